@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+import generate_stage_2
+import generate_stage_3
+from trajectory_cache import load_trajectory
+
+
+def best_time(fn, rounds):
+    """Best wall time of `rounds` calls, and the result of the last one."""
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def stage_2_windows(trajectory, segment_length, step):
+    step = step or max(1, segment_length // 2)
+    return [(i, i + segment_length) for i in range(0, len(trajectory) - segment_length + 1, step)]
+
+
+def benchmark_stage_2(trajectories, configs, rounds):
+    def reference():
+        return [
+            generate_stage_2.build_conversation(trajectory[start:end])
+            for trajectory in trajectories
+            for segment_length, step in configs
+            for start, end in stage_2_windows(trajectory, segment_length, step)
+        ]
+
+    def fragment_join():
+        samples = []
+        for trajectory in trajectories:
+            fragments = generate_stage_2.serialize_fragments(trajectory)
+            for segment_length, step in configs:
+                samples.extend(
+                    generate_stage_2.generate_dataset_json_format(trajectory, segment_length, step, fragments)
+                )
+        return samples
+
+    return best_time(reference, rounds), best_time(fragment_join, rounds)
+
+
+def benchmark_stage_3(trajectories, window_size, stride, rounds):
+    system_prompt = generate_stage_3.STAGE_3_SYSTEM_PROMPT
+    windows = [
+        [(end - window_size, end) for end in range(window_size, len(trajectory) + 1, stride)]
+        for trajectory in trajectories
+    ]
+
+    def reference():
+        return [
+            generate_stage_3.build_conversation(trajectory[start:end], system_prompt)
+            for trajectory, ranges in zip(trajectories, windows)
+            for start, end in ranges
+        ]
+
+    def fragment_join():
+        samples = []
+        for trajectory, ranges in zip(trajectories, windows):
+            fragments = generate_stage_3.serialize_fragments(trajectory)
+            for start, end in ranges:
+                samples.append(generate_stage_3.build_window_conversation(fragments, start, end, system_prompt))
+        return samples
+
+    return best_time(reference, rounds), best_time(fragment_join, rounds)
+
+
+def report(name, results):
+    (reference_time, reference_samples), (fragment_time, fragment_samples) = results
+    identical = json.dumps(reference_samples, ensure_ascii=False) == json.dumps(fragment_samples, ensure_ascii=False)
+    print(
+        f"{name}: {len(reference_samples)} samples, per-window build {reference_time:.3f}s, "
+        f"fragment join {fragment_time:.3f}s ({reference_time / max(fragment_time, 1e-9):.1f}x), "
+        f"byte-identical: {identical}"
+    )
+    return identical
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare per-window sample building with fragment reuse for stage 2 and stage 3."
+    )
+    parser.add_argument("--trajectory-dir", default="data/trajectory/test")
+    parser.add_argument(
+        "--configs",
+        nargs="+",
+        type=generate_stage_2.parse_config,
+        default=[(5, None)],
+        help="stage 2 window configurations",
+    )
+    parser.add_argument("--window-size", type=int, default=51, help="stage 3 window size")
+    parser.add_argument("--stride", type=int, default=7, help="distance between consecutive stage 3 windows")
+    parser.add_argument("--rounds", type=int, default=3, help="timed runs, the best one is reported")
+    args = parser.parse_args()
+
+    file_list = sorted(filename for filename in os.listdir(args.trajectory_dir) if filename.endswith(".json"))
+    trajectories = [load_trajectory(os.path.join(args.trajectory_dir, filename)) for filename in file_list]
+
+    identical = report("stage 2", benchmark_stage_2(trajectories, args.configs, args.rounds))
+    identical &= report("stage 3", benchmark_stage_3(trajectories, args.window_size, args.stride, args.rounds))
+    if not identical:
+        sys.exit(1)
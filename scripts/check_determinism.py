@@ -0,0 +1,65 @@
+import os
+import sys
+import random
+import filecmp
+import argparse
+import tempfile
+
+from generate_stage_2 import generate_stage_2_multi, parse_config
+from generate_stage_3 import GenStage3Dataset
+
+
+def generate(trajectory_dir, save_dir, split, configs, output_format, seed, workers, shuffle_files=False):
+    file_list = os.listdir(trajectory_dir)
+    if shuffle_files:
+        random.shuffle(file_list)
+    file_path_list = [os.path.join(trajectory_dir, filename) for filename in file_list]
+    output_options = {"output_format": output_format, "seed": seed, "workers": workers}
+    generate_stage_2_multi(file_path_list, os.path.join(save_dir, "stage2"), split, configs, **output_options)
+    GenStage3Dataset(trajectory_dir, os.path.join(save_dir, "stage3"), split, **output_options)
+
+
+def compare_dirs(dir1, dir2):
+    """Returns the relative paths that differ between two output trees (missing on either side included)."""
+    files1 = {os.path.relpath(os.path.join(root, f), dir1) for root, _, files in os.walk(dir1) for f in files}
+    files2 = {os.path.relpath(os.path.join(root, f), dir2) for root, _, files in os.walk(dir2) for f in files}
+    mismatches = sorted(files1 ^ files2)
+    for path in sorted(files1 & files2):
+        if not filecmp.cmp(os.path.join(dir1, path), os.path.join(dir2, path), shallow=False):
+            mismatches.append(path)
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that stage 2 and stage 3 outputs are byte-identical with 1 and N workers."
+    )
+    parser.add_argument("--trajectory-dir", default="data/trajectory/test")
+    parser.add_argument("--split", default="test")
+    parser.add_argument("--configs", nargs="+", type=parse_config, default=[(5, None)])
+    parser.add_argument("--output-format", choices=["json", "jsonl"], default="json")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        serial_dir = os.path.join(tmp_dir, "workers_1")
+        parallel_dir = os.path.join(tmp_dir, f"workers_{args.workers}")
+        generate(args.trajectory_dir, serial_dir, args.split, args.configs, args.output_format, args.seed, 1)
+        # the parallel run also sees the files in a different order
+        generate(
+            args.trajectory_dir,
+            parallel_dir,
+            args.split,
+            args.configs,
+            args.output_format,
+            args.seed,
+            args.workers,
+            True,
+        )
+        mismatches = compare_dirs(serial_dir, parallel_dir)
+
+    if mismatches:
+        print(f"Outputs differ between 1 and {args.workers} workers: {mismatches}")
+        sys.exit(1)
+    print(f"Outputs are byte-identical between 1 and {args.workers} workers (seed {args.seed}).")
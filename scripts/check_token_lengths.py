@@ -0,0 +1,73 @@
+import os
+import sys
+import argparse
+
+from trajectory_cache import load_trajectory
+from generate_stage_2 import count_conversation_tokens, generate_dataset_json_format, parse_config
+
+
+class CharCounter:
+    """One token per character: additive, so a sample's token_length must equal the count of its messages exactly."""
+
+    def count_all(self, texts):
+        return [len(text) for text in texts]
+
+    def count(self, text):
+        return len(text)
+
+
+def get_edge_case_trajectory():
+    """Behaviors without steps, repeated behaviors (their keys collapse in the answer) and a non-string behavior."""
+    def steps(n, tag):
+        return [{"action_description": f"tap {tag} {i} ü"} for i in range(n)]
+
+    behaviors = [("beh 24 ü", 2), ("beh 25", 0), ("beh 24 ü", 5), ("beh 26", 1), ("beh 25", 3), ("beh 27", 0)]
+    behaviors += [(7, 2), ("beh 28", 4), ("beh 24 ü", 0), ("beh 29", 6), ("beh 29", 1), ("beh 30", 2)]
+    return [{"behavior": behavior, "steps": steps(n, i)} for i, (behavior, n) in enumerate(behaviors)]
+
+
+def check_trajectory(trajectory, configs, token_budgets):
+    """Number of samples checked, and the samples whose token_length is not the count of their messages."""
+    counter = CharCounter()
+    n_samples, mismatches = 0, []
+    for segment_length, step in configs:
+        for token_budget in token_budgets:
+            for sample in generate_dataset_json_format(trajectory, segment_length, step, None, counter, token_budget):
+                n_samples += 1
+                actual = count_conversation_tokens(counter, sample)
+                if sample["token_length"] != actual or (token_budget is not None and actual > token_budget):
+                    mismatches.append((segment_length, step, token_budget, sample["token_length"], actual))
+    return n_samples, mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that the stage 2 token_length of every sample equals the token count of its messages."
+    )
+    parser.add_argument("--trajectory-dir", default="data/trajectory/test")
+    parser.add_argument("--configs", nargs="+", type=parse_config, default=[(3, 1), (5, None), (8, 3)])
+    parser.add_argument("--token-budgets", type=int, nargs="+", default=[2000, 2400], help="budgets besides none")
+    args = parser.parse_args()
+
+    trajectories = [get_edge_case_trajectory()]
+    if os.path.isdir(args.trajectory_dir):
+        trajectories += [
+            load_trajectory(os.path.join(args.trajectory_dir, filename), columns=("behavior", "steps"))
+            for filename in sorted(os.listdir(args.trajectory_dir))
+            if filename.endswith(".json")
+        ]
+
+    n_samples, mismatches = 0, []
+    for trajectory in trajectories:
+        n, trajectory_mismatches = check_trajectory(trajectory, args.configs, [None] + args.token_budgets)
+        n_samples += n
+        mismatches += trajectory_mismatches
+
+    for segment_length, step, token_budget, token_length, actual in mismatches[:10]:
+        print(
+            f"len {segment_length}, step {step}, budget {token_budget}: token_length {token_length}, "
+            f"messages count {actual}"
+        )
+    print(f"{n_samples} samples, {len(mismatches)} with a wrong token_length")
+    if mismatches:
+        sys.exit(1)
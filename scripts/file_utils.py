@@ -0,0 +1,13 @@
+import os
+import importlib.util
+
+# scripts/ and simulator/ are run as separate script directories, so the single implementation in
+# simulator/file_utils.py is loaded by path instead of being copied here
+_spec = importlib.util.spec_from_file_location(
+    "simulator_file_utils",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "simulator", "file_utils.py"),
+)
+_module = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(_module)
+
+write_json_atomic = _module.write_json_atomic
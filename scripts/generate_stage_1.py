@@ -1,12 +1,20 @@
 import os
+import math
+import hashlib
+import time
 import json
 import random
+import argparse
 import datetime
 import numpy as np
 from tqdm import tqdm
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image, ImageDraw, ImageFont
 
+from file_utils import write_json_atomic
+from merge_image_store import MergeImageStore
+
 STAGE_1_SYSTEM_PROMPT = """
 <Role>You are a professional GUI action Describer</Role>
 <Task>You are given an action and the split-screenshot image (Before-action left, After-action right) on the mobile phone. Then, you need to describe the action.</Task>
@@ -19,9 +27,81 @@ STAGE_1_SYSTEM_PROMPT = """
 </Rule>
 """
 
+DEFAULT_RENDER_PARAMS = {
+    "token_budget": None,  # max vision tokens per merged image, None keeps the full resolution
+    "patch_size": 28,  # pixels per side of one vision token, e.g. 28 for Qwen2-VL (14px patches merged 2x2)
+    "image_format": "png",  # "png", "jpeg" or "webp"
+    "quality": 90,  # JPEG / WebP quality
+}
+IMAGE_EXTENSIONS = {"png": "png", "jpeg": "jpg", "webp": "webp"}
+
+
+class RenderContext:
+    """
+    Per-process rendering resources reused across merge jobs:
+    decoded screenshots in a bounded LRU (the "after" image of step i is the "before" image of step i+1),
+    the marker font, and gradient separator strips memoized by height.
+
+    Every cached screenshot is a full-resolution bitmap held by each pool worker, so memory grows with
+    max_images * workers. Jobs reach a worker in step order and reuse only the previous job's "after" image,
+    so the default keeps one job's two inputs; a larger bound only helps when jobs arrive out of order.
+    """
+
+    def __init__(self, max_images=2, font_path="arial.ttf", font_size=14):
+        self.max_images = max_images
+        self.font_path = font_path
+        self.font_size = font_size
+        self.images = OrderedDict()
+        self.separators = {}
+        self.font = None
+
+    def open_image(self, image_path):
+        """Returns the decoded screenshot; shared, so callers must copy() before drawing on it."""
+        img = self.images.get(image_path)
+        if img is not None:
+            self.images.move_to_end(image_path)
+            return img
+
+        img = Image.open(image_path)
+        img.load()
+        self.images[image_path] = img
+        if len(self.images) > self.max_images:
+            self.images.popitem(last=False)
+        return img
+
+    def get_font(self):
+        if self.font is None:
+            self.font = ImageFont.truetype(self.font_path, self.font_size)
+        return self.font
+
+    def get_separator(self, height, gap):
+        key = (height, gap)
+        if key not in self.separators:
+            gradient = np.linspace(0, 255, gap // 2)
+            gradient = np.concatenate([gradient, gradient[::-1]])
+            gradient = np.tile(gradient, (height, 1)).reshape(height, gap)
+            self.separators[key] = Image.fromarray(gradient)
+        return self.separators[key]
+
+
+_render_context = None
+
+
+def get_render_context():
+    global _render_context
+    if _render_context is None:
+        _render_context = RenderContext()
+    return _render_context
+
+
+def set_base_dir(path):
+    """Sets the dataset root that screenshots, trajectories and outputs are resolved against."""
+    global base_dir
+    base_dir = path
+
 
 def mark_click(image_path, x, y):
-    img = Image.open(image_path)
+    img = get_render_context().open_image(image_path).copy()
     width, height = img.size
     draw = ImageDraw.Draw(img)
 
@@ -43,7 +123,7 @@ def mark_click(image_path, x, y):
     )
     draw.ellipse((x - circle_radius, y - circle_radius, x + circle_radius, y + circle_radius), fill="red")
 
-    font = ImageFont.truetype("arial.ttf", 14)
+    font = get_render_context().get_font()
     text_x = square_box[2] - 15
     text_y = square_box[1] + 2
     draw.text((text_x, text_y), "C", fill="green", font=font)
@@ -51,43 +131,230 @@ def mark_click(image_path, x, y):
     return img
 
 
-def merge_screenshots(left_path, right_path, action, i):
-    save_name = f"{left_path.split('-')[0]}-{i+1}-to-{i+2}.png"
-    save_path = os.path.join(base_dir, merge_image_base_dir, save_name)
-
-    if os.path.exists(save_path):
-        return save_path
-    left_path = os.path.join(image_base_dir, left_path)
-    right_path = os.path.join(image_base_dir, right_path)
-
+def estimate_image_tokens(width, height, patch_size):
+    return math.ceil(width / patch_size) * math.ceil(height / patch_size)
+
+
+def fit_token_budget(width, height, token_budget, patch_size):
+    """
+    Description:
+        Size closest to (width, height) with both sides multiples of patch_size and at most token_budget
+        patches, keeping the aspect ratio. Images are never upscaled beyond patch rounding.
+    Returns:
+        (width, height)
+    """
+    new_width = max(patch_size, round(width / patch_size) * patch_size)
+    new_height = max(patch_size, round(height / patch_size) * patch_size)
+    if (new_width // patch_size) * (new_height // patch_size) > token_budget:
+        scale = math.sqrt(width * height / (token_budget * patch_size * patch_size))
+        new_width = max(patch_size, math.floor(width / scale / patch_size) * patch_size)
+        new_height = max(patch_size, math.floor(height / scale / patch_size) * patch_size)
+    return new_width, new_height
+
+
+def get_merge_save_path(left_path, i, render_params=None):
+    render_params = render_params or DEFAULT_RENDER_PARAMS
+    # resized / lossy variants get their own file names, so changing the options never reuses stale images
+    suffix = ""
+    if render_params["token_budget"]:
+        suffix += f"-t{render_params['token_budget']}p{render_params['patch_size']}"
+    if render_params["image_format"] != "png":
+        suffix += f"-q{render_params['quality']}"
+    extension = IMAGE_EXTENSIONS[render_params["image_format"]]
+    save_name = f"{left_path.split('-')[0]}-{i+1}-to-{i+2}{suffix}.{extension}"
+    return os.path.join(base_dir, merge_image_base_dir, save_name)
+
+
+def render_merged_image(left_path, right_path, action, render_params=None):
+    """
+    Description:
+        Composites the before (left, with the click marker) and after (right) screenshots in memory.
+    Args:
+        left_path (str): before screenshot, relative to base_dir/image_base_dir
+        right_path (str): after screenshot, relative to base_dir/image_base_dir
+        action (str): the action, e.g. "CLICK[x,y]"
+        render_params (dict): resize / encoding options, see DEFAULT_RENDER_PARAMS
+    Returns:
+        merged (PIL.Image)
+    """
+    render_params = render_params or DEFAULT_RENDER_PARAMS
+    left_path = os.path.join(base_dir, image_base_dir, left_path)
+    right_path = os.path.join(base_dir, image_base_dir, right_path)
+
+    render_context = get_render_context()
     if action.startswith("CLICK"):
         _, coords = action.strip("]").split("[")
         x, y = map(int, coords.split(","))
         left_img = mark_click(left_path, x, y)
     else:
-        left_img = Image.open(left_path)
+        left_img = render_context.open_image(left_path)
 
-    right_img = Image.open(right_path)
+    right_img = render_context.open_image(right_path)
 
     gap = 10
     width = left_img.width + right_img.width + gap
     height = max(left_img.height, right_img.height)
     merged = Image.new("RGB", (width, height), "white")
 
-    gradient = np.linspace(0, 255, gap // 2)
-    gradient = np.concatenate([gradient, gradient[::-1]])
-    gradient = np.tile(gradient, (left_img.height, 1)).reshape(left_img.height, gap)
-
-    merged.paste(Image.fromarray(gradient), (left_img.width, 0))
+    merged.paste(render_context.get_separator(left_img.height, gap), (left_img.width, 0))
     merged.paste(left_img, (0, 0))
     merged.paste(right_img, (left_img.width + gap, 0))
 
+    if render_params["token_budget"]:
+        size = fit_token_budget(width, height, render_params["token_budget"], render_params["patch_size"])
+        if size != merged.size:
+            merged = merged.resize(size, Image.LANCZOS)
+    return merged
+
+
+def get_merged_size(left_path, right_path, render_params=None):
+    """Size render_merged_image would produce, from the screenshot headers only."""
+    render_params = render_params or DEFAULT_RENDER_PARAMS
+    with Image.open(os.path.join(base_dir, image_base_dir, left_path)) as left_img, Image.open(
+        os.path.join(base_dir, image_base_dir, right_path)
+    ) as right_img:
+        width = left_img.width + right_img.width + 10
+        height = max(left_img.height, right_img.height)
+    if render_params["token_budget"]:
+        return fit_token_budget(width, height, render_params["token_budget"], render_params["patch_size"])
+    return width, height
+
+
+def save_merged_image(merged, save_path, render_params=None):
+    render_params = render_params or DEFAULT_RENDER_PARAMS
+    if render_params["image_format"] == "png":
+        merged.save(save_path)
+    else:
+        merged.save(save_path, render_params["image_format"].upper(), quality=render_params["quality"])
+
+
+def merge_screenshots(left_path, right_path, action, i, render_params=None):
+    render_params = render_params or DEFAULT_RENDER_PARAMS
+    save_path = get_merge_save_path(left_path, i, render_params)
+
+    if os.path.exists(save_path):
+        return save_path
+    merged = render_merged_image(left_path, right_path, action, render_params)
+
     # save
-    merged.save(save_path)
+    save_merged_image(merged, save_path, render_params)
     return save_path
 
 
-def generate_conversation(steps, app):
+def get_merge_job(img_path_before, img_path_after, action, i, render_params=None, store=None):
+    """
+    Description:
+        Builds the render job of one step. Without a store, the image is named after the before screenshot
+        and step index; with a MergeImageStore, it is content-addressed.
+    Returns:
+        job (tuple): (img_path_before, img_path_after, action, save_path, render_params)
+    """
+    render_params = render_params or DEFAULT_RENDER_PARAMS
+    if store is None:
+        save_path = get_merge_save_path(img_path_before, i, render_params)
+    else:
+        extension = IMAGE_EXTENSIONS[render_params["image_format"]]
+        save_path = store.get_path(img_path_before, img_path_after, action, render_params, extension)
+    return (img_path_before, img_path_after, action, save_path, render_params)
+
+
+def render_merge_job(job):
+    """
+    Process-pool entry point: renders one merged image.
+    Returns (bytes written, (width, height)).
+    """
+    left_path, right_path, action, save_path, render_params = job
+    merged = render_merged_image(left_path, right_path, action, render_params)
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    save_merged_image(merged, save_path, render_params)
+    return os.path.getsize(save_path), merged.size
+
+
+def render_merge_images(merge_jobs, workers=1, store=None, verbose=True, rerender=()):
+    """
+    Description:
+        Renders the merged images of all jobs that are not on disk yet, fanning out to a process pool
+        when workers > 1, and reports images/sec, bytes written and vision tokens.
+        With a MergeImageStore, existing images are found by manifest lookup and new ones are added to it;
+        call store.save() afterwards.
+    Args:
+        merge_jobs (list): jobs from get_merge_job
+        workers (int): number of worker processes
+        store (MergeImageStore): content-addressed store the jobs were built with
+        verbose (bool): show progress and statistics
+        rerender (set): paths rendered again even though the store has them, e.g. stale images whose file is missing
+    Returns:
+        image_tokens (dict): merged image path -> vision-token estimate
+    """
+    # one job per output file, so two workers never write the same path
+    unique_jobs = {job[3]: job for job in merge_jobs}
+    sizes = {}
+    jobs = []
+    for save_path, job in unique_jobs.items():
+        if store is not None:
+            entry = store.lookup(save_path)
+            if entry is not None and save_path not in rerender:
+                sizes[save_path] = (entry["width"], entry["height"])
+                continue
+        elif os.path.exists(save_path):
+            with Image.open(save_path) as img:
+                sizes[save_path] = img.size
+            continue
+        jobs.append(job)
+
+    start = time.perf_counter()
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=set_base_dir, initargs=(base_dir,)) as executor:
+            chunksize = max(1, min(64, len(jobs) // (workers * 4)))
+            results = list(
+                tqdm(
+                    executor.map(render_merge_job, jobs, chunksize=chunksize),
+                    total=len(jobs),
+                    disable=not verbose,
+                )
+            )
+    else:
+        results = [render_merge_job(job) for job in tqdm(jobs, disable=not verbose)]
+    elapsed = time.perf_counter() - start
+
+    for job, (n_bytes, size) in zip(jobs, results):
+        sizes[job[3]] = size
+        if store is not None:
+            store.add(job[3], job[0], job[1], job[2], size[0], size[1], n_bytes)
+
+    image_tokens = {
+        save_path: estimate_image_tokens(*sizes[save_path], job[4]["patch_size"])
+        for save_path, job in unique_jobs.items()
+    }
+    if verbose:
+        tokens = list(image_tokens.values())
+        print(
+            f"Merged images: {len(merge_jobs)} steps, {len(unique_jobs)} unique, {len(jobs)} written, "
+            f"{len(unique_jobs) - len(jobs)} skipped, {len(jobs) / max(elapsed, 1e-9):.1f} images/sec, "
+            f"{sum(n for n, _ in results) / 2**20:.1f} MiB written ({workers} workers, {elapsed:.1f}s)"
+        )
+        if tokens:
+            print(f"Vision tokens per image: mean {np.mean(tokens):.0f}, max {max(tokens)}, total {sum(tokens)}")
+    return image_tokens
+
+
+def generate_conversation(steps, app, merge_jobs=None, render_params=None, output_mode="materialized", store=None):
+    """
+    Description:
+        Builds the ActionDescriber conversations of one behavior.
+    Args:
+        steps (list): behavior steps
+        app (str): app name
+        merge_jobs (list): if given, merged images are not rendered here; their jobs are appended
+            to this list for render_merge_images and "image_tokens" is left for the caller to fill
+        render_params (dict): resize / encoding options, see DEFAULT_RENDER_PARAMS
+        output_mode (str): "materialized" references merged image files; "virtual" references
+            (before, after, action, render_params) and nothing is rendered, see stage1_dataset.py
+        store (MergeImageStore): content-addressed store for merged images, None for the legacy names
+    Returns:
+        conversations (list)
+    """
+    render_params = render_params or DEFAULT_RENDER_PARAMS
     res = []
     for i in range(len(steps) - 1):
         step_obj = steps[i]
@@ -96,7 +363,27 @@ def generate_conversation(steps, app):
         img_path_before = step_obj["image_path"]
         img_path_after = steps[i + 1]["image_path"]
 
-        merge_image_path = merge_screenshots(img_path_before, img_path_after, action, i)
+        if output_mode == "virtual":
+            image_ref = {
+                "type": "merged_image",
+                "merged_image": {
+                    "before": img_path_before,
+                    "after": img_path_after,
+                    "action": action,
+                    "index": i,
+                    "render_params": render_params,
+                },
+            }
+            size = get_merged_size(img_path_before, img_path_after, render_params)
+            image_tokens = estimate_image_tokens(*size, render_params["patch_size"])
+        else:
+            job = get_merge_job(img_path_before, img_path_after, action, i, render_params, store)
+            image_ref = {"type": "image_url", "image_url": {"url": job[3]}}
+            if merge_jobs is None:
+                image_tokens = render_merge_images([job], store=store, verbose=False)[job[3]]
+            else:
+                merge_jobs.append(job)
+                image_tokens = None
 
         res.append(
             {
@@ -106,7 +393,7 @@ def generate_conversation(steps, app):
                         "role": "user",
                         "content": [
                             {"type": "text", "text": f"The Action is: {action}, current app is: {app}."},
-                            {"type": "image_url", "image_url": {"url": merge_image_path}},
+                            image_ref,
                         ],
                     },
                     {
@@ -114,43 +401,251 @@ def generate_conversation(steps, app):
                         "content": json.dumps({"Action_Description": action_description}, ensure_ascii=False),
                     },
                 ],
+                "image_tokens": image_tokens,
             }
         )
     return res
 
 
-base_dir = "/path/to/root"  # TODO
-
-image_base_dir = "data/screenshots/screenshots"
-merge_image_base_dir = "data/datasets/stage1/merge_images"
-
-trajectory_dir_test = "data/trajectory/test"
-file_list_test = os.listdir(trajectory_dir_test)
-file_path_test = [os.path.join(trajectory_dir_test, filename) for filename in file_list_test]
-
-
-res_conversations_list = []
-behavior_actions = defaultdict(int)
-for idx, file in enumerate(file_path_test):
-    if not file.endswith(".json"):
-        continue
-    print(f"{'='*10}{idx}{'='*10}")
-    with open(file, "r") as f:
+def get_image_url(conversation):
+    return conversation["messages"][1]["content"][1]["image_url"]["url"]
+
+
+def get_file_fingerprint(path, memo=None):
+    """size / mtime / sha256 of a file; the hash is reused from `memo` when size and mtime are unchanged."""
+    stat = os.stat(path)
+    if memo is not None and memo["size"] == stat.st_size and memo["mtime_ns"] == stat.st_mtime_ns:
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": memo["sha256"]}
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}
+
+
+def generate_file_conversations(
+    file_path, behaviors, merge_jobs, render_params, output_mode="materialized", store=None
+):
+    """
+    Description:
+        Builds the conversations of one trajectory file, skipping behaviors already in `behaviors`.
+    Args:
+        file_path (str): trajectory file
+        behaviors (set): behaviors seen so far in the split, updated in place
+        merge_jobs (list): render jobs are appended here
+        render_params (dict): resize / encoding options
+        output_mode (str): "materialized" or "virtual"
+        store (MergeImageStore): content-addressed store, None for the legacy names
+    Returns:
+        conversations (list), claimed (list): behaviors first seen in this file
+    """
+    with open(file_path, "r") as f:
         event_track_data = json.load(f)
-    for item in tqdm(event_track_data):
+
+    conversations = []
+    claimed = []
+    for item in tqdm(event_track_data, desc=os.path.basename(file_path)):
         behavior = item["behavior"]
 
-        if behavior in behavior_actions:
+        if behavior in behaviors:
             continue
 
-        behavior_actions[behavior] = 1  # mark
+        behaviors.add(behavior)  # mark
+        claimed.append(behavior)
 
         steps = item["steps"]
         app = item["app"]
 
-        res_conversations_list.extend(generate_conversation(steps, app))
+        conversations.extend(generate_conversation(steps, app, merge_jobs, render_params, output_mode, store))
+    return conversations, claimed
+
+
+def build_stage1(
+    base_dir=".",
+    splits=("test",),
+    render_params=None,
+    output_mode="materialized",
+    image_store="content",
+    workers=1,
+    prune_stale=False,
+    verify_store=False,
+    force=False,
+):
+    """
+    Description:
+        Builds data/datasets/stage1/{split}.json for every split incrementally.
+        build_manifest.json in the stage-1 directory records the parameters and, per trajectory file, its
+        size / mtime / sha256 and the behaviors it contributed; the conversations of each file are cached under
+        stage1/cache/{split}/. A file is regenerated only when it changed, the parameters changed, or the behaviors
+        claimed by the files before it changed (behaviors are deduplicated across the split, first file wins), or its
+        cached conversations reference a stored merged image that is stale.
+    Args:
+        base_dir (str): dataset root containing data/trajectory and data/screenshots
+        splits (list): trajectory splits under data/trajectory, e.g. ["train", "test"]
+        render_params (dict): resize / encoding options, see DEFAULT_RENDER_PARAMS
+        output_mode (str): "materialized" or "virtual"
+        image_store (str): "content" for the content-addressed store, "names" for the legacy names
+        workers (int): processes used to render merged images
+        prune_stale (bool): delete stored merged images whose screenshots changed
+        verify_store (bool): also treat stored merged images whose file is missing as stale
+        force (bool): ignore the build manifest and regenerate everything
+    """
+    base_dir = os.path.abspath(base_dir)
+    set_base_dir(base_dir)
+    render_params = {**DEFAULT_RENDER_PARAMS, **(render_params or {})}
+    save_dir = os.path.join(base_dir, stage1_save_dir)
+    manifest_path = os.path.join(save_dir, "build_manifest.json")
+
+    params = {
+        "render_params": render_params,
+        "output_mode": output_mode,
+        "image_store": image_store,
+        "base_dir": base_dir,
+    }
+    manifest = {"params": params, "splits": {}}
+    if os.path.exists(manifest_path) and not force:
+        with open(manifest_path, "r") as f:
+            previous = json.load(f)
+        if previous["params"] == params:
+            manifest = previous
+        else:
+            print("Build parameters changed, regenerating all splits")
+
+    store = None
+    if image_store == "content":
+        store = MergeImageStore(os.path.join(base_dir, merge_image_base_dir), os.path.join(base_dir, image_base_dir))
+    if output_mode == "materialized":
+        os.makedirs(os.path.join(base_dir, merge_image_base_dir), exist_ok=True)
+    # cached conversations that point at stale images are regenerated, so they get keys of the current screenshots
+    stale = set()
+    if store is not None and output_mode == "materialized":
+        stale = set(store.find_stale(verify_files=verify_store))
+
+    for split in splits:
+        trajectory_dir = os.path.join(base_dir, trajectory_base_dir, split)
+        cache_dir = os.path.join(save_dir, "cache", split)
+        previous_files = manifest["splits"].get(split, {})
+        files = {}
+        behaviors = set()
+        prior = ""  # chained hash of the behaviors claimed by the files so far
+        conversations = []
+        new_conversations = {}
+        merge_jobs = []
+        for filename in sorted(os.listdir(trajectory_dir)):
+            if not filename.endswith(".json"):
+                continue
+            file_path = os.path.join(trajectory_dir, filename)
+            cache_path = os.path.join(cache_dir, filename)
+            previous = previous_files.get(filename)
+            fingerprint = get_file_fingerprint(file_path, previous)
+
+            unchanged = (
+                previous is not None
+                and previous["sha256"] == fingerprint["sha256"]
+                and previous["prior"] == prior
+                and os.path.exists(cache_path)
+            )
+            if unchanged:
+                with open(cache_path, "r") as f:
+                    file_conversations = json.load(f)
+                if stale:
+                    unchanged = not any(get_image_url(conversation) in stale for conversation in file_conversations)
+
+            if unchanged:
+                claimed = previous["behaviors"]
+                behaviors.update(claimed)
+            else:
+                file_conversations, claimed = generate_file_conversations(
+                    file_path, behaviors, merge_jobs, render_params, output_mode, store
+                )
+                new_conversations[cache_path] = file_conversations
+
+            files[filename] = {**fingerprint, "prior": prior, "behaviors": claimed}
+            prior = hashlib.sha256((prior + json.dumps(claimed, ensure_ascii=False)).encode("utf-8")).hexdigest()
+            conversations.extend(file_conversations)
+
+        if output_mode == "materialized" and merge_jobs:
+            image_tokens = render_merge_images(merge_jobs, workers, store, rerender=stale)
+            stale.difference_update(image_tokens)
+            for file_conversations in new_conversations.values():
+                for conversation in file_conversations:
+                    conversation["image_tokens"] = image_tokens[get_image_url(conversation)]
+
+        for cache_path, file_conversations in new_conversations.items():
+            write_json_atomic(cache_path, file_conversations, indent=None)
+        for filename in set(previous_files) - set(files):
+            if os.path.exists(os.path.join(cache_dir, filename)):
+                os.remove(os.path.join(cache_dir, filename))
+
+        # save
+        write_json_atomic(os.path.join(save_dir, f"{split}.json"), conversations, indent=2)
+        manifest["splits"][split] = files
+        write_json_atomic(manifest_path, manifest, indent=None)
+        print(
+            f"{split}: {len(files)} trajectory files ({len(files) - len(new_conversations)} unchanged), "
+            f"{len(behaviors)} behaviors, {len(conversations)} conversations"
+        )
+
+    if store is not None:
+        # after the rebuild, so that nothing written above still references a pruned image
+        stale = store.find_stale(verify_files=verify_store)
+        if stale and prune_stale:
+            store.remove(stale)
+            print(f"Pruned {len(stale)} stale merged images")
+        elif stale:
+            print(
+                f"{len(stale)} stored merged images are stale (sources changed or image missing); "
+                "rerun with --prune-stale"
+            )
+        store.save()
+
+
+base_dir = "."  # dataset root, set with set_base_dir / build_stage1(base_dir=...)
 
-# save
-os.makedirs("data/datasets/stage1/", exist_ok=True)
-with open("data/datasets/stage1/test.json", "w") as f:
-    json.dump(res_conversations_list, f, ensure_ascii=False, indent=2)
+image_base_dir = "data/screenshots/screenshots"
+merge_image_base_dir = "data/datasets/stage1/merge_images"
+trajectory_base_dir = "data/trajectory"
+stage1_save_dir = "data/datasets/stage1"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the stage 1 (ActionDescriber) dataset.")
+    parser.add_argument("--base-dir", default=".", help="dataset root containing data/trajectory and data/screenshots")
+    parser.add_argument("--splits", nargs="+", default=["test"], help="trajectory splits, e.g. train test")
+    parser.add_argument("--force", action="store_true", help="ignore the build manifest and regenerate everything")
+    parser.add_argument("--workers", type=int, default=1, help="processes used to render merged images")
+    parser.add_argument("--token-budget", type=int, default=None, help="max vision tokens per merged image")
+    parser.add_argument("--patch-size", type=int, default=28, help="pixels per side of one vision token")
+    parser.add_argument("--image-format", choices=list(IMAGE_EXTENSIONS), default="png")
+    parser.add_argument("--quality", type=int, default=90, help="JPEG / WebP quality")
+    parser.add_argument(
+        "--output-mode",
+        choices=["materialized", "virtual"],
+        default="materialized",
+        help="virtual writes render references instead of merged images, see stage1_dataset.py",
+    )
+    parser.add_argument(
+        "--image-store",
+        choices=["content", "names"],
+        default="content",
+        help="content: content-addressed images with a manifest; names: legacy {screenshot}-{i}-to-{i+1} names",
+    )
+    parser.add_argument("--prune-stale", action="store_true", help="delete stored images whose sources changed")
+    parser.add_argument(
+        "--verify-store", action="store_true", help="also treat stored images whose file is missing as stale"
+    )
+    args = parser.parse_args()
+
+    build_stage1(
+        base_dir=args.base_dir,
+        splits=args.splits,
+        render_params={
+            "token_budget": args.token_budget,
+            "patch_size": args.patch_size,
+            "image_format": args.image_format,
+            "quality": args.quality,
+        },
+        output_mode=args.output_mode,
+        image_store=args.image_store,
+        workers=args.workers,
+        prune_stale=args.prune_stale,
+        verify_store=args.verify_store,
+        force=args.force,
+    )
@@ -3,10 +3,19 @@ import sys
 import json
 import math
 import random
+import argparse
+import operator
 from enum import Enum
-from itertools import combinations
+from itertools import combinations, repeat
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
+from rng_utils import derive_seed
+from pool_utils import bounded_map
+from shard_writer import ShardedJSONLWriter
+from trajectory_cache import load_trajectory
+from token_windows import check_token_options, get_token_counter, group_by_bucket, get_bucket_output_name
+
 
 STAGE_2_SYSTEM_PROMPT = """<Role>You are a mobile action descriptions analysis expert, responsible for identifying user behaviors on mobile devices. </Role><Task> You are tasked with grouping action description sequences and identifying the corresponding behavior for each group. You need output in JSON format.</Task>
 Please process user input according to the following rules:
@@ -47,81 +56,458 @@ def get_trajectory(file_path_list):
         if not file.endswith(".json"):
             continue
 
-        with open(file, "r", encoding="utf-8") as f:
-            trajectory = json.load(f)
+        yield load_trajectory(file)
+
+
+STAGE_2_USER_PREFIX = "Please handle the following sequence of action descriptions:\n"
+
+
+def build_conversation(segment):
+    """Stage 2 sample of one window of behaviors, built from scratch; see build_window_conversation."""
+    ## user input
+    action_description_list = [step["action_description"] for behavior in segment for step in behavior["steps"]]
+    action_description_list = [
+        f"step_{i+1}: {action_description}" for i, action_description in enumerate(action_description_list)
+    ]
+    action_description_string = "\n".join(action_description_list)
+
+    ### assistant output
+    output_dict = {}
+    step_start = 1
+    for behavior in segment:
+        output_dict[behavior["behavior"]] = [step_start + i for i in range(len(behavior["steps"]))]
+        step_start += len(behavior["steps"])
+
+    my_conversation = {
+        "messages": [
+            {"role": "system", "content": STAGE_2_SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": f"{STAGE_2_USER_PREFIX}{action_description_string}\n",
+            },
+            {"role": "assistant", "content": json.dumps(output_dict, ensure_ascii=False)},
+        ],
+    }
+    return my_conversation
+
+
+STEP_PREFIXES = []  # "step_1", "step_2", ... shared by every window
+
+
+def get_step_prefixes(n_steps):
+    while len(STEP_PREFIXES) < n_steps:
+        STEP_PREFIXES.append(f"step_{len(STEP_PREFIXES) + 1}")
+    return STEP_PREFIXES[:n_steps]
 
-        yield trajectory
 
+STEP_NUMBERS = {}  # (first, stop) -> "first, first + 1, ..., stop - 1"
 
-def generate_dataset_json_format(trajectory, segment_length):
+
+def get_step_numbers(first, stop):
+    if (first, stop) not in STEP_NUMBERS:
+        STEP_NUMBERS[first, stop] = ", ".join(map(str, range(first, stop)))
+    return STEP_NUMBERS[first, stop]
+
+
+def serialize_fragments(trajectory):
+    """
+    Description:
+        Serializes every behavior of a trajectory once, so that overlapping windows are assembled by joining strings
+    Args:
+        trajectory (list): user trajectory
+    Returns:
+        fragments (dict): "lines": step lines of the whole trajectory without their "step_N" prefix,
+            "offsets": index of the first line of every behavior (plus the total), "keys": behaviors as JSON keys,
+            None for non-string behaviors
+    """
+    lines, offsets, keys = [], [0], []
+    for behavior in trajectory:
+        lines.extend([f": {step['action_description']}" for step in behavior["steps"]])
+        offsets.append(len(lines))
+        key = behavior["behavior"]
+        keys.append(json.dumps(key, ensure_ascii=False) if isinstance(key, str) else None)
+    return {"lines": lines, "offsets": offsets, "keys": keys}
+
+
+def build_window_conversation(trajectory, fragments, start, end):
+    """
+    Description:
+        Stage 2 sample of trajectory[start:end] joined from serialize_fragments, byte-identical to build_conversation.
+        Only step numbers are rendered per window; windows repeating a behavior (whose duplicate keys collapse in
+        the output dict) or with non-string behaviors fall back to build_conversation.
+    """
+    keys = fragments["keys"][start:end]
+    if None in keys or len(set(keys)) < len(keys):
+        return build_conversation(trajectory[start:end])
+
+    offsets = fragments["offsets"]
+    first_line = offsets[start]
+    window_lines = fragments["lines"][first_line : offsets[end]]
+    action_description_string = "\n".join(map(operator.add, get_step_prefixes(len(window_lines)), window_lines))
+
+    items = [
+        f"{key}: [{get_step_numbers(line_start - first_line + 1, line_end - first_line + 1)}]"
+        for key, line_start, line_end in zip(keys, offsets[start:end], offsets[start + 1 : end + 1])
+    ]
+
+    return {
+        "messages": [
+            {"role": "system", "content": STAGE_2_SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": f"{STAGE_2_USER_PREFIX}{action_description_string}\n",
+            },
+            {"role": "assistant", "content": "{" + ", ".join(items) + "}"},
+        ],
+    }
+
+
+def get_prompt_token_length(counter):
+    """Tokens of a sample without behaviors: the system prompt, the user prefix and newline, and the empty answer."""
+    return (
+        counter.count(STAGE_2_SYSTEM_PROMPT)
+        + counter.count(STAGE_2_USER_PREFIX)
+        + counter.count("\n")
+        + counter.count("{}")
+    )
+
+
+def count_conversation_tokens(counter, conversation):
+    return sum(counter.count(message["content"]) for message in conversation["messages"])
+
+
+def get_window_token_lengths(trajectory, fragments, counter, start, end):
+    """
+    Description:
+        Token lengths of the windows trajectory[start:start + 1], ..., trajectory[start:end], summed from the cached
+        counts of the fragments build_window_conversation joins (see TokenCounter). The answer is tracked the way
+        json.dumps renders it: a repeated behavior keeps the position of its first occurrence and the steps of its
+        last one. Windows with non-string behaviors are built with build_conversation and counted whole
+    Args:
+        trajectory (list): user trajectory
+        fragments (dict): serialize_fragments of the trajectory
+        counter (TokenCounter): token counter
+    Returns:
+        lengths (list): token lengths, one per window
+    """
+    offsets, lines, keys = fragments["offsets"], fragments["lines"], fragments["keys"]
+    if None in keys[start:end]:
+        return [
+            count_conversation_tokens(counter, build_conversation(trajectory[start:stop]))
+            for stop in range(start + 1, end + 1)
+        ]
+
+    separator_tokens = counter.count(", ")
+    newline_tokens = counter.count("\n")
+    item_frame_tokens = counter.count(": []")
+    prompt_tokens = get_prompt_token_length(counter)
+    user_tokens = 0
+    item_tokens = {}  # behavior key -> tokens of its "key: [numbers]" item in the answer
+    items_total = 0
+    lengths = []
+    step_number = 0
+    for i in range(start, end):
+        first = step_number + 1
+        for line in lines[offsets[i] : offsets[i + 1]]:
+            step_number += 1
+            user_tokens += counter.count(f"step_{step_number}") + counter.count(line)
+            user_tokens += newline_tokens if step_number > 1 else 0
+        numbers = [counter.count(str(number)) for number in range(first, step_number + 1)]
+        tokens = counter.count(keys[i]) + item_frame_tokens + sum(numbers) + separator_tokens * max(0, len(numbers) - 1)
+        items_total += tokens - item_tokens.get(keys[i], 0)
+        item_tokens[keys[i]] = tokens
+        lengths.append(prompt_tokens + user_tokens + items_total + separator_tokens * (len(item_tokens) - 1))
+    return lengths
+
+
+def generate_dataset_json_format(
+    trajectory, segment_length, step=None, fragments=None, counter=None, token_budget=None
+):
     """
     Desription:
         Use sliding window to split the trajectory into multiple segments
     Args:
         trajectory (dict): user trajectory
         segment_length (int): length of the sliding window
+        step (int): stride of the sliding window, half the window by default
+        fragments (list): serialize_fragments(trajectory), to share it between several window configurations
+        counter (TokenCounter): tags every sample with its "token_length"
+        token_budget (int): with a counter, every window is cut to its longest prefix that fits in the budget
+            (segment_length becomes a maximum); windows without such a prefix are dropped
     Returns:
         dataset (list)
     """
 
     window = segment_length
-    step = max(1, window // 2)
+    if step is None:
+        step = max(1, window // 2)
+    if fragments is None:
+        fragments = serialize_fragments(trajectory)
 
-    split_lists = []
-    for i in range(0, len(trajectory) - window + 1, step):
-        split_lists.append(trajectory[i : i + window])
+    if counter is None:
+        return [
+            build_window_conversation(trajectory, fragments, i, i + window)
+            for i in range(0, len(trajectory) - window + 1, step)
+        ]
 
+    counter.count_all(fragments["lines"] + [key for key in fragments["keys"] if key is not None])
     result_list = []
-    for segment in split_lists:
-        ## user input
-        action_description_list = [step["action_description"] for behavior in segment for step in behavior["steps"]]
-        action_description_list = [
-            f"step_{i+1}: {action_description}" for i, action_description in enumerate(action_description_list)
-        ]
-        action_description_string = "\n".join(action_description_list)
-
-        ### assistant output
-        output_dict = {}
-        step_start = 1
-        for behavior in segment:
-            output_dict[behavior["behavior"]] = [step_start + i for i in range(len(behavior["steps"]))]
-            step_start += len(behavior["steps"])
-
-        my_conversation = {
-            "messages": [
-                {"role": "system", "content": STAGE_2_SYSTEM_PROMPT},
-                {
-                    "role": "user",
-                    "content": f"Please handle the following sequence of action descriptions:\n{action_description_string}\n",
-                },
-                {"role": "assistant", "content": json.dumps(output_dict, ensure_ascii=False)},
-            ],
-        }
+    for i in range(0, len(trajectory) - window + 1, step):
+        lengths = get_window_token_lengths(trajectory, fragments, counter, i, i + window)
+        n_behaviors = window
+        if token_budget is not None:
+            # lengths can drop where a repeated behavior replaces a longer step list, so search them all
+            n_behaviors = max((n for n, length in enumerate(lengths, 1) if length <= token_budget), default=0)
+        if n_behaviors == 0:
+            continue
+        my_conversation = build_window_conversation(trajectory, fragments, i, i + n_behaviors)
+        my_conversation["token_length"] = lengths[n_behaviors - 1]
         result_list.append(my_conversation)
-
     return result_list
 
 
-def generate_stage_2(
+def get_config_name(split, segment_length, step=None, token_budget=None):
+    name = f"{split}_len_{segment_length}"
+    if step is not None:
+        name += f"_step_{step}"
+    if token_budget is not None:
+        name += f"_budget_{token_budget}"
+    return name
+
+
+def parse_config(config):
+    """
+    "5" -> (5, None); "8:3" -> (8, 3); "8:0.25" -> (8, 2), a stride given as a ratio of the window.
+    Used as an argparse type, so an invalid configuration is reported as a usage error.
+    """
+    segment_length, separator, step = config.partition(":")
+    try:
+        segment_length = int(segment_length)
+        if separator:
+            step = round(segment_length * float(step)) if "." in step else int(step)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f'invalid window configuration "{config}", expected LEN, LEN:STEP or LEN:RATIO'
+        )
+    if segment_length < 1:
+        raise argparse.ArgumentTypeError(f'invalid window configuration "{config}": the window length must be >= 1')
+    if not separator:
+        return segment_length, None
+    if step < 1:
+        raise argparse.ArgumentTypeError(f'invalid window configuration "{config}": the step must be >= 1')
+    return segment_length, step
+
+
+def generate_file_samples(file_path, configs, tokenizer=None, token_budget=None):
+    """Process-pool entry point: the samples of one trajectory file for every configuration."""
+    trajectory = load_trajectory(file_path, columns=("behavior", "steps"), step_columns=("action_description",))
+    fragments = serialize_fragments(trajectory)
+    counter = None if tokenizer is None else get_token_counter(tokenizer)
+    return [
+        generate_dataset_json_format(trajectory, segment_length, step, fragments, counter, token_budget)
+        for segment_length, step in configs
+    ]
+
+
+def iter_file_samples(file_path_list, configs, workers=1, tokenizer=None, token_budget=None):
+    """Yields generate_file_samples of every trajectory file, in file_path_list order whatever the worker count."""
+    file_path_list = [file for file in file_path_list if file.endswith(".json")]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = bounded_map(
+                executor,
+                generate_file_samples,
+                file_path_list,
+                repeat(configs),
+                repeat(tokenizer),
+                repeat(token_budget),
+                window=workers * 2,
+            )
+            yield from tqdm(results, total=len(file_path_list))
+    else:
+        for file in tqdm(file_path_list):
+            yield generate_file_samples(file, configs, tokenizer, token_budget)
+
+
+def warn_empty_outputs(names, counts, tokenizer, token_budget):
+    """Reports the configurations whose every window was dropped by the token budget."""
+    if token_budget is None:
+        return
+    prompt_tokens = get_prompt_token_length(get_token_counter(tokenizer))
+    for name, count in zip(names, counts):
+        if count == 0:
+            print(
+                f"Warning: no window of {name} fits in token_budget {token_budget} "
+                f"(the prompt alone takes {prompt_tokens} tokens), its output is empty"
+            )
+
+
+def generate_stage_2_multi(
     file_path_list,
     save_dir,
     split="train",
-    segment_length=5,
+    configs=((5, None),),
+    output_format="json",
+    shard_size=100000,
+    shuffle_buffer=10000,
+    seed=None,
+    workers=1,
+    tokenizer=None,
+    token_budget=None,
+    length_buckets=None,
 ):
-    dataset_list = []
-    for trajectory in tqdm(get_trajectory(file_path_list)):
-        dataset_gen = generate_dataset_json_format(trajectory, segment_length)
-        dataset_list.extend(dataset_gen)
+    """
+    Description:
+        Generates the stage 2 datasets of one split for several sliding-window configurations in a single pass:
+        every trajectory file is read and parsed once, and its samples for all configurations are emitted together.
+    Args:
+        file_path_list (list): trajectory files
+        save_dir (str): output directory
+        split (str): "train" or "test"
+        configs (list): (segment_length, step) pairs; step None is half the window. Each configuration is saved
+            as {split}_len_{segment_length}[_step_{step}]
+        output_format (str): "json" writes one shuffled .json per configuration; "jsonl" streams samples through
+            a bounded shuffle buffer into JSONL shards, one directory per configuration
+        shard_size (int): samples per JSONL shard
+        shuffle_buffer (int): samples held by the JSONL shuffle buffer
+        seed (int): with a seed, files are processed in sorted order and every shuffle uses an RNG derived from
+            (seed, output name), so the output is reproducible and independent of workers and listing order.
+            None keeps the global `random` state
+        workers (int): number of processes generating per-file samples
+        tokenizer (str): Hugging Face tokenizer name or path; every sample is tagged with its "token_length"
+        token_budget (int): cuts every window to the behaviors that fit in this many tokens, see
+            generate_dataset_json_format; outputs get a _budget_{token_budget} suffix
+        length_buckets (list): strictly ascending token length bounds; the samples of every configuration are split
+            into one output per bucket, suffixed _tok_{lower}-{upper}, so training batches pack with little padding
+    """
+    check_token_options(tokenizer, token_budget, length_buckets)
+    configs = list(dict.fromkeys(configs))
+    names = [get_config_name(split, segment_length, step, token_budget) for segment_length, step in configs]
+
+    if seed is None and workers > 1:
+        seed = random.randrange(2**32)
+    if seed is not None:
+        file_path_list = sorted(file_path_list, key=os.path.basename)
+        shuffle_rngs = [random.Random(derive_seed(seed, name)) for name in names]
+    else:
+        shuffle_rngs = [random] * len(configs)
+
+    file_samples_iter = iter_file_samples(file_path_list, configs, workers, tokenizer, token_budget)
+
+    if output_format == "jsonl":
+        # one writer per configuration and length bucket, opened at the bucket's first sample
+        writers = [{} for _ in configs]
+
+        def get_writer(config_idx, bucket):
+            if bucket not in writers[config_idx]:
+                name = get_bucket_output_name(names[config_idx], bucket)
+                writer_seed = None if seed is None else derive_seed(seed, name)
+                writer = ShardedJSONLWriter(os.path.join(save_dir, name), shard_size, shuffle_buffer, writer_seed)
+                writers[config_idx][bucket] = writer
+            return writers[config_idx][bucket]
+
+        if not length_buckets:
+            for config_idx in range(len(configs)):
+                get_writer(config_idx, None)
+        counts = [0] * len(configs)
+        for file_samples in file_samples_iter:
+            for config_idx, samples in enumerate(file_samples):
+                counts[config_idx] += len(samples)
+                for bucket, bucket_samples in group_by_bucket(samples, length_buckets).items():
+                    get_writer(config_idx, bucket).write_all(bucket_samples)
+        for config_writers in writers:
+            for writer in config_writers.values():
+                writer.close()
+        warn_empty_outputs(names, counts, tokenizer, token_budget)
+        return
+
+    dataset_lists = [[] for _ in configs]
+    for file_samples in file_samples_iter:
+        for dataset_gen, dataset_list in zip(file_samples, dataset_lists):
+            dataset_list.extend(dataset_gen)
+    warn_empty_outputs(names, [len(dataset_list) for dataset_list in dataset_lists], tokenizer, token_budget)
 
     # save
     os.makedirs(save_dir, exist_ok=True)
-    savepath = os.path.join(save_dir, f"{split}_len_{segment_length}.json")
-    with open(savepath, "w", encoding="utf-8") as f:
-        random.shuffle(dataset_list)
-        json.dump(dataset_list, f, ensure_ascii=False, indent=4)
+    for name, dataset_list, shuffle_rng in zip(names, dataset_lists, shuffle_rngs):
+        for bucket, bucket_list in group_by_bucket(dataset_list, length_buckets).items():
+            savepath = os.path.join(save_dir, f"{get_bucket_output_name(name, bucket)}.json")
+            with open(savepath, "w", encoding="utf-8") as f:
+                shuffle_rng.shuffle(bucket_list)
+                json.dump(bucket_list, f, ensure_ascii=False, indent=4)
+
+
+def generate_stage_2(
+    file_path_list,
+    save_dir,
+    split="train",
+    segment_length=5,
+    output_format="json",
+    shard_size=100000,
+    shuffle_buffer=10000,
+    seed=None,
+    workers=1,
+    tokenizer=None,
+    token_budget=None,
+    length_buckets=None,
+):
+    """
+    Description:
+        Generates the stage 2 dataset of one split.
+    Args:
+        file_path_list (list): trajectory files
+        save_dir (str): output directory
+        split (str): "train" or "test"
+        segment_length (int): length of the sliding window
+        output_format (str): "json" writes one shuffled {split}_len_{segment_length}.json; "jsonl" streams
+            samples through a bounded shuffle buffer into JSONL shards under {split}_len_{segment_length}/
+        shard_size (int): samples per JSONL shard
+        shuffle_buffer (int): samples held by the JSONL shuffle buffer
+        seed (int): makes the output reproducible, see generate_stage_2_multi
+        workers (int): number of processes generating per-file samples
+        tokenizer, token_budget, length_buckets: token-budget windowing and length buckets, see generate_stage_2_multi
+    """
+    generate_stage_2_multi(
+        file_path_list,
+        save_dir,
+        split,
+        [(segment_length, None)],
+        output_format,
+        shard_size,
+        shuffle_buffer,
+        seed,
+        workers,
+        tokenizer,
+        token_budget,
+        length_buckets,
+    )
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the stage 2 (behavior segmentation) dataset.")
+    parser.add_argument("--output-format", choices=["json", "jsonl"], default="json")
+    parser.add_argument("--shard-size", type=int, default=100000, help="samples per JSONL shard")
+    parser.add_argument("--shuffle-buffer", type=int, default=10000, help="samples held by the JSONL shuffle buffer")
+    parser.add_argument(
+        "--configs",
+        nargs="+",
+        type=parse_config,
+        default=[(5, None)],
+        help='window configurations generated in one pass: "LEN", "LEN:STEP" or "LEN:RATIO", e.g. 3 5 8:4 12:0.25',
+    )
+    parser.add_argument("--seed", type=int, default=None, help="makes the output reproducible")
+    parser.add_argument("--workers", type=int, default=1, help="processes generating per-file samples")
+    parser.add_argument("--tokenizer", default=None, help="Hugging Face tokenizer tagging samples with token_length")
+    parser.add_argument("--token-budget", type=int, default=None, help="cut windows to fit this many tokens")
+    parser.add_argument(
+        "--length-buckets", type=int, nargs="+", default=None, help="token length bounds of the output buckets"
+    )
+    args = parser.parse_args()
+    configs = args.configs
+    try:
+        check_token_options(args.tokenizer, args.token_budget, args.length_buckets)
+    except ValueError as error:
+        parser.error(str(error))
 
     dir_test = "data/trajectory/test"
     dir_train = "data/trajectory/train"
@@ -132,5 +518,19 @@ if __name__ == "__main__":
     file_path_list_test = [os.path.join(dir_test, filename) for filename in file_list_test]
     file_path_list_train = [os.path.join(dir_train, filename) for filename in file_list_train]
 
-    generate_stage_2(file_path_list_test, save_dir="data/datasets/stage2/", split="test")
-    generate_stage_2(file_path_list_train, save_dir="data/datasets/stage2/", split="train")
+    output_options = {
+        "output_format": args.output_format,
+        "shard_size": args.shard_size,
+        "shuffle_buffer": args.shuffle_buffer,
+        "seed": args.seed,
+        "workers": args.workers,
+        "tokenizer": args.tokenizer,
+        "token_budget": args.token_budget,
+        "length_buckets": args.length_buckets,
+    }
+    generate_stage_2_multi(
+        file_path_list_test, save_dir="data/datasets/stage2/", split="test", configs=configs, **output_options
+    )
+    generate_stage_2_multi(
+        file_path_list_train, save_dir="data/datasets/stage2/", split="train", configs=configs, **output_options
+    )
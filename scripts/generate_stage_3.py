@@ -3,10 +3,20 @@ import sys
 import json
 import math
 import random
+import argparse
+import pyarrow as pa
 from enum import Enum
-from itertools import combinations
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, combinations
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
+from rng_utils import derive_seed
+from pool_utils import bounded_map
+from shard_writer import ShardedJSONLWriter
+from trajectory_cache import load_trajectory
+from token_windows import check_token_options, get_token_counter, group_by_bucket, get_bucket_output_name
+
 
 STAGE_3_SYSTEM_PROMPT = """<Role> You are a helpful assistant that provides proactive suggestions to the user. </Role>
 <Task> Understand what the user is doing and predict their next behavior based on historical behaviors.</Task>
@@ -22,8 +32,124 @@ STAGE_3_SYSTEM_PROMPT = """<Role> You are a helpful assistant that provides proa
 </Rules>"""
 
 
+STAGE_3_INSTRUCTIONS = "Now analyze the history behaviour and provide a task if you think the user needs your help."
+# json.dumps of the input dict up to the first observation
+STAGE_3_INPUT_PREFIX = f'{{"Instructions": {json.dumps(STAGE_3_INSTRUCTIONS, ensure_ascii=False)}, "Observations": ['
+
+
+def build_conversation(segment: list, system_prompt: str) -> dict:
+    """Stage 3 sample of one window: the behaviors before the last one are the observations, the last is the answer."""
+    input_dict = {
+        "Instructions": STAGE_3_INSTRUCTIONS,
+        "Observations": [
+            {
+                "Step_id": i + 1,
+                "Time": item["datetime"].split(".")[0],
+                "Event": item["event"],
+                "Behaviour": item["behavior"],
+            }
+            for i, item in enumerate(segment[:-1])
+        ],
+    }
+
+    output_dict = {"Event": segment[-1]["event"], "Behaviour": segment[-1]["behavior"]}
+
+    my_conversation = {
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": json.dumps(input_dict, ensure_ascii=False)},
+            {"role": "assistant", "content": json.dumps(output_dict, ensure_ascii=False)},
+        ]
+    }
+    return my_conversation
+
+
+def serialize_fragments(event_track_data: list) -> tuple:
+    """
+    Description:
+        Serializes every behavior of a trajectory once, both as an observation (without its Step_id, which depends
+        on the window) and as an answer, so that overlapping windows are assembled by joining strings
+    Returns:
+        observations (list), answers (list)
+    """
+    observations, answers = [], []
+    for item in event_track_data:
+        event = json.dumps(item["event"], ensure_ascii=False)
+        behavior = json.dumps(item["behavior"], ensure_ascii=False)
+        time = json.dumps(item["datetime"].split(".")[0], ensure_ascii=False)
+        observations.append(f'"Time": {time}, "Event": {event}, "Behaviour": {behavior}}}')
+        answers.append(f'{{"Event": {event}, "Behaviour": {behavior}}}')
+    return observations, answers
+
+
+def build_window_conversation(fragments: tuple, start: int, end: int, system_prompt: str) -> dict:
+    """Stage 3 sample of the window [start, end) joined from serialize_fragments, identical to build_conversation."""
+    observations, answers = fragments
+    observation_string = ", ".join(
+        [f'{{"Step_id": {i + 1}, {observation}' for i, observation in enumerate(observations[start : end - 1])]
+    )
+    return {
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"{STAGE_3_INPUT_PREFIX}{observation_string}]}}"},
+            {"role": "assistant", "content": answers[end - 1]},
+        ]
+    }
+
+
+def check_options(output_format, tokenizer, token_budget, length_buckets, sampling):
+    """Raises ValueError for GenStage3Dataset options that cannot be used together."""
+    check_token_options(tokenizer, token_budget, length_buckets)
+    if tokenizer is not None and output_format == "compact":
+        raise ValueError("Token lengths are not supported by the compact format")
+    # plan_sampling draws from the windows before fit_token_budget drops the ones that do not fit
+    if token_budget is not None and sampling:
+        raise ValueError("max_per_event, target_count and stratify cannot be combined with token_budget")
+
+
 class GenStage3Dataset:
-    def __init__(self, event_track_data_dir, save_basedir, split="train", window_size=51, repeat=7):
+    def __init__(
+        self,
+        event_track_data_dir,
+        save_basedir,
+        split="train",
+        window_size=51,
+        repeat=7,
+        output_format="json",
+        shard_size=100000,
+        shuffle_buffer=10000,
+        seed=None,
+        workers=1,
+        max_per_event=None,
+        target_count=None,
+        stratify=False,
+        tokenizer=None,
+        token_budget=None,
+        length_buckets=None,
+    ):
+        """
+        Args:
+            output_format (str): "json" writes one shuffled {split}_len_{window_size-1}.json; "jsonl" streams
+                samples through a bounded shuffle buffer into JSONL shards under {split}_len_{window_size-1}/;
+                "compact" writes trajectories and sample ranges as Arrow, see save_compact
+            shard_size (int): samples per JSONL shard
+            shuffle_buffer (int): samples held by the JSONL shuffle buffer
+            seed (int): with a seed, files are processed in sorted order, each file samples its windows with an RNG
+                derived from (seed, split, file name) and the shuffle uses one derived from (seed, split), so the
+                output is reproducible and independent of workers and listing order. None uses the global `random`
+            workers (int): number of processes generating per-file samples
+            max_per_event (int): at most this many samples per event class (of the last behavior) in the split
+            target_count (int): number of samples in the split, drawn uniformly from the eligible windows
+            stratify (bool): give every event class the same number of samples: target_count split evenly (classes
+                with fewer windows hand their share to the others), or without target_count, as many as the rarest
+                class. With any of the three options, only the selected windows are ever built, see plan_sampling
+            tokenizer (str): Hugging Face tokenizer name or path; every sample is tagged with its "token_length"
+            token_budget (int): cuts every window from the left to the observations that fit in this many tokens
+                (window_size becomes a maximum), see fit_token_budget; outputs get a _budget_{token_budget} suffix
+            length_buckets (list): strictly ascending token length bounds; samples are split into one output per
+                bucket, suffixed _tok_{lower}-{upper}, so training batches pack with little padding
+        Options that cannot be used together raise ValueError, see check_options.
+        """
 
         self.way_20 = [
             "E-commerce platform",
@@ -52,96 +178,427 @@ class GenStage3Dataset:
         self.window_size = window_size
         self.repeat = repeat
         self.split = split
+        self.output_format = output_format
+        self.shard_size = shard_size
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed if seed is not None or workers <= 1 else random.randrange(2**32)
+        self.workers = workers
+        self.max_per_event = max_per_event
+        self.target_count = target_count
+        self.stratify = stratify
+        self.sampling = max_per_event is not None or target_count is not None or stratify
+        self.tokenizer = tokenizer
+        self.token_budget = token_budget
+        self.length_buckets = length_buckets
 
         choices = '"' + '"\n"'.join(self.way_20) + '"'
         system_prompt_append = f"<choices> When proposing a predicted behavior, the EVENT can be only selected from the following options:\n{choices}\n</choices>"
         self.system_prompt = STAGE_3_SYSTEM_PROMPT + system_prompt_append
 
+        check_options(output_format, tokenizer, token_budget, length_buckets, self.sampling)
         self.run()
 
-    def split_array_into_segments(self, arr: list) -> list[list]:
-        repeat = self.repeat
-        window_size = self.window_size
-        step = window_size
-        assert repeat > 0
+    def draw_first_ends(self, rng=None) -> list:
+        """End of the first window of each of the `repeat` passes; every pass then slides by window_size."""
+        rng = rng or random
+        assert self.repeat > 0
+        end_init_offset_list = rng.choices(range(self.window_size, self.window_size * 2), k=self.repeat)
+        return [self.window_size + offset for offset in end_init_offset_list]
 
-        end_init_offset_list = random.choices(range(window_size, window_size * 2), k=repeat)
+    def split_array_into_ranges(self, length: int, rng=None) -> list[tuple]:
+        ranges = []
+        for end in self.draw_first_ends(rng):
+            while end < length:
+                ranges.append((end - self.window_size, end))
+                end += self.window_size
 
-        segments = []
-        for idx in range(repeat):
-            end = window_size + end_init_offset_list[idx]
-            while end < len(arr):
-                start = end - window_size
-                segment = arr[start:end]
-                segments.append(segment)
-                end += step
+        return ranges
 
-        return segments
+    def split_array_into_segments(self, arr: list, rng=None) -> list[list]:
+        return [arr[start:end] for start, end in self.split_array_into_ranges(len(arr), rng)]
 
-    def generate_dataset(self, event_track_data: list) -> list:
-        n_way = self.way_20
+    def build_event_index(self, events: list) -> dict:
+        """
+        Description:
+            Index of the positions where a sample window may end: the ends (position + 1) of the behaviors whose
+            event is one of the 20 events, grouped by event and by end % window_size, the residue shared by all the
+            windows of one pass
+        Returns:
+            index (dict): {event: {residue: [end, ...]}} with ascending ends; the None key holds all events together
+        """
+        eligible = set(self.way_20)
+        index = {None: {}}
+        for end, event in enumerate(events, 1):
+            if event in eligible:
+                residue = end % self.window_size
+                index.setdefault(event, {}).setdefault(residue, []).append(end)
+                index[None].setdefault(residue, []).append(end)
+        return index
+
+    def get_pass_bounds(self, residue_index: dict, first_ends: list, length: int) -> list[tuple]:
+        """Per pass, (ends, lo, hi) such that ends[lo:hi] are the indexed window ends the pass visits."""
+        bounds = []
+        for first_end in first_ends:
+            ends = residue_index.get(first_end % self.window_size, [])
+            bounds.append((ends, bisect_left(ends, first_end), bisect_left(ends, length)))
+        return bounds
+
+    def generate_ranges(self, event_track_data: list, rng=None) -> list[tuple]:
+        """
+        (start, end) of every sample window whose last behavior belongs to one of the 20 events, in pass order.
+        Only the eligible ends are enumerated, through build_event_index.
+        """
         if len(event_track_data) == 0:
             return []
-        result_list = []
-
-        # split json_data
-        segments = self.split_array_into_segments(event_track_data)
-
-        for segment in segments:
-            if segment[-1]["event"] not in n_way:
-                continue
-
-            input_dict = {
-                "Instructions": "Now analyze the history behaviour and provide a task if you think the user needs your help.",
-                "Observations": [
-                    {
-                        "Step_id": i + 1,
-                        "Time": item["datetime"].split(".")[0],
-                        "Event": item["event"],
-                        "Behaviour": item["behavior"],
-                    }
-                    for i, item in enumerate(segment[:-1])
-                ],
-            }
 
-            output_dict = {"Event": segment[-1]["event"], "Behaviour": segment[-1]["behavior"]}
+        first_ends = self.draw_first_ends(rng)
+        index = self.build_event_index([item["event"] for item in event_track_data])
+        return [
+            (end - self.window_size, end)
+            for ends, lo, hi in self.get_pass_bounds(index[None], first_ends, len(event_track_data))
+            for end in ends[lo:hi]
+        ]
 
-            my_conversation = {
-                "messages": [
-                    {"role": "system", "content": self.system_prompt},
-                    {"role": "user", "content": json.dumps(input_dict, ensure_ascii=False)},
-                    {"role": "assistant", "content": json.dumps(output_dict, ensure_ascii=False)},
-                ]
-            }
-            result_list.append(my_conversation)
-        return result_list
+    def count_file_windows(self, filepath: str) -> tuple:
+        """
+        Process-pool entry point of the first sampling pass: draws the passes of one trajectory file and counts
+        its eligible windows per event class, without building any of them.
+        Returns:
+            first_ends (list), counts (dict): {event: number of windows}
+        """
+        events = [item["event"] for item in load_trajectory(filepath, columns=("event",))]
+        if len(events) == 0:
+            return [], {}
+        first_ends = self.draw_first_ends(self.get_file_rng(filepath))
+        index = self.build_event_index(events)
+        counts = {}
+        for event, residue_index in index.items():
+            if event is not None:
+                bounds = self.get_pass_bounds(residue_index, first_ends, len(events))
+                counts[event] = sum(hi - lo for _, lo, hi in bounds)
+        return first_ends, counts
+
+    def allocate_quotas(self, available: dict, rng) -> dict:
+        """Number of samples to draw from every event class, given its number of windows after max_per_event."""
+        if not available:
+            return {}
+        if self.stratify:
+            if self.target_count is None:
+                level = min(available.values())
+                return {event: level for event in available}
+            # rarest classes first, so that their unused share goes to the larger ones
+            quotas, remaining = {}, self.target_count
+            ordered = sorted(available, key=lambda event: (available[event], event))
+            for i, event in enumerate(ordered):
+                quotas[event] = min(available[event], remaining // (len(ordered) - i))
+                remaining -= quotas[event]
+            return quotas
+
+        total = sum(available.values())
+        if self.target_count is None or self.target_count >= total:
+            return dict(available)
+        events = sorted(available)
+        starts = list(accumulate([available[event] for event in events], initial=0))
+        quotas = dict.fromkeys(events, 0)
+        for pick in rng.sample(range(total), self.target_count):
+            quotas[events[bisect_right(starts, pick) - 1]] += 1
+        return quotas
+
+    def plan_sampling(self, file_counts: list) -> list:
+        """
+        Description:
+            Chooses the windows of the split from the per-file counts of count_file_windows: per event class, a
+            uniform subset of its windows of the size given by allocate_quotas. Windows are addressed by their rank
+            within the class, so this costs time in the number of selected samples, not of candidate windows.
+        Args:
+            file_counts (list): (first_ends, counts) of every trajectory file
+        Returns:
+            plans (list): (first_ends, {event: ascending ranks within the file}) of every trajectory file
+        """
+        rng = random if self.seed is None else random.Random(derive_seed(self.seed, self.split, "sampling"))
+        totals = {}
+        for _, counts in file_counts:
+            for event, count in counts.items():
+                totals[event] = totals.get(event, 0) + count
+        available = {
+            event: count if self.max_per_event is None else min(count, self.max_per_event)
+            for event, count in totals.items()
+            if count
+        }
+        quotas = self.allocate_quotas(available, rng)
+
+        selected = [{} for _ in file_counts]
+        for event in sorted(quotas):
+            starts = list(accumulate([counts.get(event, 0) for _, counts in file_counts], initial=0))
+            for pick in sorted(rng.sample(range(totals[event]), quotas[event])):
+                file_idx = bisect_right(starts, pick) - 1
+                selected[file_idx].setdefault(event, []).append(pick - starts[file_idx])
+        return [(first_ends, file_selected) for (first_ends, _), file_selected in zip(file_counts, selected)]
+
+    def select_ranges(self, event_track_data: list, first_ends: list, selected: dict) -> list[tuple]:
+        """(start, end) of the windows chosen by plan_sampling in one trajectory file, in pass order."""
+        index = self.build_event_index([item["event"] for item in event_track_data])
+        keyed = []
+        for event, ranks in selected.items():
+            bounds = self.get_pass_bounds(index[event], first_ends, len(event_track_data))
+            pass_idx, skipped = 0, 0
+            for rank in ranks:
+                while rank >= skipped + bounds[pass_idx][2] - bounds[pass_idx][1]:
+                    skipped += bounds[pass_idx][2] - bounds[pass_idx][1]
+                    pass_idx += 1
+                ends, lo, _ = bounds[pass_idx]
+                keyed.append((pass_idx, ends[lo + rank - skipped]))
+        keyed.sort()
+        return [(end - self.window_size, end) for _, end in keyed]
+
+    def generate_dataset(self, event_track_data: list, rng=None) -> list:
+        return self.build_samples(event_track_data, self.generate_ranges(event_track_data, rng))
+
+    def build_samples(self, event_track_data: list, ranges: list, fragments=None, token_lengths=None) -> list:
+        if not ranges:
+            return []
+        fragments = fragments or serialize_fragments(event_track_data)
+        samples = [build_window_conversation(fragments, start, end, self.system_prompt) for start, end in ranges]
+        if token_lengths is not None:
+            for sample, token_length in zip(samples, token_lengths):
+                sample["token_length"] = token_length
+        return samples
+
+    def get_prompt_token_length(self, counter) -> int:
+        """Tokens of a sample before any observation or answer: the system prompt and the input framing."""
+        return counter.count(self.system_prompt) + counter.count(STAGE_3_INPUT_PREFIX) + counter.count("]}")
+
+    def warn_if_empty(self, name: str, count: int):
+        """Reports an output whose every window was dropped by the token budget."""
+        if self.token_budget is not None and count == 0:
+            prompt_tokens = self.get_prompt_token_length(get_token_counter(self.tokenizer))
+            print(
+                f"Warning: no window of {name} fits in token_budget {self.token_budget} "
+                f"(the prompt alone takes {prompt_tokens} tokens), its output is empty"
+            )
+
+    def fit_token_budget(self, fragments: tuple, counter, ranges: list) -> tuple:
+        """
+        Description:
+            Measures the token length of every window from the cached counts of the fragments
+            build_window_conversation joins (see TokenCounter) and, with token_budget, moves its start right until
+            it fits. The answer is always kept; windows that do not fit with a single observation are dropped.
+        Returns:
+            ranges (list), token_lengths (list)
+        """
+        observations, answers = fragments
+        counter.count_all(observations + answers)
+        base = self.get_prompt_token_length(counter)
+        # tokens of observations[:i], and of the Step_id prefixes of the first i observations of a window
+        separator_tokens = counter.count(", ")
+        observation_tokens = [counter.count(item) + separator_tokens for item in observations]
+        observation_tokens = list(accumulate(observation_tokens, initial=0))
+        step_id_tokens = [0]
+
+        fitted_ranges, token_lengths = [], []
+        for start, end in ranges:
+            while len(step_id_tokens) < end - start:
+                step_id_tokens.append(step_id_tokens[-1] + counter.count(f'{{"Step_id": {len(step_id_tokens)}, '))
+            answer_tokens = base + counter.count(answers[end - 1])
+
+            def window_tokens(window_start):
+                # every observation is counted with a separator, one more than the window has
+                observation_sum = observation_tokens[end - 1] - observation_tokens[window_start] - separator_tokens
+                return answer_tokens + observation_sum + step_id_tokens[end - 1 - window_start]
+
+            if self.token_budget is not None:
+                while start < end - 1 and window_tokens(start) > self.token_budget:
+                    start += 1
+                if start == end - 1:
+                    continue
+            fitted_ranges.append((start, end))
+            token_lengths.append(window_tokens(start))
+        return fitted_ranges, token_lengths
+
+    def get_file_rng(self, filepath: str):
+        if self.seed is None:
+            return None
+        return random.Random(derive_seed(self.seed, self.split, os.path.basename(filepath)))
+
+    def generate_file_dataset(self, filepath: str, plan=None) -> list:
+        """Process-pool entry point: the samples of one trajectory file, or those chosen by its plan_sampling plan."""
+        event_track_data = load_trajectory(filepath, columns=("datetime", "event", "behavior"))
+
+        if plan is None:
+            ranges = self.generate_ranges(event_track_data, self.get_file_rng(filepath))
+        else:
+            ranges = self.select_ranges(event_track_data, *plan)
+        if self.output_format == "compact":
+            columns = {key: [item[key] for item in event_track_data] for key in ("datetime", "event", "behavior")}
+            return os.path.basename(filepath), columns, ranges
+        if self.tokenizer is None or not ranges:
+            return self.build_samples(event_track_data, ranges)
+        fragments = serialize_fragments(event_track_data)
+        ranges, token_lengths = self.fit_token_budget(fragments, get_token_counter(self.tokenizer), ranges)
+        return self.build_samples(event_track_data, ranges, fragments, token_lengths)
+
+    def map_files(self, fn, *iterables):
+        """fn over the trajectory files, on a process pool when workers > 1, results in input order."""
+        if self.workers > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                results = bounded_map(executor, fn, *iterables, window=self.workers * 2)
+                yield from tqdm(results, total=len(iterables[0]))
+        else:
+            for args in tqdm(zip(*iterables), total=len(iterables[0])):
+                yield fn(*args)
+
+    def iter_file_datasets(self):
+        """Yields the samples of every trajectory file, in the same file order whatever the worker count."""
+        file_list = [filename for filename in os.listdir(self.event_track_data_dir) if filename.endswith(".json")]
+        if self.seed is not None:
+            file_list.sort()
+        file_path_list = [os.path.join(self.event_track_data_dir, filename) for filename in file_list]
+
+        plans = [None] * len(file_path_list)
+        if self.sampling:
+            plans = self.plan_sampling(list(self.map_files(self.count_file_windows, file_path_list)))
+        yield from self.map_files(self.generate_file_dataset, file_path_list, plans)
 
     def run(self):
-        file_list = os.listdir(self.event_track_data_dir)
+        shuffle_seed = None if self.seed is None else derive_seed(self.seed, self.split)
+        name = f"{self.split}_len_{self.window_size-1}"
+        if self.token_budget is not None:
+            name += f"_budget_{self.token_budget}"
+        if self.output_format == "jsonl":
+            # one writer per length bucket, opened at the bucket's first sample
+            writers = {}
+            if not self.length_buckets:
+                writers[None] = ShardedJSONLWriter(
+                    os.path.join(self.save_basedir, name), self.shard_size, self.shuffle_buffer, shuffle_seed
+                )
+            count = 0
+            for file_dataset in self.iter_file_datasets():
+                count += len(file_dataset)
+                for bucket, samples in group_by_bucket(file_dataset, self.length_buckets).items():
+                    if bucket not in writers:
+                        save_dir = os.path.join(self.save_basedir, get_bucket_output_name(name, bucket))
+                        writer_seed = None if shuffle_seed is None else derive_seed(self.seed, self.split, bucket)
+                        writer = ShardedJSONLWriter(save_dir, self.shard_size, self.shuffle_buffer, writer_seed)
+                        writers[bucket] = writer
+                    writers[bucket].write_all(samples)
+            for writer in writers.values():
+                writer.close()
+            self.warn_if_empty(name, count)
+            return
+
+        if self.output_format == "compact":
+            self.save_compact(list(self.iter_file_datasets()), shuffle_seed)
+            return
 
         datasets = []
 
-        for filename in tqdm(file_list):
-            if not filename.endswith(".json"):
-                continue
+        for file_dataset in self.iter_file_datasets():
+            datasets.extend(file_dataset)
+        self.warn_if_empty(name, len(datasets))
 
-            # read json file
-            filepath = os.path.join(self.event_track_data_dir, filename)
-            with open(filepath, "r", encoding="utf-8") as f:
-                event_track_data = json.load(f)
+        shuffle_rng = random if shuffle_seed is None else random.Random(shuffle_seed)
+        os.makedirs(self.save_basedir, exist_ok=True)
+        for bucket, bucket_datasets in group_by_bucket(datasets, self.length_buckets).items():
+            shuffle_rng.shuffle(bucket_datasets)
 
-            datasets.extend(self.generate_dataset(event_track_data))
+            # save
+            save_path = os.path.join(self.save_basedir, f"{get_bucket_output_name(name, bucket)}.json")
+            with open(save_path, "w", encoding="utf-8") as f:
+                json.dump(bucket_datasets, f, ensure_ascii=False, indent=4)
 
-        random.shuffle(datasets)
 
-        # save
-        os.makedirs(self.save_basedir, exist_ok=True)
-        save_path = os.path.join(self.save_basedir, f"{self.split}_len_{self.window_size-1}.json")
-        with open(save_path, "w", encoding="utf-8") as f:
-            json.dump(datasets, f, ensure_ascii=False, indent=4)
+    def save_compact(self, file_results: list, shuffle_seed=None):
+        """
+        Description:
+            Writes the compact format under {split}_len_{window_size-1}_compact/: every trajectory is stored once in
+            trajectories.arrow (datetime, dictionary-encoded event / behavior), and every sample is a
+            (trajectory_id, start, end, prompt_id) row of samples.arrow, shuffled like the json output.
+            Both are uncompressed Arrow IPC files, so readers can memory-map them; see stage3_compact.py.
+        Args:
+            file_results (list): (file name, columns, ranges) of every trajectory file
+            shuffle_seed (int): seed of the sample shuffle, None uses the global `random`
+        """
+        files, offsets = [], []
+        columns = {"datetime": [], "event": [], "behavior": []}
+        samples = []
+        for trajectory_id, (filename, file_columns, ranges) in enumerate(file_results):
+            files.append(filename)
+            offsets.append(len(columns["datetime"]))
+            for key in columns:
+                columns[key].extend(file_columns[key])
+            samples.extend((trajectory_id, start, end) for start, end in ranges)
+
+        if shuffle_seed is None:
+            random.shuffle(samples)
+        else:
+            random.Random(shuffle_seed).shuffle(samples)
+
+        trajectories = pa.table(
+            {
+                "datetime": pa.array(columns["datetime"], pa.string()),
+                "event": pa.array(columns["event"], pa.string()).dictionary_encode(),
+                "behavior": pa.array(columns["behavior"], pa.string()).dictionary_encode(),
+            }
+        ).replace_schema_metadata({"files": json.dumps(files, ensure_ascii=False), "offsets": json.dumps(offsets)})
+        sample_table = pa.table(
+            {
+                "trajectory_id": pa.array([sample[0] for sample in samples], pa.int32()),
+                "start": pa.array([sample[1] for sample in samples], pa.int32()),
+                "end": pa.array([sample[2] for sample in samples], pa.int32()),
+                "prompt_id": pa.array([0] * len(samples), pa.int16()),
+            }
+        ).replace_schema_metadata({"prompts": json.dumps([self.system_prompt], ensure_ascii=False)})
+
+        save_dir = os.path.join(self.save_basedir, f"{self.split}_len_{self.window_size-1}_compact")
+        os.makedirs(save_dir, exist_ok=True)
+        for name, table in (("trajectories.arrow", trajectories), ("samples.arrow", sample_table)):
+            with pa.OSFile(os.path.join(save_dir, name), "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the stage 3 (behavior prediction) dataset.")
+    parser.add_argument(
+        "--output-format",
+        choices=["json", "jsonl", "compact"],
+        default="json",
+        help="compact stores each trajectory once plus (trajectory, start, end) samples, see stage3_compact.py",
+    )
+    parser.add_argument("--shard-size", type=int, default=100000, help="samples per JSONL shard")
+    parser.add_argument("--shuffle-buffer", type=int, default=10000, help="samples held by the JSONL shuffle buffer")
+    parser.add_argument("--seed", type=int, default=None, help="makes the output reproducible")
+    parser.add_argument("--workers", type=int, default=1, help="processes generating per-file samples")
+    parser.add_argument("--max-per-event", type=int, default=None, help="cap on the samples of each event class")
+    parser.add_argument("--target-count", type=int, default=None, help="number of samples per split")
+    parser.add_argument("--stratify", action="store_true", help="same number of samples for every event class")
+    parser.add_argument("--window-size", type=int, default=51, help="behaviors per window, a maximum with a budget")
+    parser.add_argument("--tokenizer", default=None, help="Hugging Face tokenizer tagging samples with token_length")
+    parser.add_argument("--token-budget", type=int, default=None, help="cut windows to fit this many tokens")
+    parser.add_argument(
+        "--length-buckets", type=int, nargs="+", default=None, help="token length bounds of the output buckets"
+    )
+    args = parser.parse_args()
+    sampling = args.max_per_event is not None or args.target_count is not None or args.stratify
+    try:
+        check_options(args.output_format, args.tokenizer, args.token_budget, args.length_buckets, sampling)
+    except ValueError as error:
+        parser.error(str(error))
+
+    output_options = {
+        "output_format": args.output_format,
+        "shard_size": args.shard_size,
+        "shuffle_buffer": args.shuffle_buffer,
+        "seed": args.seed,
+        "workers": args.workers,
+        "max_per_event": args.max_per_event,
+        "target_count": args.target_count,
+        "stratify": args.stratify,
+        "window_size": args.window_size,
+        "tokenizer": args.tokenizer,
+        "token_budget": args.token_budget,
+        "length_buckets": args.length_buckets,
+    }
     save_basedir = "data/datasets/stage3/"
-    gen_stage_3 = GenStage3Dataset("data/trajectory/test", save_basedir, split="test")
-    gen_stage_3 = GenStage3Dataset("data/trajectory/train", save_basedir, split="train")
+    gen_stage_3 = GenStage3Dataset("data/trajectory/test", save_basedir, split="test", **output_options)
+    gen_stage_3 = GenStage3Dataset("data/trajectory/train", save_basedir, split="train", **output_options)
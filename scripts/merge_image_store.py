@@ -0,0 +1,108 @@
+import os
+import json
+import hashlib
+
+from file_utils import write_json_atomic
+
+
+class MergeImageStore:
+    """
+    Content-addressed store of merged stage-1 images.
+
+    An image lives at `{root}/{key[:2]}/{key[2:4]}/{key}.{ext}`, where the key hashes both source screenshots,
+    the action and the render parameters, so identical step pairs share one file and changed sources get new keys.
+    `manifest.json` under the root records every stored image and a (size, mtime) -> sha256 memo of the sources:
+    rebuilds skip by manifest lookup instead of stat-ing outputs, and only re-hash sources that changed.
+    """
+
+    def __init__(self, root, image_base_dir):
+        self.root = root
+        self.image_base_dir = image_base_dir
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self.sources = {}
+        self.images = {}
+        self.checked = {}  # sources already stat-ed in this run
+        self.dirty = False
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                manifest = json.load(f)
+            self.sources = manifest.get("sources", {})
+            self.images = manifest.get("images", {})
+
+    def hash_source(self, rel_path):
+        """sha256 of a source screenshot, re-hashed only when its size or mtime changed."""
+        if rel_path in self.checked:
+            return self.checked[rel_path]
+
+        path = os.path.join(self.image_base_dir, rel_path)
+        if not os.path.exists(path):
+            self.checked[rel_path] = None
+            return None
+        stat = os.stat(path)
+        memo = self.sources.get(rel_path)
+        if memo is not None and memo["size"] == stat.st_size and memo["mtime_ns"] == stat.st_mtime_ns:
+            digest = memo["sha256"]
+        else:
+            with open(path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            self.sources[rel_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}
+            self.dirty = True
+        self.checked[rel_path] = digest
+        return digest
+
+    def make_key(self, before, after, action, render_params):
+        sources = [self.hash_source(before), self.hash_source(after)]
+        # a missing screenshot has no content to address; the legacy path fails on it when rendering as well
+        for rel_path, digest in zip((before, after), sources):
+            if digest is None:
+                raise FileNotFoundError(f"Screenshot not found: {os.path.join(self.image_base_dir, rel_path)}")
+        payload = json.dumps([*sources, action, render_params], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_path(self, before, after, action, render_params, extension):
+        key = self.make_key(before, after, action, render_params)
+        return os.path.join(self.root, key[:2], key[2:4], f"{key}.{extension}")
+
+    def lookup(self, path):
+        """Manifest entry of a stored image, or None if it has not been rendered."""
+        return self.images.get(os.path.relpath(path, self.root))
+
+    def add(self, path, before, after, action, width, height, size):
+        self.images[os.path.relpath(path, self.root)] = {
+            "before": before,
+            "after": after,
+            "action": action,
+            "sources": [self.hash_source(before), self.hash_source(after)],
+            "width": width,
+            "height": height,
+            "bytes": size,
+        }
+        self.dirty = True
+
+    def find_stale(self, verify_files=False):
+        """
+        Description:
+            Entries whose source screenshots changed or disappeared since they were rendered
+            (and, with verify_files, entries whose image file is missing).
+        Returns:
+            stale (list): image paths
+        """
+        stale = []
+        for rel_path, entry in self.images.items():
+            current = [self.hash_source(entry["before"]), self.hash_source(entry["after"])]
+            if current != entry["sources"] or (verify_files and not os.path.exists(os.path.join(self.root, rel_path))):
+                stale.append(os.path.join(self.root, rel_path))
+        return stale
+
+    def remove(self, paths):
+        for path in paths:
+            self.images.pop(os.path.relpath(path, self.root), None)
+            if os.path.exists(path):
+                os.remove(path)
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        write_json_atomic(self.manifest_path, {"sources": self.sources, "images": self.images}, indent=None)
+        self.dirty = False
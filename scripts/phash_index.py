@@ -0,0 +1,248 @@
+import os
+import re
+import json
+import argparse
+import numpy as np
+from tqdm import tqdm
+from collections import defaultdict
+from PIL import Image
+
+from file_utils import write_json_atomic
+from generate_stage_1 import image_base_dir
+
+CLICK_PATTERN = re.compile(r"CLICK\[(-?\d+),\s*(-?\d+)\]")
+
+
+def dhash(image_path, hash_size=8):
+    """Difference hash: hash_size * hash_size bits, one per horizontal brightness gradient of a downscaled image."""
+    with Image.open(image_path) as img:
+        img = img.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = np.asarray(img, dtype=np.int16)
+    value = 0
+    for bit in (pixels[:, 1:] > pixels[:, :-1]).flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class PHashIndex:
+    """
+    Near-duplicate index of (before screenshot, after screenshot, action) step pairs and their action descriptions.
+
+    A pair's signature is dhash(before) followed by dhash(after). Signatures are split into `bands` bands and
+    bucketed per band together with the action type (LSH banding), so any two pairs within `bands - 1` bits of
+    each other share a bucket. Candidates then need a total Hamming distance <= max_distance and the same action:
+    equal strings, or CLICKs within click_radius pixels.
+    Entries without a description are pending: novel pairs waiting for the describer, shared by their near duplicates.
+    """
+
+    def __init__(self, path=None, hash_size=8, bands=16, max_distance=10, click_radius=30):
+        self.path = path
+        self.hash_size = hash_size
+        self.bands = bands
+        self.max_distance = max_distance
+        self.click_radius = click_radius
+        self.entries = []
+        self.buckets = defaultdict(list)
+        self.hashes = {}  # image path -> dhash, memoized for this run
+
+        if path and os.path.exists(path):
+            with open(path, "r") as f:
+                index = json.load(f)
+            self.hash_size = index["hash_size"]
+            self.bands = index["bands"]
+            for entry in index["entries"]:
+                self.insert(entry)
+
+    @property
+    def bits(self):
+        return 2 * self.hash_size * self.hash_size
+
+    def hash_image(self, image_path):
+        if image_path not in self.hashes:
+            self.hashes[image_path] = dhash(os.path.join(image_base_dir, image_path), self.hash_size)
+        return self.hashes[image_path]
+
+    def signature(self, before, after):
+        return (self.hash_image(before) << (self.hash_size * self.hash_size)) | self.hash_image(after)
+
+    def band_keys(self, signature, action):
+        action_type = action.split("[")[0]
+        band_bits = self.bits // self.bands
+        mask = (1 << band_bits) - 1
+        return [(band, (signature >> (band * band_bits)) & mask, action_type) for band in range(self.bands)]
+
+    def actions_match(self, a, b):
+        if a == b:
+            return True
+        click_a, click_b = CLICK_PATTERN.fullmatch(a), CLICK_PATTERN.fullmatch(b)
+        if click_a is None or click_b is None:
+            return False
+        dx = int(click_a.group(1)) - int(click_b.group(1))
+        dy = int(click_a.group(2)) - int(click_b.group(2))
+        return dx * dx + dy * dy <= self.click_radius * self.click_radius
+
+    def insert(self, entry):
+        idx = len(self.entries)
+        self.entries.append(entry)
+        for key in self.band_keys(int(entry["signature"], 16), entry["action"]):
+            self.buckets[key].append(idx)
+        return idx
+
+    def add(self, before, after, action, action_description=None):
+        """Indexes a step pair; a None description marks it pending. Returns the entry id."""
+        entry = {
+            "signature": format(self.signature(before, after), "x"),
+            "action": action,
+            "action_description": action_description,
+            "before": before,
+            "after": after,
+        }
+        return self.insert(entry)
+
+    def query(self, before, after, action):
+        """
+        Description:
+            Finds the closest indexed pair within max_distance.
+        Returns:
+            (entry_id, distance), or None when the pair is novel
+        """
+        signature = self.signature(before, after)
+        best = None
+        seen = set()
+        for key in self.band_keys(signature, action):
+            for idx in self.buckets.get(key, []):
+                if idx in seen:
+                    continue
+                seen.add(idx)
+                entry = self.entries[idx]
+                distance = hamming(signature, int(entry["signature"], 16))
+                if distance > self.max_distance or not self.actions_match(action, entry["action"]):
+                    continue
+                # prefer described entries, then the closest
+                rank = (entry["action_description"] is None, distance)
+                if best is None or rank < best[0]:
+                    best = (rank, idx, distance)
+        return None if best is None else (best[1], best[2])
+
+    def save(self, path=None):
+        described = [entry for entry in self.entries if entry["action_description"] is not None]
+        index = {"hash_size": self.hash_size, "bands": self.bands, "entries": described}
+        write_json_atomic(path or self.path, index, indent=None)
+
+
+def iter_step_pairs(event_track_data):
+    """Yields (behavior_idx, step_idx, before, after, action) for every step that has an after screenshot."""
+    for behavior_idx, item in enumerate(event_track_data):
+        steps = item["steps"]
+        for step_idx in range(len(steps) - 1):
+            step = steps[step_idx]
+            yield behavior_idx, step_idx, step["image_path"], steps[step_idx + 1]["image_path"], step["action"]
+
+
+def index_trajectories(index, file_paths):
+    """Adds every described step pair of the trajectory files, skipping near duplicates of indexed pairs."""
+    n_added = 0
+    for file in file_paths:
+        with open(file, "r") as f:
+            event_track_data = json.load(f)
+        for behavior_idx, step_idx, before, after, action in tqdm(list(iter_step_pairs(event_track_data)), desc=file):
+            description = event_track_data[behavior_idx]["steps"][step_idx].get("action_description")
+            if not description:
+                continue
+            match = index.query(before, after, action)
+            if match is not None and index.entries[match[0]]["action_description"] is not None:
+                continue
+            index.add(before, after, action, description)
+            n_added += 1
+    print(f"Indexed {n_added} step pairs ({len(index.entries)} total)")
+
+
+def describe_trajectories(index, file_paths, save_dir, pending_path, describe_all=False):
+    """
+    Description:
+        Fills missing action descriptions of new trajectories from near-duplicate indexed pairs.
+        Novel pairs are written to `pending_path` (one JSON line per pair, near duplicates within the batch grouped
+        under one pending pair) for the action describer; their steps keep an empty description.
+    Args:
+        index (PHashIndex): index of described pairs
+        file_paths (list): trajectory files
+        save_dir (str): where the filled trajectory files are written
+        pending_path (str): JSONL of novel pairs with the steps that share them
+        describe_all (bool): look up every step, not only those without a description
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    pending = {}
+    n_reused, n_steps = 0, 0
+    for file in file_paths:
+        with open(file, "r") as f:
+            event_track_data = json.load(f)
+        for behavior_idx, step_idx, before, after, action in tqdm(list(iter_step_pairs(event_track_data)), desc=file):
+            step = event_track_data[behavior_idx]["steps"][step_idx]
+            if step.get("action_description") and not describe_all:
+                continue
+            n_steps += 1
+            match = index.query(before, after, action)
+            if match is not None and index.entries[match[0]]["action_description"] is not None:
+                step["action_description"] = index.entries[match[0]]["action_description"]
+                n_reused += 1
+                continue
+
+            entry_id = match[0] if match is not None else index.add(before, after, action)
+            if entry_id not in pending:
+                pending[entry_id] = {
+                    "before": before,
+                    "after": after,
+                    "action": action,
+                    "app": event_track_data[behavior_idx]["app"],
+                    "steps": [],
+                }
+            pending[entry_id]["steps"].append([os.path.basename(file), behavior_idx, step_idx])
+
+        with open(os.path.join(save_dir, os.path.basename(file)), "w") as f:
+            json.dump(event_track_data, f, ensure_ascii=False)
+
+    os.makedirs(os.path.dirname(pending_path) or ".", exist_ok=True)
+    with open(pending_path, "w") as f:
+        for pair in pending.values():
+            f.write(json.dumps(pair, ensure_ascii=False) + "\n")
+    print(
+        f"Steps to describe: {n_steps}, reused: {n_reused}, "
+        f"novel pairs for the describer: {len(pending)} (covering {n_steps - n_reused} steps)"
+    )
+
+
+def list_trajectory_files(dirs):
+    return sorted(
+        os.path.join(trajectory_dir, filename)
+        for trajectory_dir in dirs
+        for filename in os.listdir(trajectory_dir)
+        if filename.endswith(".json")
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reuse action descriptions across near-duplicate step pairs.")
+    parser.add_argument("--index", default="data/datasets/stage1/phash_index.json")
+    parser.add_argument("--max-distance", type=int, default=10, help="max Hamming distance over both screenshots")
+    parser.add_argument("--click-radius", type=int, default=30, help="max pixel distance between matching clicks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="index described trajectories")
+    build_parser.add_argument("trajectory_dirs", nargs="+")
+    describe_parser = subparsers.add_parser("describe", help="fill descriptions of new trajectories from the index")
+    describe_parser.add_argument("trajectory_dirs", nargs="+")
+    describe_parser.add_argument("--save-dir", required=True)
+    describe_parser.add_argument("--pending", default="data/datasets/stage1/pending_pairs.jsonl")
+    describe_parser.add_argument("--all", action="store_true", help="also look up steps that have a description")
+    args = parser.parse_args()
+
+    index = PHashIndex(args.index, max_distance=args.max_distance, click_radius=args.click_radius)
+    file_paths = list_trajectory_files(args.trajectory_dirs)
+    if args.command == "build":
+        index_trajectories(index, file_paths)
+        index.save()
+    else:
+        describe_trajectories(index, file_paths, args.save_dir, args.pending, args.all)
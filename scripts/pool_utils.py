@@ -0,0 +1,26 @@
+from collections import deque
+
+
+def bounded_map(executor, fn, *iterables, window):
+    """
+    Description:
+        Like executor.map, but reads the inputs lazily and keeps at most `window` tasks in flight, so memory stays
+        flat however many inputs there are. Results are yielded in input order.
+    Args:
+        executor: a concurrent.futures executor.
+        fn: the function to call on each zipped tuple of iterables.
+        window: the maximum number of submitted but not yet yielded tasks.
+    Returns:
+        A generator of fn results.
+    """
+    pending = deque()
+    try:
+        for args in zip(*iterables):
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fn, *args))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
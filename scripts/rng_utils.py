@@ -0,0 +1,8 @@
+import json
+import hashlib
+
+
+def derive_seed(seed, *keys):
+    """64-bit seed derived from a global seed and keys (split, file name, ...), independent of processing order."""
+    payload = json.dumps([seed, *keys], ensure_ascii=False)
+    return int.from_bytes(hashlib.sha256(payload.encode("utf-8")).digest()[:8], "little")
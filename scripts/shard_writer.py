@@ -0,0 +1,127 @@
+import os
+import json
+import random
+import numpy as np
+
+
+class ShardedJSONLWriter:
+    """
+    Streams samples to JSONL shards `part-00000.jsonl, part-00001.jsonl, ...` of at most `shard_size` lines.
+
+    Samples pass through a bounded shuffle buffer: once `shuffle_buffer` samples are held, each new sample evicts a
+    uniformly chosen one to the current shard, so memory stays at buffer + one shard of offsets however large the
+    corpus is. Every shard gets a `.idx` file of little-endian uint64 line offsets, and `index.json` lists the shards
+    and their sample counts; ShardedJSONLReader uses both for random access. Existing shards in `save_dir` are removed
+    when the writer is created, and index.json is only written by a successful close().
+    """
+
+    def __init__(self, save_dir, shard_size=100000, shuffle_buffer=10000, seed=None):
+        self.save_dir = save_dir
+        self.shard_size = shard_size
+        self.shuffle_buffer = shuffle_buffer
+        self.rng = random.Random(seed)
+        self.buffer = []
+        self.shards = []
+        self.file = None
+        self.offsets = []
+        self.position = 0
+        os.makedirs(save_dir, exist_ok=True)
+        # shards of an earlier, larger run would otherwise be left next to the new ones
+        for filename in os.listdir(save_dir):
+            if filename == "index.json" or (filename.startswith("part-") and filename.endswith((".jsonl", ".idx"))):
+                os.remove(os.path.join(save_dir, filename))
+
+    def write(self, sample):
+        line = (json.dumps(sample, ensure_ascii=False) + "\n").encode("utf-8")
+        if self.shuffle_buffer <= 1:
+            self.emit(line)
+            return
+        if len(self.buffer) < self.shuffle_buffer:
+            self.buffer.append(line)
+            return
+        idx = self.rng.randrange(len(self.buffer))
+        self.buffer[idx], line = line, self.buffer[idx]
+        self.emit(line)
+
+    def write_all(self, samples):
+        for sample in samples:
+            self.write(sample)
+
+    def emit(self, line):
+        if self.file is None:
+            name = f"part-{len(self.shards):05d}"
+            self.file = open(os.path.join(self.save_dir, f"{name}.jsonl"), "wb")
+            self.shards.append({"path": f"{name}.jsonl", "index": f"{name}.idx", "count": 0})
+            self.offsets = []
+            self.position = 0
+        self.offsets.append(self.position)
+        self.file.write(line)
+        self.position += len(line)
+        if len(self.offsets) >= self.shard_size:
+            self.close_shard()
+
+    def close_shard(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        shard = self.shards[-1]
+        shard["count"] = len(self.offsets)
+        np.asarray(self.offsets, dtype="<u8").tofile(os.path.join(self.save_dir, shard["index"]))
+
+    def close(self):
+        """Drains the shuffle buffer, closes the last shard and writes index.json. Returns the number of samples."""
+        self.rng.shuffle(self.buffer)
+        for line in self.buffer:
+            self.emit(line)
+        self.buffer = []
+        self.close_shard()
+
+        total = sum(shard["count"] for shard in self.shards)
+        with open(os.path.join(self.save_dir, "index.json"), "w", encoding="utf-8") as f:
+            json.dump({"total": total, "shards": self.shards}, f, ensure_ascii=False, indent=4)
+        return total
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.file is not None:
+            # no index.json for a failed run, so readers never see a partial dataset as complete
+            self.file.close()
+            self.file = None
+
+
+class ShardedJSONLReader:
+    """Random access and iteration over the output of ShardedJSONLWriter; offsets are memory-mapped."""
+
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+        with open(os.path.join(save_dir, "index.json"), "r", encoding="utf-8") as f:
+            self.shards = json.load(f)["shards"]
+        self.starts = np.cumsum([0] + [shard["count"] for shard in self.shards])
+        self.offsets = [
+            np.memmap(os.path.join(save_dir, shard["index"]), dtype="<u8", mode="r") if shard["count"] else None
+            for shard in self.shards
+        ]
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        shard_idx = int(np.searchsorted(self.starts, idx, side="right")) - 1
+        with open(os.path.join(self.save_dir, self.shards[shard_idx]["path"]), "rb") as f:
+            f.seek(int(self.offsets[shard_idx][idx - self.starts[shard_idx]]))
+            return json.loads(f.readline())
+
+    def __iter__(self):
+        for shard in self.shards:
+            with open(os.path.join(self.save_dir, shard["path"]), "r", encoding="utf-8") as f:
+                for line in f:
+                    yield json.loads(line)
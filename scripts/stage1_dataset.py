@@ -0,0 +1,125 @@
+import io
+import os
+import copy
+import json
+import argparse
+from collections import OrderedDict
+from PIL import Image
+
+import generate_stage_1
+from generate_stage_1 import get_merge_job, render_merged_image, render_merge_images, save_merged_image
+from merge_image_store import MergeImageStore
+
+
+class Stage1Dataset:
+    """
+    Lazy view over a stage-1 dataset written with `--output-mode virtual`.
+    Merged images are composited from (before, after, action, render_params) on access and kept in a small LRU;
+    records that reference image files (materialized mode) are opened from disk.
+    """
+
+    def __init__(self, path, cache_size=64):
+        with open(path, "r") as f:
+            self.records = json.load(f)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, idx):
+        record = self.records[idx]
+        return {"messages": record["messages"], "image": self.get_image(idx), "image_tokens": record.get("image_tokens")}
+
+    @staticmethod
+    def get_image_item(record):
+        return record["messages"][1]["content"][1]
+
+    def get_image(self, idx):
+        item = self.get_image_item(self.records[idx])
+        if item["type"] == "image_url":
+            key = item["image_url"]["url"]
+        else:
+            key = json.dumps(item["merged_image"], sort_keys=True)
+
+        img = self.cache.get(key)
+        if img is not None:
+            self.cache.move_to_end(key)
+            return img
+
+        if item["type"] == "image_url":
+            img = Image.open(key)
+            img.load()
+        else:
+            img = self.render(item["merged_image"])
+        self.cache[key] = img
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return img
+
+    @staticmethod
+    def render(ref):
+        render_params = ref["render_params"]
+        merged = render_merged_image(ref["before"], ref["after"], ref["action"], render_params)
+        if render_params["image_format"] != "png":
+            # round-trip through the encoder, so lazy images match the exported files pixel for pixel
+            buffer = io.BytesIO()
+            save_merged_image(merged, buffer, render_params)
+            buffer.seek(0)
+            merged = Image.open(buffer)
+            merged.load()
+        return merged
+
+    def export(self, save_path, workers=1, store=None):
+        """
+        Description:
+            Materializes the dataset for trainers that need image files: renders every referenced image under
+            merge_image_base_dir (same layout as the materialized mode) and writes a copy of the dataset
+            with image_url entries.
+        Args:
+            save_path (str): output json
+            workers (int): number of worker processes used to render
+            store (MergeImageStore): content-addressed store, None for the legacy names
+        """
+        merge_jobs = []
+        records = []
+        for record in self.records:
+            item = self.get_image_item(record)
+            if item["type"] == "merged_image":
+                ref = item["merged_image"]
+                job = get_merge_job(
+                    ref["before"], ref["after"], ref["action"], ref["index"], ref["render_params"], store
+                )
+                merge_jobs.append(job)
+                record = copy.deepcopy(record)
+                record["messages"][1]["content"][1] = {"type": "image_url", "image_url": {"url": job[3]}}
+            records.append(record)
+
+        os.makedirs(os.path.join(generate_stage_1.base_dir, generate_stage_1.merge_image_base_dir), exist_ok=True)
+        render_merge_images(merge_jobs, workers, store)
+        if store is not None:
+            store.save()
+
+        os.makedirs(os.path.dirname(save_path) or ".", exist_ok=True)
+        with open(save_path, "w") as f:
+            json.dump(records, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Materialize a virtual stage 1 dataset.")
+    parser.add_argument("path", help="virtual dataset, e.g. data/datasets/stage1/test.json")
+    parser.add_argument("save_path", help="materialized dataset to write")
+    parser.add_argument("--workers", type=int, default=1, help="processes used to render merged images")
+    parser.add_argument("--image-store", choices=["content", "names"], default="content")
+    parser.add_argument("--base-dir", default=".", help="dataset root containing data/screenshots")
+    args = parser.parse_args()
+
+    base_dir = os.path.abspath(args.base_dir)
+    generate_stage_1.set_base_dir(base_dir)
+    store = None
+    if args.image_store == "content":
+        store = MergeImageStore(
+            os.path.join(base_dir, generate_stage_1.merge_image_base_dir),
+            os.path.join(base_dir, generate_stage_1.image_base_dir),
+        )
+    Stage1Dataset(args.path).export(args.save_path, args.workers, store)
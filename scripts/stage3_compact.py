@@ -0,0 +1,73 @@
+import os
+import json
+import argparse
+import pyarrow as pa
+from tqdm import tqdm
+
+from generate_stage_3 import build_conversation
+
+
+def read_arrow(path):
+    """Memory-maps an uncompressed Arrow IPC file; the returned table does not copy its buffers."""
+    return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+
+
+class Stage3CompactDataset:
+    """
+    Lazy reader of the compact stage-3 format written by GenStage3Dataset(output_format="compact").
+    Conversations are materialized on access and are identical to the json output, in the same order.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.trajectories = read_arrow(os.path.join(path, "trajectories.arrow"))
+        samples = read_arrow(os.path.join(path, "samples.arrow"))
+
+        self.files = json.loads(self.trajectories.schema.metadata[b"files"])
+        self.offsets = json.loads(self.trajectories.schema.metadata[b"offsets"])
+        self.prompts = json.loads(samples.schema.metadata[b"prompts"])
+        self.trajectory_ids = samples.column("trajectory_id").to_numpy()
+        self.starts = samples.column("start").to_numpy()
+        self.ends = samples.column("end").to_numpy()
+        self.prompt_ids = samples.column("prompt_id").to_numpy()
+
+    def __len__(self):
+        return len(self.trajectory_ids)
+
+    def get_segment(self, idx):
+        """Behaviors (datetime, event, behavior) of the sample window."""
+        offset = self.offsets[self.trajectory_ids[idx]]
+        start, end = int(self.starts[idx]), int(self.ends[idx])
+        return self.trajectories.slice(offset + start, end - start).to_pylist()
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return build_conversation(self.get_segment(idx), self.prompts[self.prompt_ids[idx]])
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def export(self, save_path):
+        """Writes the materialized conversations in the json format of GenStage3Dataset."""
+        os.makedirs(os.path.dirname(save_path) or ".", exist_ok=True)
+        with open(save_path, "w", encoding="utf-8") as f:
+            json.dump(list(tqdm(self, total=len(self))), f, ensure_ascii=False, indent=4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Materialize a compact stage 3 dataset as json.")
+    parser.add_argument("path", help="compact dataset, e.g. data/datasets/stage3/train_len_50_compact")
+    parser.add_argument("save_path", help="json file to write")
+    args = parser.parse_args()
+
+    dataset = Stage3CompactDataset(args.path)
+    dataset.export(args.save_path)
+    compact_size = sum(os.path.getsize(os.path.join(args.path, name)) for name in os.listdir(args.path))
+    print(
+        f"{len(dataset)} samples: compact {compact_size / 2**20:.1f} MiB, "
+        f"json {os.path.getsize(args.save_path) / 2**20:.1f} MiB"
+    )
@@ -0,0 +1,85 @@
+from bisect import bisect_left
+
+
+class TokenCounter:
+    """
+    Token counts of text fragments with a Hugging Face tokenizer.
+
+    Unseen fragments are tokenized in batches and every count is cached by text, so the behaviors, steps and
+    separators shared by overlapping windows are tokenized once. The token length of a sample is the sum of the counts
+    of the fragments it is joined from; it can differ from tokenizing the whole message by a few tokens where
+    fragments meet, and does not include chat template tokens.
+    """
+
+    def __init__(self, tokenizer_path, batch_size=1024):
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+        self.batch_size = batch_size
+        self.cache = {}
+
+    def count_all(self, texts):
+        missing = list(dict.fromkeys(text for text in texts if text not in self.cache))
+        for i in range(0, len(missing), self.batch_size):
+            batch = missing[i : i + self.batch_size]
+            input_ids = self.tokenizer(batch, add_special_tokens=False)["input_ids"]
+            for text, ids in zip(batch, input_ids):
+                self.cache[text] = len(ids)
+        return [self.cache[text] for text in texts]
+
+    def count(self, text):
+        if text not in self.cache:
+            self.count_all([text])
+        return self.cache[text]
+
+
+TOKEN_COUNTERS = {}
+
+
+def get_token_counter(tokenizer_path):
+    """One TokenCounter per tokenizer and process, so that pool workers keep their cache from file to file."""
+    if tokenizer_path not in TOKEN_COUNTERS:
+        TOKEN_COUNTERS[tokenizer_path] = TokenCounter(tokenizer_path)
+    return TOKEN_COUNTERS[tokenizer_path]
+
+
+def check_token_options(tokenizer, token_budget, length_buckets):
+    """Raises ValueError for token options that cannot be used together or have no valid meaning."""
+    if (token_budget is not None or length_buckets) and tokenizer is None:
+        raise ValueError("token_budget and length_buckets need a tokenizer")
+    if token_budget is not None and token_budget < 1:
+        raise ValueError(f"token_budget must be >= 1, got {token_budget}")
+    if length_buckets:
+        if length_buckets[0] < 1 or any(lower >= upper for lower, upper in zip(length_buckets, length_buckets[1:])):
+            raise ValueError(f"length_buckets must be positive and strictly ascending, got {list(length_buckets)}")
+
+
+def get_bucket_name(token_length, length_buckets):
+    """
+    Description:
+        Length bucket of a sample
+    Args:
+        token_length (int): token length of the sample
+        length_buckets (list): ascending upper bounds, e.g. [512, 1024, 2048]
+    Returns:
+        name (str): "tok_0-512", "tok_512-1024", ..., and "tok_2048+" past the last bound
+    """
+    idx = bisect_left(length_buckets, token_length)
+    if idx == len(length_buckets):
+        return f"tok_{length_buckets[-1]}+"
+    lower = 0 if idx == 0 else length_buckets[idx - 1]
+    return f"tok_{lower}-{length_buckets[idx]}"
+
+
+def group_by_bucket(samples, length_buckets):
+    """{bucket name: samples}, buckets in ascending order of length; no buckets keeps everything under None."""
+    if not length_buckets:
+        return {None: samples}
+    groups = {get_bucket_name(bound, length_buckets): [] for bound in list(length_buckets) + [float("inf")]}
+    for sample in samples:
+        groups[get_bucket_name(sample["token_length"], length_buckets)].append(sample)
+    return {name: group for name, group in groups.items() if group}
+
+
+def get_bucket_output_name(name, bucket):
+    return name if bucket is None else f"{name}_{bucket}"
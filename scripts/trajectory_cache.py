@@ -0,0 +1,217 @@
+import os
+import json
+import hashlib
+import argparse
+import tempfile
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from tqdm import tqdm
+
+TRAJECTORY_KEYS = ("behavior", "event", "datetime", "app", "steps")
+STEP_KEYS = ("action", "action_description", "image_path")
+CACHE_VERSION = "2"
+
+cache_dir = os.getenv("TRAJECTORY_CACHE_DIR") or "data/cache/trajectory"
+cache_enabled = os.getenv("TRAJECTORY_CACHE", "1") != "0"
+
+
+def get_cache_path(source_path):
+    source_path = os.path.abspath(source_path)
+    digest = hashlib.sha1(source_path.encode("utf-8")).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(source_path))[0]
+    return os.path.join(cache_dir, f"{name}-{digest}.arrow")
+
+
+def get_source_metadata(source_path):
+    stat = os.stat(source_path)
+    return {
+        b"version": CACHE_VERSION.encode(),
+        b"size": str(stat.st_size).encode(),
+        b"mtime_ns": str(stat.st_mtime_ns).encode(),
+    }
+
+
+def to_table(event_track_data):
+    """
+    Description:
+        Columnar form of a trajectory file: dictionary-encoded behavior / event / app and step strings,
+        steps as a list<struct> column. Columns and step fields follow the key order of the file.
+    Returns:
+        table (pa.Table), or None if the file has fields outside the trajectory schema or keys in varying order
+        (it is then not cached, so loading always gives back exactly the JSON content)
+    """
+    steps = [step for item in event_track_data for step in item.get("steps", ())]
+    keys = list(event_track_data[0]) if event_track_data else list(TRAJECTORY_KEYS)
+    step_keys = list(steps[0]) if steps else list(STEP_KEYS)
+    if set(keys) != set(TRAJECTORY_KEYS) or set(step_keys) != set(STEP_KEYS):
+        return None
+    if any(list(item) != keys for item in event_track_data) or any(list(step) != step_keys for step in steps):
+        return None
+
+    def dictionary(values):
+        return pa.array(values, pa.string()).dictionary_encode()
+
+    try:
+        offsets = np.cumsum([0] + [len(item["steps"]) for item in event_track_data], dtype=np.int32)
+        step_struct = pa.StructArray.from_arrays(
+            [dictionary([step[key] for step in steps]) for key in step_keys], names=step_keys
+        )
+        columns = {
+            "behavior": dictionary([item["behavior"] for item in event_track_data]),
+            "event": dictionary([item["event"] for item in event_track_data]),
+            "datetime": pa.array([item["datetime"] for item in event_track_data], pa.string()),
+            "app": dictionary([item["app"] for item in event_track_data]),
+            "steps": pa.ListArray.from_arrays(pa.array(offsets, pa.int32()), step_struct),
+        }
+        return pa.table({key: columns[key] for key in keys})
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return None
+
+
+def column_to_pylist(array):
+    """to_pylist of a cached column, decoding each dictionary once instead of converting every row through Arrow."""
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    if array.null_count:
+        return array.to_pylist()
+    if pa.types.is_dictionary(array.type):
+        values = array.dictionary.to_pylist()
+        return [values[i] for i in array.indices.to_numpy(zero_copy_only=False).tolist()]
+    if pa.types.is_list(array.type):
+        offsets = array.offsets.to_numpy()
+        offsets = (offsets - offsets[0]).tolist()
+        items = column_to_pylist(array.flatten())
+        return [items[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    if pa.types.is_struct(array.type):
+        names = [field.name for field in array.type]
+        return [dict(zip(names, values)) for values in zip(*(column_to_pylist(child) for child in array.flatten()))]
+    return array.to_pylist()
+
+
+def table_to_pylist(table):
+    """Same as table.to_pylist(), several times faster on the dictionary-encoded cache."""
+    columns = [column_to_pylist(table.column(name)) for name in table.column_names]
+    return [dict(zip(table.column_names, values)) for values in zip(*columns)]
+
+
+def write_table(table, cache_path, metadata):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    table = table.replace_schema_metadata(metadata)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), prefix=".tmp-", suffix=".arrow")
+    os.close(fd)
+    try:
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def read_cached_table(source_path):
+    """The memory-mapped cache of a trajectory file, or None if it is missing or older than the source."""
+    cache_path = get_cache_path(source_path)
+    if not os.path.exists(cache_path):
+        return None
+    table = pa.ipc.open_file(pa.memory_map(cache_path, "r")).read_all()
+    if table.schema.metadata != get_source_metadata(source_path):
+        return None
+    return table
+
+
+def load_trajectory_table(source_path, columns=None):
+    """
+    Description:
+        Memory-mapped Arrow table of a trajectory file, (re)built from the JSON when the cache is missing or stale.
+    Args:
+        source_path (str): trajectory JSON file
+        columns (list): columns to select, all by default
+    Returns:
+        table (pa.Table), or None if the file cannot be cached
+    """
+    table = read_cached_table(source_path)
+    if table is None:
+        metadata = get_source_metadata(source_path)
+        with open(source_path, "r", encoding="utf-8") as f:
+            table = to_table(json.load(f))
+        if table is None:
+            return None
+        write_table(table, get_cache_path(source_path), metadata)
+    return table.select(list(columns)) if columns else table
+
+
+def select_columns(table, columns=None, step_columns=None):
+    """Selects behavior columns and, inside the steps column, step fields without touching the other fields."""
+    if columns:
+        table = table.select(list(columns))
+    if step_columns and "steps" in table.column_names:
+        steps = table.column("steps").combine_chunks()
+        step_struct = steps.flatten()
+        steps = pa.ListArray.from_arrays(
+            pc.subtract(steps.offsets, steps.offsets[0]),
+            pa.StructArray.from_arrays([step_struct.field(key) for key in step_columns], names=list(step_columns)),
+        )
+        table = table.set_column(table.column_names.index("steps"), "steps", steps)
+    return table
+
+
+def load_trajectory(source_path, columns=None, step_columns=None):
+    """
+    Description:
+        Drop-in replacement for json.load of a trajectory file, served from the columnar cache when it is fresh.
+        A missing or stale cache is rebuilt from the JSON on the way. Either way the result has the keys in the
+        order of the file, or in the order of `columns` / `step_columns` when they are given.
+    Args:
+        source_path (str): trajectory JSON file
+        columns (list): keys to keep in every behavior (e.g. ["datetime", "event", "behavior"]), all by default;
+            with the cache, only these columns are decoded
+        step_columns (list): keys to keep in every step, all by default
+    Returns:
+        event_track_data (list)
+    """
+    if cache_enabled:
+        table = read_cached_table(source_path)
+        if table is not None:
+            return table_to_pylist(select_columns(table, columns, step_columns))
+
+    metadata = get_source_metadata(source_path)
+    with open(source_path, "r", encoding="utf-8") as f:
+        event_track_data = json.load(f)
+    if cache_enabled:
+        table = to_table(event_track_data)
+        if table is not None:
+            write_table(table, get_cache_path(source_path), metadata)
+    if columns:
+        event_track_data = [{key: item[key] for key in columns} for item in event_track_data]
+    if step_columns:
+        for item in event_track_data:
+            if "steps" in item:
+                item["steps"] = [{key: step[key] for key in step_columns} for step in item["steps"]]
+    return event_track_data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert trajectory JSON files into the columnar cache.")
+    parser.add_argument("trajectory_dirs", nargs="*", default=["data/trajectory/train", "data/trajectory/test"])
+    args = parser.parse_args()
+
+    n_cached, n_skipped, source_bytes, cache_bytes = 0, 0, 0, 0
+    file_paths = [
+        os.path.join(trajectory_dir, filename)
+        for trajectory_dir in args.trajectory_dirs
+        for filename in sorted(os.listdir(trajectory_dir))
+        if filename.endswith(".json")
+    ]
+    for file in tqdm(file_paths):
+        if load_trajectory_table(file) is None:
+            n_skipped += 1
+            continue
+        n_cached += 1
+        source_bytes += os.path.getsize(file)
+        cache_bytes += os.path.getsize(get_cache_path(file))
+    print(
+        f"{n_cached} files cached in {cache_dir} ({source_bytes / 2**20:.1f} MiB JSON -> {cache_bytes / 2**20:.1f} MiB), "
+        f"{n_skipped} files with fields outside the trajectory schema left uncached"
+    )
@@ -0,0 +1,139 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from openai import OpenAI
+
+from mock_server import start_mock_server
+from request_api import create_chat_completion, close_clients
+from usage_log import UsageRecorder, set_default_recorder, load_records, summarize
+from generate_persona import GenPersona, GenPersonaWithoutIntent
+from generate_intention_trajectory import GenIntentTrajectory
+
+
+def bench_client(base_url: str, n_requests: int, n_threads: int, latency: float) -> None:
+    """
+    Compares a fresh OpenAI client per request (old behavior) against the pooled client registry.
+    """
+    messages = [{"role": "user", "content": "ping"}]
+
+    def call_fresh_client(_):
+        client = OpenAI(api_key="mock", base_url=base_url, timeout=60)
+        response = client.chat.completions.create(model="mock", messages=messages, timeout=60)
+        client.close()
+        return response.choices[0].message.content
+
+    def call_pooled_client(_):
+        return create_chat_completion(api_key="mock", base_url=base_url, model="mock", messages=messages)
+
+    for name, fn in [("fresh client", call_fresh_client), ("pooled client", call_pooled_client)]:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(fn, range(n_requests)))
+        elapsed = time.perf_counter() - start
+        print(f"{name:>14}: {n_requests / elapsed:8.1f} req/s ({n_requests} requests, {n_threads} threads, {latency}s latency)")
+
+    close_clients()
+
+
+def bench_simulator(
+    base_url: str,
+    n_users: int,
+    max_concurrency: int,
+    stream: bool,
+    context_mode: str,
+    intentions_csv: str = "simulator/intentions/user_demo.csv",
+) -> None:
+    """
+    Runs GenPersona, GenPersonaWithoutIntent and GenIntentTrajectory end to end against the mock endpoint
+    and reports throughput and latency percentiles per stage from the usage log.
+    """
+    work_dir = tempfile.mkdtemp(prefix="act2intention-bench-")
+    usage_file = os.path.join(work_dir, "usage.jsonl")
+    set_default_recorder(UsageRecorder(usage_file))
+
+    intentions_dir = os.path.join(work_dir, "intentions")
+    os.makedirs(intentions_dir)
+    for i in range(n_users):
+        shutil.copy(intentions_csv, os.path.join(intentions_dir, f"user_{i:05d}.csv"))
+
+    gen_persona = GenPersona(api_key="mock", base_url=base_url, model="mock", max_concurrency=max_concurrency)
+    gen_persona.dir = intentions_dir
+    gen_persona.save_file = os.path.join(work_dir, "user_personas.json")
+    gen_persona.checkpoint_file = os.path.join(work_dir, "user_personas.jsonl")
+
+    gen_persona_without_intent = GenPersonaWithoutIntent(
+        api_key="mock", base_url=base_url, model="mock", max_concurrency=max_concurrency
+    )
+    gen_persona_without_intent.N = n_users
+    gen_persona_without_intent.save_file = os.path.join(work_dir, "user_personas_without_intent.json")
+
+    gen_intent_trajectory = GenIntentTrajectory(
+        api_key="mock",
+        base_url=base_url,
+        model="mock",
+        max_concurrency=max_concurrency,
+        stream=stream,
+        context_mode=context_mode,
+    )
+    gen_intent_trajectory.user_personas = gen_persona.save_file
+    gen_intent_trajectory.save_dir = os.path.join(work_dir, "trajectory")
+
+    print(f"{'stage':<24} {'wall(s)':>8} {'calls':>6} {'calls/s':>8} {'p50(s)':>7} {'p95(s)':>7} {'p99(s)':>7} {'errors':>6} {'retries':>7}")
+    for generator in [gen_persona, gen_persona_without_intent, gen_intent_trajectory]:
+        name = type(generator).__name__
+        start = time.perf_counter()
+        generator.run()
+        elapsed = time.perf_counter() - start
+
+        records = [r for r in load_records(usage_file) if r["caller"] == name]
+        row = summarize(records, "caller")[0] if records else None
+        if row is None:
+            print(f"{name:<24} {elapsed:>8.2f} {0:>6}")
+            continue
+        print(
+            f"{name:<24} {elapsed:>8.2f} {row['calls']:>6} {row['calls'] / elapsed:>8.1f} "
+            f"{row['p50']:>7.3f} {row['p95']:>7.3f} {row['p99']:>7.3f} {row['errors']:>6} {row['retries']:>7}"
+        )
+
+    set_default_recorder(None)
+    shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulator throughput benchmarks against a local mock endpoint.")
+    parser.add_argument("--latency", type=float, default=0.0, help="mock latency in seconds (median for lognormal)")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "lognormal"], default="fixed")
+    parser.add_argument("--error-429", type=float, default=0.0)
+    parser.add_argument("--error-500", type=float, default=0.0)
+    subparsers = parser.add_subparsers(dest="command")
+
+    client_parser = subparsers.add_parser("client", help="fresh vs pooled OpenAI client")
+    client_parser.add_argument("--requests", type=int, default=500)
+    client_parser.add_argument("--threads", type=int, default=8)
+
+    simulator_parser = subparsers.add_parser("simulator", help="GenPersona / GenPersonaWithoutIntent / GenIntentTrajectory")
+    simulator_parser.add_argument("--users", type=int, default=50)
+    simulator_parser.add_argument("--concurrency", type=int, default=8)
+    simulator_parser.add_argument("--stream", action="store_true")
+    simulator_parser.add_argument("--context-mode", choices=["full", "window"], default="full")
+    args = parser.parse_args()
+
+    # benchmarks always hit the mock endpoint, never the response cache
+    os.environ.pop("API_CACHE_PATH", None)
+
+    server, base_url = start_mock_server(
+        latency=args.latency,
+        latency_dist=args.latency_dist,
+        error_429=args.error_429,
+        error_500=args.error_500,
+    )
+    try:
+        if args.command == "simulator":
+            bench_simulator(base_url, args.users, args.concurrency, args.stream, args.context_mode)
+        else:
+            bench_client(base_url, getattr(args, "requests", 500), getattr(args, "threads", 8), args.latency)
+    finally:
+        server.shutdown()
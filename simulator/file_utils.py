@@ -0,0 +1,21 @@
+import os
+import json
+import tempfile
+from typing import Any
+
+
+def write_json_atomic(path: str, data: Any, indent: int = 4) -> None:
+    """
+    Writes JSON to a temp file in the same directory and renames it over `path`,
+    so readers (and restarts after a kill) never see a half-written file.
+    """
+    dir_name = os.path.dirname(path) or "."
+    os.makedirs(dir_name, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_name, prefix=".tmp-", suffix=".json")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=indent)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -5,10 +5,13 @@ import json
 import random
 import requests
 import pandas as pd
+from collections import Counter, deque
 from dotenv import load_dotenv
-from typing import List, Dict, Any, Optional, Tuple, Union
+from typing import List, Dict, Any, Optional, Tuple, Union, Iterator, Callable
 
-from request_api import create_chat_completion
+from request_api import create_chat_completion, batch_chat_completion, stream_chat_completion, estimate_tokens
+from response_cache import get_default_cache
+from file_utils import write_json_atomic
 
 SYSTEM_PROMPT = """<Role>You need to act as a real user.</Role>  
 <Task>Your task is to generate realistic app usage intention trajectories based on the user profile and scenario I provide.</Task>  
@@ -21,14 +24,93 @@ SYSTEM_PROMPT = """<Role>You need to act as a real user.</Role>
 6. Strictly output in JSON format: List[{"Time": "string","APP": "string","Intention": "string"}]
 </Rule>"""
 
+CONTINUE_PROMPT = 'You need to continue generating intent trajectories for subsequent time periods based on the generated intent trajectories.\nStrictly output in JSON format: List[{"Time": "string","APP": "string","Intention": "string"}]'
+
+
+class IncrementalJSONParser:
+    """
+    Extracts flat JSON objects from a token stream as soon as each one closes.
+    Mirrors GenIntentTrajectory.parse_content: an object starts at the last "{" and ends at the next "}"
+    (braces inside strings are ignored), newlines are dropped and invalid candidates are skipped.
+    """
+
+    def __init__(self):
+        self.buffer = None
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        objects = []
+        for ch in text:
+            if ch == "\n":
+                continue
+            if self.buffer is None:
+                if ch == "{":
+                    self.buffer = [ch]
+                continue
+
+            self.buffer.append(ch)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch == "{":
+                self.buffer = [ch]
+            elif ch == "}":
+                candidate = "".join(self.buffer)
+                self.buffer = None
+                try:
+                    objects.append(json.loads(candidate))
+                except json.JSONDecodeError:
+                    pass
+        return objects
+
 
 class GenIntentTrajectory:
-    def __init__(self, api_key: str, base_url: str, model: str):
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str,
+        model: str,
+        max_concurrency: int = 1,
+        rpm: Optional[int] = None,
+        tpm: Optional[int] = None,
+        stream: bool = False,
+        context_mode: str = "full",
+        context_last_k: int = 20,
+        context_token_budget: Optional[int] = None,
+        max_iterations: int = 3,
+        intent_length_max: int = 100,
+        prompt_tokens_log_size: int = 1000,
+    ):
         self.api_key = api_key
         self.base_url = base_url
         self.model = model
-        self.max_iterations = 3
-        self.intent_length_max = 100
+        # max_concurrency > 1 generates all personas together through the rate-limited batch API
+        self.max_concurrency = max_concurrency
+        self.rpm = rpm
+        self.tpm = tpm
+        # stream=True yields intentions as they close in the token stream and stops at intent_length_max
+        self.stream = stream
+        # "full" re-sends the whole conversation every turn; "window" keeps the system prompt, the persona
+        # and only the last `context_last_k` intentions (plus a digest of earlier ones) within `context_token_budget`
+        if context_mode not in ("full", "window"):
+            raise ValueError(f"context_mode must be 'full' or 'window', got {context_mode!r}")
+        self.context_mode = context_mode
+        self.context_last_k = context_last_k
+        self.context_token_budget = context_token_budget
+        # estimated prompt tokens of each turn, one list per generated trajectory; only the last
+        # `prompt_tokens_log_size` trajectories are kept, so long scheduler runs stay bounded
+        self.prompt_tokens_log = deque(maxlen=prompt_tokens_log_size)
+        # continuation turns per trajectory, and the number of intentions to stop at; long trajectories
+        # (e.g. 500+ intentions) need both raised, ideally with context_mode="window"
+        self.max_iterations = max_iterations
+        self.intent_length_max = intent_length_max
 
         self.user_personas = "simulator/user_personas.json"
         self.save_dir = "simulator/trajectory"
@@ -41,6 +123,8 @@ class GenIntentTrajectory:
             return False
 
     def parse_content(self, input_string):
+        if not input_string:
+            return []
         input_string = input_string.replace("\n", "").strip()
         pattern = r"\{.*?\}"
         matches = re.findall(pattern, input_string, re.DOTALL)
@@ -54,60 +138,267 @@ class GenIntentTrajectory:
                 res.append(json_data)
         return res
 
-    def generate_intentions(self, user_profile: str, scenario: str) -> List[Dict[str, str]]:
+    def request_intentions(
+        self,
+        messages: List[Dict[str, str]],
+        n_remaining: int,
+        seed: Optional[int] = None,
+        on_usage: Optional[Callable[[Any], None]] = None,
+    ):
+        """
+        Description:
+            Runs one turn. In streaming mode intentions are yielded as soon as they close, and the
+            request is closed once `n_remaining` intentions have arrived.
+        Args:
+            messages (List[Dict[str, str]]): conversation so far
+            n_remaining (int): intentions still needed to reach intent_length_max
+            seed (int): sampling seed
+            on_usage (Callable): receives the API-reported usage of the turn, see create_chat_completion
+        Returns:
+            Iterator over intentions; the generator's return value is the (possibly truncated) response text.
+        """
+        if not self.stream:
+            response = create_chat_completion(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                model=self.model,
+                caller=type(self).__name__,
+                messages=messages,
+                seed=seed,
+                on_usage=on_usage,
+            )
+            yield from self.parse_content(response)
+            return response
+
+        parser = IncrementalJSONParser()
+        chunks = []
+        n_yielded = 0
+        deltas = stream_chat_completion(
+            api_key=self.api_key,
+            base_url=self.base_url,
+            model=self.model,
+            caller=type(self).__name__,
+            messages=messages,
+            seed=seed,
+            on_usage=on_usage,
+        )
+        try:
+            for delta in deltas:
+                chunks.append(delta)
+                for intention in parser.feed(delta):
+                    yield intention
+                    n_yielded += 1
+                    if n_yielded >= n_remaining:
+                        return "".join(chunks).strip()
+        finally:
+            deltas.close()
+        return "".join(chunks).strip()
+
+    def digest_intentions(self, intentions: List[Dict[str, str]]) -> str:
+        """Compact, locally built summary of intentions dropped from the context window."""
+        if not intentions:
+            return ""
+        apps = Counter(intention.get("APP", "") for intention in intentions).most_common(10)
+        apps_string = ", ".join(f"{app} ({n})" for app, n in apps)
+        return (
+            f"Earlier intentions (omitted): {len(intentions)} intentions from {intentions[0].get('Time', '')} "
+            f"to {intentions[-1].get('Time', '')}; most used apps: {apps_string}.\n"
+        )
+
+    def build_window_messages(self, user_prompt: str, intentions: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """
+        Description:
+            Builds a bounded continuation context: system prompt, persona/scenario, the last K intentions
+            and a digest of the earlier ones. K is halved until the prompt fits context_token_budget.
+        Args:
+            user_prompt (str): persona and scenario
+            intentions (List[Dict[str, str]]): all intentions generated so far
+        Returns:
+            messages (List[Dict[str, str]])
+        """
+        k = min(self.context_last_k, len(intentions))
+        while True:
+            recent, earlier = intentions[len(intentions) - k :], intentions[: len(intentions) - k]
+            messages = [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt},
+                {"role": "assistant", "content": json.dumps(recent, ensure_ascii=False)},
+                {"role": "user", "content": self.digest_intentions(earlier) + CONTINUE_PROMPT},
+            ]
+            if self.context_token_budget is None or k <= 1 or estimate_tokens(messages) <= self.context_token_budget:
+                return messages
+            k //= 2
+
+    def iter_intentions(self, user_profile: str, scenario: str, seed: Optional[int] = None) -> Iterator[Dict[str, str]]:
+        user_prompt = f"{user_profile} {scenario}"
         messages = [
             {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": f"{user_profile} {scenario}"},
+            {"role": "user", "content": user_prompt},
         ]
 
-        all_intentions = []
+        intentions = []
+        prompt_tokens = []
+        self.prompt_tokens_log.append(prompt_tokens)
         max_iterations = self.max_iterations
-        while len(all_intentions) > self.intent_length_max or max_iterations > 0:
+        while len(intentions) < self.intent_length_max and max_iterations > 0:
             max_iterations -= 1
-            try:
-                response = create_chat_completion(
-                    api_key=self.api_key,
-                    base_url=self.base_url,
-                    model=self.model,
-                    messages=messages,
-                )
+            # the estimate stands in until (or unless) the API reports the turn's usage
+            prompt_tokens.append(estimate_tokens(messages))
 
-                current_intentions = self.parse_content(response)
-                all_intentions.extend(current_intentions)
+            def on_usage(usage, turn_index=len(prompt_tokens) - 1):
+                if usage.prompt_tokens is not None:
+                    prompt_tokens[turn_index] = usage.prompt_tokens
 
-                if not current_intentions:
-                    print("Error: No intentions generated.")
-                    print(f"{response=}")
+            turn = self.request_intentions(
+                messages, self.intent_length_max - len(intentions), seed=seed, on_usage=on_usage
+            )
+            n_current = 0
+            while True:
+                try:
+                    intention = next(turn)
+                except StopIteration as stop:
+                    response = stop.value
                     break
+                n_current += 1
+                intentions.append(intention)
+                yield intention
+
+            if n_current == 0:
+                print("Error: No intentions generated.")
+                print(f"{response=}")
+                break
 
-                # update
+            # update
+            if self.context_mode == "window":
+                messages = self.build_window_messages(user_prompt, intentions)
+            else:
                 messages.append({"role": "assistant", "content": response})
-                messages.append(
-                    {
-                        "role": "user",
-                        "content": 'You need to continue generating intent trajectories for subsequent time periods based on the generated intent trajectories.\nStrictly output in JSON format: List[{"Time": "string","APP": "string","Intention": "string"}]',
-                    }
-                )
-            except Exception as e:
-                print(f"Error generating intentions: {e}")
+                messages.append({"role": "user", "content": CONTINUE_PROMPT})
+
+    def generate_intentions(
+        self, user_profile: str, scenario: str, seed: Optional[int] = None, partial_on_error: bool = True
+    ) -> List[Dict[str, str]]:
+        """
+        Description:
+            Collects iter_intentions. An API error ends the trajectory: with partial_on_error, the intentions
+            generated so far are returned (the standalone run keeps them); otherwise the error is raised, so that
+            a caller with retries (TrajectoryScheduler) does not mistake a truncated trajectory for a complete one.
+        """
+        intentions = []
+        try:
+            for intention in self.iter_intentions(user_profile, scenario, seed=seed):
+                intentions.append(intention)
+        except Exception as e:
+            if not partial_on_error:
+                raise
+            print(f"Error generating intentions: {e}")
+        return intentions
+
+    def generate_intentions_batch(
+        self, user_profiles: List[str], scenarios: List[str], seed: Optional[int] = None
+    ) -> List[List[Dict[str, str]]]:
+        """
+        Description:
+            Batched version of generate_intentions: every continuation turn of every profile is sent
+            through the rate-limited batch API together, so turns of different profiles overlap.
+            Requests carry the same seed as in generate_intentions; the batch API cannot stream, so a
+            generator created with stream=True raises ValueError here.
+        Args:
+            user_profiles (List[str]): personas
+            scenarios (List[str]): one scenario per persona
+            seed (int): sampling seed sent with every request
+        Returns:
+            all_intentions (List[List[Dict[str, str]]]): intentions per persona, in input order
+        """
+        conversations = [
+            [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": f"{user_profile} {scenario}"},
+            ]
+            for user_profile, scenario in zip(user_profiles, scenarios)
+        ]
+        all_intentions = [[] for _ in conversations]
+        prompt_tokens = [[] for _ in conversations]
+        self.prompt_tokens_log.extend(prompt_tokens)
+        active = list(range(len(conversations)))
+
+        for _ in range(self.max_iterations):
+            if not active:
                 break
+            for idx in active:
+                prompt_tokens[idx].append(estimate_tokens(conversations[idx]))
+
+            def on_usage(batch_idx, usage, active=active):
+                if usage.prompt_tokens is not None:
+                    prompt_tokens[active[batch_idx]][-1] = usage.prompt_tokens
+
+            responses = batch_chat_completion(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                model=self.model,
+                caller=type(self).__name__,
+                messages_list=[conversations[idx] for idx in active],
+                max_concurrency=self.max_concurrency,
+                rpm=self.rpm,
+                tpm=self.tpm,
+                seed=seed,
+                stream=self.stream,
+                on_usage=on_usage,
+            )
+
+            next_active = []
+            for idx, response in zip(active, responses):
+                current_intentions = self.parse_content(response)
+                all_intentions[idx].extend(current_intentions)
+
+                if not current_intentions:
+                    print(f"Error: No intentions generated. {response=}")
+                    continue
+
+                if self.context_mode == "window":
+                    user_prompt = f"{user_profiles[idx]} {scenarios[idx]}"
+                    conversations[idx] = self.build_window_messages(user_prompt, all_intentions[idx])
+                else:
+                    conversations[idx].append({"role": "assistant", "content": response})
+                    conversations[idx].append({"role": "user", "content": CONTINUE_PROMPT})
+                if len(all_intentions[idx]) < self.intent_length_max:
+                    next_active.append(idx)
+            active = next_active
 
         return all_intentions
 
     def run(self):
+        self.prompt_tokens_log.clear()
         with open(self.user_personas, "r", encoding="utf-8") as f:
             user_profiles = json.load(f)
 
-        for id, persona in user_profiles.items():
-            gen_intentions = self.generate_intentions(persona, "")
+        if self.max_concurrency > 1:
+            ids = list(user_profiles.keys())
+            results = self.generate_intentions_batch([user_profiles[id] for id in ids], [""] * len(ids))
+        else:
+            ids = user_profiles.keys()
+            results = (self.generate_intentions(user_profiles[id], "") for id in ids)
+
+        for id, gen_intentions in zip(ids, results):
             if not gen_intentions:
                 print(f"Error: No intentions generated for persona {id}.")
                 continue
 
             # Save to json
             output_file = os.path.join(self.save_dir, f"intentions_{id}.json")
-            with open(output_file, "w", encoding="utf-8") as f:
-                json.dump(gen_intentions, f, ensure_ascii=False, indent=4)
+            write_json_atomic(output_file, gen_intentions)
+
+        self.report_prompt_tokens()
+
+    def report_prompt_tokens(self):
+        """
+        Prints the mean prompt tokens of each turn index over all generated trajectories: the API-reported
+        usage, or the estimate_tokens estimate for turns without one (cached or cut-off streamed responses).
+        """
+        n_turns = max((len(tokens) for tokens in self.prompt_tokens_log), default=0)
+        for turn in range(n_turns):
+            turn_tokens = [tokens[turn] for tokens in self.prompt_tokens_log if len(tokens) > turn]
+            print(f"[{self.context_mode}] turn {turn + 1}: {sum(turn_tokens) / len(turn_tokens):.0f} prompt tokens (mean of {len(turn_tokens)})")
 
 
 if __name__ == "__main__":
@@ -115,9 +406,35 @@ if __name__ == "__main__":
     API_KEY = os.getenv("API_KEY")
     BASE_URL = os.getenv("API_HOST")
     MODEL = os.getenv("API_MODEL_NAME")
+    MAX_CONCURRENCY = int(os.getenv("API_MAX_CONCURRENCY") or 1)
+    RPM = int(os.getenv("API_RPM") or 0) or None
+    TPM = int(os.getenv("API_TPM") or 0) or None
+    STREAM = (os.getenv("API_STREAM") or "").lower() in ("1", "true")
+    CONTEXT_MODE = os.getenv("API_CONTEXT_MODE") or "full"
+    CONTEXT_LAST_K = int(os.getenv("API_CONTEXT_LAST_K") or 20)
+    CONTEXT_TOKEN_BUDGET = int(os.getenv("API_CONTEXT_TOKEN_BUDGET") or 0) or None
+    MAX_ITERATIONS = int(os.getenv("API_MAX_ITERATIONS") or 3)
+    INTENT_LENGTH_MAX = int(os.getenv("API_INTENT_LENGTH_MAX") or 100)
 
     if not API_KEY or not BASE_URL or not MODEL:
         raise ValueError("API_KEY, API_HOST, and API_MODEL_NAME must be set in the environment variables.")
 
-    gen_intent_trajectory = GenIntentTrajectory(api_key=API_KEY, base_url=BASE_URL, model=MODEL)
+    gen_intent_trajectory = GenIntentTrajectory(
+        api_key=API_KEY,
+        base_url=BASE_URL,
+        model=MODEL,
+        max_concurrency=MAX_CONCURRENCY,
+        rpm=RPM,
+        tpm=TPM,
+        stream=STREAM,
+        context_mode=CONTEXT_MODE,
+        context_last_k=CONTEXT_LAST_K,
+        context_token_budget=CONTEXT_TOKEN_BUDGET,
+        max_iterations=MAX_ITERATIONS,
+        intent_length_max=INTENT_LENGTH_MAX,
+    )
     gen_intent_trajectory.run()
+
+    cache = get_default_cache()
+    if cache is not None:
+        print(f"Response cache: {cache.stats()}")
@@ -8,16 +8,41 @@ import pandas as pd
 from dotenv import load_dotenv
 from typing import List, Dict, Any, Optional, Tuple, Union
 
-from request_api import create_chat_completion
+from request_api import create_chat_completion, batch_chat_completion
+from response_cache import ResponseCache, get_default_cache
+from file_utils import write_json_atomic
 
 
 class GenPersona:
-    def __init__(self, api_key: str, base_url: str, model: str):
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str,
+        model: str,
+        max_concurrency: int = 1,
+        rpm: Optional[int] = None,
+        tpm: Optional[int] = None,
+        chunk_rows: Optional[int] = None,
+        merge_fanout: int = 4,
+    ):
         self.api_key = api_key
         self.base_url = base_url
         self.model = model
+        # max_concurrency > 1 sends all requests through the rate-limited batch API
+        self.max_concurrency = max_concurrency
+        self.rpm = rpm
+        self.tpm = tpm
         self.dir = "simulator/intentions"
         self.save_file = "simulator/user_personas.json"
+        # one {"id", "file", "persona"} line per finished file; survives crashes and lets run() resume
+        self.checkpoint_file = "simulator/user_personas.jsonl"
+        # chunk_rows set: map-reduce mode for long histories. Time-ordered chunks of `chunk_rows` rows are
+        # summarized in parallel, then merged `merge_fanout` at a time until one persona remains.
+        # Chunk and merge results are cached, so appending rows only recomputes the tail.
+        self.chunk_rows = chunk_rows
+        self.merge_fanout = max(2, merge_fanout)
+        self.chunk_cache_file = "simulator/cache/persona_chunks.sqlite"
+        self.chunk_cache = None
 
         self.SYSTEM_PROMPT = """<Role>You are a user data analyst</Role>
 <Task>Your task is to generate a comprehensive and personalized user profile description based on the user's historical mobile phone usage intent trajectory.</Task>
@@ -34,6 +59,37 @@ class GenPersona:
 4. Maintain an objective description and avoid excessive speculation. All inferences should be grounded in the user's actual historical intents and behavior patterns. Rather than describing highly uncertain imagined content, focus only on what can be confidently deduced from the user's historical intent sequence and behavior patterns. Minimize aesthetic descriptions as much as possible.  
 5. All the Intentions mentioned above are collected from users' mobile phone usage.
 6. Strictly output in JSON format: {"Persona": str}, and DO NOT output anything other than JSON.
+</Rule>"""
+
+        self.CHUNK_PROMPT = """<Role>You are a user data analyst</Role>
+<Task>You are given one time-ordered segment of a user's historical mobile phone usage intent trajectory. Your task is to summarize the user's behavior patterns in this segment.</Task>
+<Rule>  
+0. The input format is: List[(Time, APP, Intention, Event)], where "Event" represents the category of each user intent.  
+1. Merge semantically similar intentions into behavior patterns, keeping their frequencies and the apps involved. Do not merge so much that the user's individual traits are lost.  
+2. If a behavior pattern exhibits clear temporal characteristics, state them directly.  
+3. Maintain an objective description and avoid speculation. Focus only on what can be confidently deduced from the segment.  
+4. Strictly output in JSON format: {"Patterns": str}, and DO NOT output anything other than JSON.
+</Rule>"""
+
+        self.MERGE_PROMPT = """<Role>You are a user data analyst</Role>
+<Task>You are given behavior pattern summaries of consecutive time periods of the same user's mobile phone usage. Your task is to merge them into one summary of the user's behavior patterns over the whole period.</Task>
+<Rule>  
+0. The input format is: List[str], one summary per period, in time order.  
+1. Merge patterns whose semantics are truly identical and add up their frequencies; keep distinct patterns separate.  
+2. Keep temporal characteristics, and state how the patterns change over time if they do.  
+3. Do not over-merge: the summary must still reflect the user's individual traits.  
+4. Strictly output in JSON format: {"Patterns": str}, and DO NOT output anything other than JSON.
+</Rule>"""
+
+        self.PERSONA_FROM_PATTERNS_PROMPT = """<Role>You are a user data analyst</Role>
+<Task>Your task is to generate a comprehensive and personalized user profile description based on summaries of the user's behavior patterns, each covering a consecutive period of the user's historical mobile phone usage intent trajectory.</Task>
+<Rule>  
+0. The input format is: List[str], one behavior pattern summary per period, in time order.  
+1. Merge patterns whose semantics are truly identical. Merging too much makes the profile vague and generic; merging too little obscures the user's core behavior patterns.  
+2. Based on the merged behavior patterns, provide a thorough analytical summary of the user's profile. The summary should be comprehensive while highlighting the user's personalized traits.  
+3. Maintain an objective description and avoid excessive speculation. All inferences should be grounded in the behavior patterns. Minimize aesthetic descriptions as much as possible.  
+4. All the behavior patterns above are derived from users' mobile phone usage.
+5. Strictly output in JSON format: {"Persona": str}, and DO NOT output anything other than JSON.
 </Rule>"""
 
     def is_valid_json(self, json_string):
@@ -43,7 +99,9 @@ class GenPersona:
         except json.JSONDecodeError:
             return False
 
-    def parse_content(self, input_string):
+    def parse_content(self, input_string, key="Persona"):
+        if not input_string:
+            return None
 
         pattern = r"\{.*?\}"
         matches = re.findall(pattern, input_string, re.DOTALL)
@@ -51,8 +109,8 @@ class GenPersona:
         if len(matches) != 0 and self.is_valid_json(matches[0]):
             json_data = json.loads(matches[0])
 
-            if "Persona" in json_data:
-                return json_data["Persona"]
+            if key in json_data:
+                return json_data[key]
 
         return None
 
@@ -62,41 +120,177 @@ class GenPersona:
         :param data: List of tuples containing (Time, APP, Intention, Event)
         :return: Generated persona in JSON format
         """
-        messages = [
-            {"role": "system", "content": self.SYSTEM_PROMPT},
-            {"role": "user", "content": json.dumps(data)},
-        ]
         response = create_chat_completion(
             api_key=self.api_key,
             base_url=self.base_url,
             model=self.model,
-            messages=messages,
+            caller=type(self).__name__,
+            messages=self.build_messages(data),
         )
         return response
 
-    def run(self):
-        persona_res_dict = {}
+    def build_messages(self, data: List[Tuple[str, str, str, str]]) -> List[Dict[str, str]]:
+        return [
+            {"role": "system", "content": self.SYSTEM_PROMPT},
+            {"role": "user", "content": json.dumps(data)},
+        ]
+
+    def batch(self, messages_list: List[List[Dict[str, str]]], **kwargs) -> List[Optional[str]]:
+        return batch_chat_completion(
+            api_key=self.api_key,
+            base_url=self.base_url,
+            model=self.model,
+            messages_list=messages_list,
+            max_concurrency=self.max_concurrency,
+            rpm=self.rpm,
+            tpm=self.tpm,
+            caller=type(self).__name__,
+            **kwargs,
+        )
 
-        file_list = os.listdir(self.dir)
-        for file_idx, file in enumerate(file_list):
-            with open(os.path.join(self.dir, file), "r", encoding="utf-8") as f:
-                data_csv = f.readlines()[1:-1]
-            data = [f"({x.strip()})" for x in data_csv]
+    def generate_persona_chunked(self, data: List[str]) -> Optional[str]:
+        """
+        Description:
+            Map-reduce persona generation for histories that do not fit in one prompt.
+            Rows are sorted by time and cut into fixed-size chunks from the start, and merges are grouped
+            from the start as well, so appending rows leaves earlier chunks and merge groups (and their
+            cached results) unchanged.
+        Args:
+            data (List[str]): "(Time,APP,Intention,Event)" rows
+        Returns:
+            persona (str), or None if any step failed (successful steps stay cached for the retry)
+        """
+        if self.chunk_cache is None:
+            self.chunk_cache = ResponseCache(self.chunk_cache_file)
+
+        data = sorted(data, key=lambda row: row.split(",", 1)[0])
+        chunks = [data[i : i + self.chunk_rows] for i in range(0, len(data), self.chunk_rows)]
+
+        # map: summarize chunks in parallel
+        responses = self.batch(
+            [
+                [{"role": "system", "content": self.CHUNK_PROMPT}, {"role": "user", "content": json.dumps(chunk)}]
+                for chunk in chunks
+            ],
+            cache=self.chunk_cache,
+        )
+        partials = [self.parse_content(response, key="Patterns") for response in responses]
+
+        # reduce: merge `merge_fanout` partials at a time until they fit in the final prompt
+        while None not in partials and len(partials) > self.merge_fanout:
+            groups = [partials[i : i + self.merge_fanout] for i in range(0, len(partials), self.merge_fanout)]
+            responses = self.batch(
+                [
+                    [{"role": "system", "content": self.MERGE_PROMPT}, {"role": "user", "content": json.dumps(group)}]
+                    for group in groups
+                ],
+                cache=self.chunk_cache,
+            )
+            partials = [self.parse_content(response, key="Patterns") for response in responses]
+
+        if None in partials:
+            return None
+        messages = [
+            {"role": "system", "content": self.PERSONA_FROM_PATTERNS_PROMPT},
+            {"role": "user", "content": json.dumps(partials)},
+        ]
+        return self.parse_content(self.batch([messages])[0])
+
+    def persona_id(self, file: str) -> str:
+        """Stable persona id derived from the intention file name (independent of os.listdir order)."""
+        return os.path.splitext(file)[0]
+
+    def read_intentions(self, file: str) -> List[str]:
+        with open(os.path.join(self.dir, file), "r", encoding="utf-8") as f:
+            data_csv = f.readlines()[1:-1]
+        return [f"({x.strip()})" for x in data_csv]
+
+    def load_checkpoint(self) -> Dict[str, str]:
+        personas = {}
+        if not os.path.exists(self.checkpoint_file):
+            return personas
+        line = ""
+        with open(self.checkpoint_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # truncated last line of a killed run
+                personas[record["id"]] = record["persona"]
+        if line and not line.endswith("\n"):
+            # terminate the truncated line so the next append starts on a fresh one
+            with open(self.checkpoint_file, "a", encoding="utf-8") as f:
+                f.write("\n")
+        return personas
+
+    def append_checkpoint(self, persona_id: str, file: str, persona: str):
+        with open(self.checkpoint_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"id": persona_id, "file": file, "persona": persona}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
 
-            response = self.generate_persona(data)
-            persona = self.parse_content(response)
-            persona_res_dict[file_idx] = persona
+    def run(self):
+        """
+        Generates a persona for every intention file.
+        Each persona is appended to `checkpoint_file` as soon as it is parsed; files already in the
+        checkpoint are skipped, and the checkpoint is finally compacted into `save_file`.
+        """
+        personas = self.load_checkpoint()
+        file_list = sorted(file for file in os.listdir(self.dir) if file.endswith(".csv"))
+        pending = [file for file in file_list if self.persona_id(file) not in personas]
+        print(f"{len(file_list) - len(pending)}/{len(file_list)} personas already in {self.checkpoint_file}")
+
+        def save_persona(idx: int, persona: Optional[str]):
+            file = pending[idx]
+            if persona is None:
+                print(f"Error: No persona generated for {file}, it will be retried on the next run.")
+                return
+            personas[self.persona_id(file)] = persona
+            self.append_checkpoint(self.persona_id(file), file, persona)
+
+        def on_result(idx: int, response: Optional[str]):
+            save_persona(idx, self.parse_content(response))
+
+        if self.chunk_rows:
+            for idx, file in enumerate(pending):
+                save_persona(idx, self.generate_persona_chunked(self.read_intentions(file)))
+        elif self.max_concurrency > 1:
+            self.batch([self.build_messages(self.read_intentions(file)) for file in pending], on_result=on_result)
+        else:
+            for idx, file in enumerate(pending):
+                try:
+                    response = self.generate_persona(self.read_intentions(file))
+                except Exception as e:
+                    print(f"Error generating persona for {file}: {e}")
+                    continue
+                on_result(idx, response)
 
         ## save personas
-        with open(self.save_file, "w", encoding="utf-8") as f:
-            json.dump(persona_res_dict, f, ensure_ascii=False, indent=4)
+        persona_res_dict = {
+            self.persona_id(file): personas[self.persona_id(file)]
+            for file in file_list
+            if self.persona_id(file) in personas
+        }
+        write_json_atomic(self.save_file, persona_res_dict)
 
 
 class GenPersonaWithoutIntent:
-    def __init__(self, api_key: str, base_url: str, model: str):
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str,
+        model: str,
+        max_concurrency: int = 1,
+        rpm: Optional[int] = None,
+        tpm: Optional[int] = None,
+    ):
         self.api_key = api_key
         self.base_url = base_url
         self.model = model
+        # max_concurrency > 1 sends all requests through the rate-limited batch API
+        self.max_concurrency = max_concurrency
+        self.rpm = rpm
+        self.tpm = tpm
         self.N = 10
         self.save_file = "simulator/user_personas.json"
 
@@ -125,6 +319,8 @@ class GenPersonaWithoutIntent:
             return False
 
     def parse_content(self, input_string):
+        if not input_string:
+            return None
 
         pattern = r"\{.*?\}"
         matches = re.findall(pattern, input_string, re.DOTALL)
@@ -143,25 +339,40 @@ class GenPersonaWithoutIntent:
         :param data: List of tuples containing (Time, APP, Intention, Event)
         :return: Generated persona in JSON format
         """
-        messages = [
-            {"role": "system", "content": self.SYSTEM_PROMPT},
-            {"role": "user", "content": "generate a persona"},
-        ]
         response = create_chat_completion(
             api_key=self.api_key,
             base_url=self.base_url,
             model=self.model,
-            messages=messages,
+            caller=type(self).__name__,
+            messages=self.build_messages(),
         )
         return response
 
+    def build_messages(self) -> List[Dict[str, str]]:
+        return [
+            {"role": "system", "content": self.SYSTEM_PROMPT},
+            {"role": "user", "content": "generate a persona"},
+        ]
+
     def run(self):
         persona_res_dict = {}
 
-        for i in range(self.N):
-            response = self.generate_persona()
-            persona = self.parse_content(response)
-            persona_res_dict[i] = persona
+        if self.max_concurrency > 1:
+            responses = batch_chat_completion(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                model=self.model,
+                caller=type(self).__name__,
+                messages_list=[self.build_messages() for _ in range(self.N)],
+                max_concurrency=self.max_concurrency,
+                rpm=self.rpm,
+                tpm=self.tpm,
+            )
+        else:
+            responses = [self.generate_persona() for _ in range(self.N)]
+
+        for i, response in enumerate(responses):
+            persona_res_dict[i] = self.parse_content(response)
 
         ## save personas
         with open(self.save_file, "w", encoding="utf-8") as f:
@@ -173,15 +384,31 @@ if __name__ == "__main__":
     API_KEY = os.getenv("API_KEY")
     BASE_URL = os.getenv("API_HOST")
     MODEL = os.getenv("API_MODEL_NAME")
+    MAX_CONCURRENCY = int(os.getenv("API_MAX_CONCURRENCY") or 1)
+    RPM = int(os.getenv("API_RPM") or 0) or None
+    TPM = int(os.getenv("API_TPM") or 0) or None
+    CHUNK_ROWS = int(os.getenv("PERSONA_CHUNK_ROWS") or 0) or None
     if not API_KEY or not BASE_URL or not MODEL:
         raise ValueError("API_KEY, API_HOST, and API_MODEL_NAME must be set in the environment variables.")
 
     """
     For privacy reasons, here we only provide one example.
     """
-    gen_persona = GenPersona(api_key=API_KEY, base_url=BASE_URL, model=MODEL)
+    gen_persona = GenPersona(
+        api_key=API_KEY,
+        base_url=BASE_URL,
+        model=MODEL,
+        max_concurrency=MAX_CONCURRENCY,
+        rpm=RPM,
+        tpm=TPM,
+        chunk_rows=CHUNK_ROWS,
+    )
     gen_persona.run()
 
+    cache = get_default_cache()
+    if cache is not None:
+        print(f"Response cache: {cache.stats()}")
+
 """
 
 Generate a detailed user persona focused on Android smartphone users, analyzing intent-driven behavioral patterns and contextual correlations. Structure the output strictly using these markdown headers and subsections:  
@@ -0,0 +1,258 @@
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MOCK_PERSONAS = [
+    "A young office worker who checks messages and news in the morning, orders takeout at lunch and watches short videos at night.",
+    "A university student who studies with e-books and note apps, chats with classmates and plays mobile games on weekends.",
+    "A commuter who checks the map and weather before leaving home, listens to music on the way and shops online in the evening.",
+]
+MOCK_APPS = [
+    ("微信", "Check the latest messages received on the phone."),
+    ("抖音短视频", "Watch recommended short videos."),
+    ("高德地图", "Search the route to the office."),
+    ("美团外卖", "Order lunch from a nearby restaurant."),
+    ("QQ音乐", "Play the daily recommended playlist."),
+    ("墨迹天气", "Check today's weather forecast."),
+]
+
+
+class MockChatHandler(BaseHTTPRequestHandler):
+    """
+    Offline OpenAI-compatible `/chat/completions` endpoint for benchmarks and network-free tests.
+    Responses follow the persona / intention schemas of the simulator unless fixed content is configured.
+    """
+
+    protocol_version = "HTTP/1.1"  # keep-alive, so pooled clients can reuse connections
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+
+        error = self.server.sample_error()
+        if error == "timeout":
+            time.sleep(self.server.timeout_seconds)
+            self.close_connection = True
+            return
+        time.sleep(self.server.sample_latency())
+        if error is not None:
+            self.send_error_response(error)
+            return
+
+        content = self.server.content if self.server.content is not None else render_content(body.get("messages", []))
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 4
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": prompt_tokens + len(content) // 4,
+        }
+
+        if body.get("stream"):
+            include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+            self.send_stream(body, content, usage if include_usage else None)
+            return
+
+        payload = {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": usage,
+        }
+        self.send_json(200, payload)
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_response(self, status):
+        message = "Rate limit reached (mock)" if status == 429 else "Internal server error (mock)"
+        headers = {"Retry-After": "0"} if status == 429 else {}
+        self.send_json(status, {"error": {"message": message, "type": "mock_error", "code": status}}, headers)
+
+    def send_stream(self, body, content, usage=None):
+        """Sends the content as server-sent events, a few characters per chunk."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(choices, usage=None):
+            chunk = {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "mock"),
+                "choices": choices,
+            }
+            if usage is not None:
+                chunk["usage"] = usage
+            return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8")
+
+        chunk_size = self.server.chunk_size
+        try:
+            for start in range(0, len(content), chunk_size):
+                delta = {"content": content[start : start + chunk_size]}
+                self.wfile.write(event([{"index": 0, "delta": delta, "finish_reason": None}]))
+                self.wfile.flush()
+                if self.server.chunk_delay > 0:
+                    time.sleep(self.server.chunk_delay)
+            if usage is not None:
+                self.wfile.write(event([], usage))
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client closed the stream early
+
+
+def render_content(messages):
+    """
+    Templated response matching the schema the prompt asks for:
+    {"Persona": str} for persona prompts, {"Patterns": str} for chunked persona prompts,
+    List[{"Time","APP","Intention"}] for intention prompts.
+    """
+    system_prompt = next((m.get("content", "") for m in messages if m.get("role") == "system"), "")
+    if "act as a real user" in system_prompt:
+        # continue the timeline after the intentions already in the conversation
+        turn = sum(1 for m in messages if m.get("role") == "assistant")
+        start = datetime(2024, 10, 25, 7, 0) + timedelta(hours=2 * turn)
+        intentions = []
+        for i in range(10):
+            app, intention = random.choice(MOCK_APPS)
+            time_string = (start + timedelta(minutes=12 * i)).strftime("%Y-%m-%d %H:%M")
+            intentions.append({"Time": time_string, "APP": app, "Intention": intention})
+        return json.dumps(intentions, ensure_ascii=False, indent=2)
+    if '{"Patterns": str}' in system_prompt:
+        return json.dumps({"Patterns": random.choice(MOCK_PERSONAS)}, ensure_ascii=False)
+    return json.dumps({"Persona": random.choice(MOCK_PERSONAS)}, ensure_ascii=False)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        latency=0.0,
+        latency_dist="fixed",
+        latency_sigma=0.5,
+        error_429=0.0,
+        error_500=0.0,
+        error_timeout=0.0,
+        timeout_seconds=120.0,
+        content=None,
+        chunk_size=8,
+        chunk_delay=0.0,
+    ):
+        super().__init__(address, MockChatHandler)
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.error_429 = error_429
+        self.error_500 = error_500
+        self.error_timeout = error_timeout
+        self.timeout_seconds = timeout_seconds
+        self.content = content
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+
+    def sample_latency(self):
+        if self.latency <= 0:
+            return 0.0
+        if self.latency_dist == "uniform":
+            return random.uniform(0, 2 * self.latency)
+        if self.latency_dist == "lognormal":
+            # median = latency, long right tail controlled by sigma
+            return random.lognormvariate(0, self.latency_sigma) * self.latency
+        return self.latency
+
+    def sample_error(self):
+        r = random.random()
+        if r < self.error_429:
+            return 429
+        if r < self.error_429 + self.error_500:
+            return 500
+        if r < self.error_429 + self.error_500 + self.error_timeout:
+            return "timeout"
+        return None
+
+
+def start_mock_server(host="127.0.0.1", port=0, **kwargs):
+    """
+    Starts the mock server in a daemon thread.
+    Args:
+        host (str): bind address
+        port (int): bind port, 0 picks a free port
+        latency (float): base latency in seconds (the median for "lognormal", the mean for "uniform")
+        latency_dist (str): "fixed", "uniform" or "lognormal"
+        latency_sigma (float): sigma of the lognormal distribution
+        error_429, error_500, error_timeout (float): probabilities of injecting each error
+        timeout_seconds (float): how long an injected timeout hangs before closing the connection
+        content (str): fixed assistant message; None renders persona / intention templates
+        chunk_size (int): characters per streamed chunk
+        chunk_delay (float): seconds between streamed chunks
+    Returns:
+        server (MockServer), base_url (str)
+    """
+    server = MockServer((host, port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://{server.server_address[0]}:{server.server_address[1]}/v1"
+    return server, base_url
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline OpenAI-compatible chat-completions server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "lognormal"], default="fixed")
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--error-429", type=float, default=0.0)
+    parser.add_argument("--error-500", type=float, default=0.0)
+    parser.add_argument("--error-timeout", type=float, default=0.0)
+    parser.add_argument("--timeout-seconds", type=float, default=120.0)
+    parser.add_argument("--chunk-size", type=int, default=8)
+    parser.add_argument("--chunk-delay", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server, base_url = start_mock_server(
+        args.host,
+        args.port,
+        latency=args.latency,
+        latency_dist=args.latency_dist,
+        latency_sigma=args.latency_sigma,
+        error_429=args.error_429,
+        error_500=args.error_500,
+        error_timeout=args.error_timeout,
+        timeout_seconds=args.timeout_seconds,
+        chunk_size=args.chunk_size,
+        chunk_delay=args.chunk_delay,
+    )
+    print(f"Mock server listening on {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -2,15 +2,80 @@ import re
 import os
 import time
 import json
+import asyncio
 import base64
 import random
 import argparse
 import requests
+import threading
+import httpx
 import pandas as pd
 from tqdm import tqdm
-from openai import OpenAI
+import openai
+from openai import OpenAI, AsyncOpenAI
 from PIL import Image, ImageDraw
-from typing import List, Dict, Any, Optional, Tuple, Union
+from typing import List, Dict, Any, Optional, Tuple, Union, Callable, Iterator
+
+from response_cache import ResponseCache, get_default_cache
+from usage_log import record_usage
+
+# Max connections kept alive per (api_key, base_url, timeout) client, unless API_POOL_SIZE is set.
+DEFAULT_CLIENT_POOL_SIZE = 64
+
+# HTTP status codes worth retrying: rate limits, timeouts and transient server errors.
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+_client_registry: Dict[Tuple[str, str, float], OpenAI] = {}
+_client_registry_lock = threading.Lock()
+
+
+def get_client(api_key: str, base_url: str, timeout: float = 60, pool_size: Optional[int] = None) -> OpenAI:
+    """
+    Returns a shared OpenAI client for (api_key, base_url, timeout).
+    返回可复用的 OpenAI 客户端。
+
+    The client (and its keep-alive connection pool) is created on first use and reused by
+    every later call, so TLS handshakes and client setup are paid once per endpoint instead
+    of once per request. httpx clients are thread-safe, so the same client can be shared by
+    worker threads.
+
+    Parameters:
+    - api_key (str): API key for authentication.
+    - base_url (str): The base URL for the API endpoint.
+    - timeout (float, optional): Request timeout in seconds. Default is 60.
+    - pool_size (int, optional): Max pooled connections, only used when the client is created. Default is the
+      API_POOL_SIZE env var, read at that point so a .env loaded after import applies, else DEFAULT_CLIENT_POOL_SIZE.
+    Returns:
+    - OpenAI: The shared client.
+    """
+    key = (api_key, base_url, timeout)
+    client = _client_registry.get(key)
+    if client is not None:
+        return client
+
+    with _client_registry_lock:
+        client = _client_registry.get(key)
+        if client is None:
+            pool_size = pool_size or int(os.getenv("API_POOL_SIZE") or DEFAULT_CLIENT_POOL_SIZE)
+            http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                timeout=timeout,
+            )
+            # retries are done by create_chat_completion so they can be counted
+            client = OpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0, http_client=http_client)
+            _client_registry[key] = client
+    return client
+
+
+def close_clients() -> None:
+    """
+    Closes every pooled client and empties the registry.
+    关闭所有复用的客户端。
+    """
+    with _client_registry_lock:
+        for client in _client_registry.values():
+            client.close()
+        _client_registry.clear()
 
 
 def create_chat_completion(
@@ -23,6 +88,11 @@ def create_chat_completion(
     temperature: float = 1.0,
     presence_penalty: float = 1.0,
     stream: bool = False,
+    cache: Optional[ResponseCache] = None,
+    seed: Optional[int] = None,
+    caller: Optional[str] = None,
+    max_retries: int = 2,
+    on_usage: Optional[Callable[[Any], None]] = None,
 ) -> Any:
     """
     Creates a chat completion request.
@@ -37,28 +107,426 @@ def create_chat_completion(
     - top_p (float, optional): Controls nucleus sampling. Default is 1.0.
     - temperature (float, optional):  Sampling temperature. Higher values mean more random completions. Default is 1.0.
     - presence_penalty (float, optional):
-    - stream (bool, optional): Whether to stream the response. Default is False.
+    - stream (bool, optional): Whether to stream the response; the streamed deltas are joined into the returned content
+      and cached like a non-streamed response, see stream_chat_completion. Default is False.
+    - cache (ResponseCache, optional): Response cache to read/write. Default is the API_CACHE_PATH cache, if configured.
+    - seed (int, optional): Sampling seed, for providers that support deterministic sampling. Default is None.
+    - caller (str, optional): Name of the calling component, written to the usage log. Default is None.
+    - max_retries (int, optional): Retries for 429/5xx/timeout errors, with jittered exponential backoff. Default is 2.
+    - on_usage (Callable[[Any], None], optional): Called with the provider-reported usage (prompt_tokens,
+      completion_tokens, ...) when the API returns one; not called for cached responses. Default is None.
     Returns:
     - Any: The response from the chat completion API.
     """
+    if stream:
+        # stream_chat_completion looks the request up in the cache and stores the joined stream
+        deltas = stream_chat_completion(
+            api_key,
+            base_url,
+            model,
+            messages,
+            max_tokens,
+            top_p,
+            temperature,
+            presence_penalty,
+            seed=seed,
+            caller=caller,
+            max_retries=max_retries,
+            cache=cache,
+            on_usage=on_usage,
+        )
+        return "".join(deltas).strip()
+
+    extra_params = {"seed": seed} if seed is not None else {}
+    cache = cache or get_default_cache()
+    cache_key = None
+    if cache is not None:
+        cache_key = ResponseCache.make_key(model, messages, max_tokens, temperature, top_p, presence_penalty, **extra_params)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            record_usage(model, caller, latency=0.0, cached=True)
+            return cached
 
+    start_time = time.perf_counter()
+    retries = 0
     try:
-        client = OpenAI(api_key=api_key, base_url=base_url, timeout=60)
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            stream=stream,
-            timeout=60,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            presence_penalty=presence_penalty,
-            top_p=top_p,
+        client = get_client(api_key, base_url, timeout=60)
+        while True:
+            try:
+                response = client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    timeout=60,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    presence_penalty=presence_penalty,
+                    top_p=top_p,
+                    **extra_params,
+                )
+                break
+            except Exception as e:
+                if retries < max_retries and is_retryable_error(e):
+                    time.sleep(backoff_delay(retries, e))
+                    retries += 1
+                    continue
+                raise
+
+        usage = response.usage
+        record_usage(
+            model,
+            caller,
+            latency=time.perf_counter() - start_time,
+            prompt_tokens=usage.prompt_tokens if usage else None,
+            completion_tokens=usage.completion_tokens if usage else None,
+            retries=retries,
         )
+        if usage is not None and on_usage is not None:
+            on_usage(usage)
         if response:
-            return response.choices[0].message.content.strip()
+            content = response.choices[0].message.content.strip()
+            if cache_key is not None:
+                cache.put(cache_key, content)
+            return content
         else:
             print(f"OpenAI API returned no response: {response}")
             return None
     except Exception as e:
+        record_usage(model, caller, latency=time.perf_counter() - start_time, retries=retries, error=str(e))
+        print(f"OpenAI API Error: {e}")
+        raise e
+
+
+def stream_chat_completion(
+    api_key: str,
+    base_url: str,
+    model: str,
+    messages: List[Dict[str, Any]],
+    max_tokens: int = 10000,
+    top_p: float = 1.0,
+    temperature: float = 1.0,
+    presence_penalty: float = 1.0,
+    seed: Optional[int] = None,
+    caller: Optional[str] = None,
+    max_retries: int = 2,
+    cache: Optional[ResponseCache] = None,
+    on_usage: Optional[Callable[[Any], None]] = None,
+) -> Iterator[str]:
+    """
+    Streams a chat completion, yielding content deltas as they arrive.
+    流式聊天请求，逐段返回生成内容。
+
+    Closing the generator early (e.g. `break` in the consuming loop) closes the HTTP stream,
+    so the server stops generating tokens that would be thrown away. Only opening the stream is
+    retried; an error in the middle of a stream is raised to the consumer.
+
+    The response cache is shared with create_chat_completion: a cached response is yielded as a
+    single delta (in replay mode a miss raises CacheMissError before any request is sent), and a
+    stream read to the end is stored joined. A stream closed early is incomplete and not stored.
+    on_usage receives the usage chunk that ends a stream read to the end.
+
+    Parameters: see create_chat_completion.
+    Returns:
+    - Iterator[str]: The content deltas.
+    """
+    extra_params = {"seed": seed} if seed is not None else {}
+    cache = cache or get_default_cache()
+    cache_key = None
+    if cache is not None:
+        cache_key = ResponseCache.make_key(model, messages, max_tokens, temperature, top_p, presence_penalty, **extra_params)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            record_usage(model, caller, latency=0.0, stream=True, cached=True)
+            yield cached
+            return
+
+    start_time = time.perf_counter()
+    retries = 0
+    try:
+        client = get_client(api_key, base_url, timeout=60)
+        while True:
+            try:
+                response = client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    timeout=60,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    presence_penalty=presence_penalty,
+                    top_p=top_p,
+                    **extra_params,
+                )
+                break
+            except Exception as e:
+                if retries < max_retries and is_retryable_error(e):
+                    time.sleep(backoff_delay(retries, e))
+                    retries += 1
+                    continue
+                raise
+    except Exception as e:
+        record_usage(model, caller, latency=time.perf_counter() - start_time, retries=retries, stream=True, error=str(e))
         print(f"OpenAI API Error: {e}")
         raise e
+
+    ttft = None
+    usage = None
+    error = None
+    chunks = []
+    try:
+        for chunk in response:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                if ttft is None:
+                    ttft = time.perf_counter() - start_time
+                chunks.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+        if cache_key is not None:
+            cache.put(cache_key, "".join(chunks).strip())
+        if usage is not None and on_usage is not None:
+            on_usage(usage)
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        response.close()
+        record_usage(
+            model,
+            caller,
+            latency=time.perf_counter() - start_time,
+            prompt_tokens=usage.prompt_tokens if usage else None,
+            completion_tokens=usage.completion_tokens if usage else None,
+            ttft=ttft,
+            retries=retries,
+            stream=True,
+            error=error,
+        )
+
+
+def estimate_tokens(messages: List[Dict[str, Any]]) -> int:
+    """
+    Roughly estimates the prompt tokens of a messages list (~4 characters per token).
+    粗略估计消息的 token 数。
+    """
+    n_chars = 0
+    for message in messages:
+        content = message.get("content", "")
+        n_chars += len(content) if isinstance(content, str) else len(json.dumps(content, ensure_ascii=False))
+    return max(1, n_chars // 4)
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """
+    Whether an OpenAI API error is transient (429, 5xx, timeout, connection reset).
+    """
+    if isinstance(error, openai.APIConnectionError):  # includes APITimeoutError
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return False
+
+
+def backoff_delay(attempt: int, error: Optional[Exception] = None, base: float = 1.0, max_delay: float = 60.0) -> float:
+    """
+    Exponential backoff with full jitter: uniform(0, min(max_delay, base * 2^attempt)).
+    A `Retry-After` header sent by the server takes precedence.
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        try:
+            return min(max_delay, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(max_delay, base * 2**attempt))
+
+
+class AsyncRateLimiter:
+    """
+    Token-bucket limiter enforcing requests-per-minute and tokens-per-minute budgets.
+    Both buckets start full and refill continuously; None disables a budget.
+    """
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.request_allowance = float(rpm or 0)
+        self.token_allowance = float(tpm or 0)
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        if self.rpm:
+            self.request_allowance = min(self.rpm, self.request_allowance + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.token_allowance = min(self.tpm, self.token_allowance + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens: int):
+        async with self.lock:
+            while True:
+                self.refill()
+                wait = 0.0
+                if self.rpm and self.request_allowance < 1:
+                    wait = max(wait, (1 - self.request_allowance) * 60 / self.rpm)
+                if self.tpm:
+                    needed = min(tokens, self.tpm)
+                    if self.token_allowance < needed:
+                        wait = max(wait, (needed - self.token_allowance) * 60 / self.tpm)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            if self.rpm:
+                self.request_allowance -= 1
+            if self.tpm:
+                self.token_allowance -= tokens
+
+    def adjust(self, tokens: int):
+        """Charges (or refunds) the difference between estimated and actual token usage."""
+        if self.tpm:
+            self.token_allowance -= tokens
+
+
+async def async_batch_chat_completion(
+    api_key: str,
+    base_url: str,
+    model: str,
+    messages_list: List[List[Dict[str, Any]]],
+    max_tokens: int = 10000,
+    top_p: float = 1.0,
+    temperature: float = 1.0,
+    presence_penalty: float = 1.0,
+    max_concurrency: int = 8,
+    rpm: Optional[int] = None,
+    tpm: Optional[int] = None,
+    max_retries: int = 5,
+    timeout: float = 60,
+    on_result: Optional[Callable[[int, Optional[str]], None]] = None,
+    cache: Optional[ResponseCache] = None,
+    caller: Optional[str] = None,
+    seed: Optional[int] = None,
+    stream: bool = False,
+    on_usage: Optional[Callable[[int, Any], None]] = None,
+) -> List[Optional[str]]:
+    """
+    Runs many chat completions concurrently.
+    并发执行多个聊天请求。
+
+    Requests are throttled by the rpm/tpm budgets and at most `max_concurrency` are in flight.
+    429/5xx/timeout errors are retried with jittered exponential backoff. A request that still
+    fails (or hits a non-retryable error) yields None instead of aborting the whole batch.
+
+    Parameters:
+    - api_key, base_url, model, max_tokens, top_p, temperature, presence_penalty: see create_chat_completion.
+    - messages_list (List[List[Dict[str, Any]]]): one messages list per request.
+    - max_concurrency (int, optional): Max in-flight requests. Default is 8.
+    - rpm (int, optional): Requests-per-minute budget. Default is None (unlimited).
+    - tpm (int, optional): Tokens-per-minute budget. Default is None (unlimited).
+    - max_retries (int, optional): Retries per request for transient errors. Default is 5.
+    - timeout (float, optional): Per-request timeout in seconds. Default is 60.
+    - on_result (Callable[[int, Optional[str]], None], optional): Called with (index, content) as each request finishes.
+    - cache (ResponseCache, optional): Response cache to read/write. Default is the API_CACHE_PATH cache, if configured.
+    - caller (str, optional): Name of the calling component, written to the usage log. Default is None.
+    - seed (int, optional): Sampling seed sent with every request, as in create_chat_completion. Default is None.
+    - stream (bool, optional): Not supported in batch mode; True raises ValueError. Default is False.
+    - on_usage (Callable[[int, Any], None], optional): Called with (index, usage) for every request the API reports
+      usage for. Default is None.
+    Returns:
+    - List[Optional[str]]: The response contents, in the same order as `messages_list`.
+    """
+    if stream:
+        raise ValueError("Streaming is not supported by batch requests; use stream_chat_completion per request")
+    extra_params = {"seed": seed} if seed is not None else {}
+    cache = cache or get_default_cache()
+    results: List[Optional[str]] = [None] * len(messages_list)
+    cache_keys: List[Optional[str]] = [None] * len(messages_list)
+    pending = []
+    for idx, messages in enumerate(messages_list):
+        if cache is not None:
+            cache_keys[idx] = ResponseCache.make_key(
+                model, messages, max_tokens, temperature, top_p, presence_penalty, **extra_params
+            )
+            results[idx] = cache.get(cache_keys[idx])
+            if results[idx] is not None:
+                record_usage(model, caller, latency=0.0, cached=True)
+                if on_result is not None:
+                    on_result(idx, results[idx])
+                continue
+        pending.append(idx)
+
+    if not pending:
+        return results
+
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+        timeout=timeout,
+    )
+    client = AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0, http_client=http_client)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    limiter = AsyncRateLimiter(rpm=rpm, tpm=tpm)
+
+    async def worker(idx: int, messages: List[Dict[str, Any]]):
+        estimated_tokens = estimate_tokens(messages)
+        start_time = None  # set when the first attempt is sent, so queueing time is not counted as latency
+        for attempt in range(max_retries + 1):
+            await limiter.acquire(estimated_tokens)
+            try:
+                async with semaphore:
+                    start_time = start_time or time.perf_counter()
+                    response = await client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        presence_penalty=presence_penalty,
+                        top_p=top_p,
+                        **extra_params,
+                    )
+            except Exception as e:
+                if attempt < max_retries and is_retryable_error(e):
+                    await asyncio.sleep(backoff_delay(attempt, e))
+                    continue
+                record_usage(model, caller, latency=time.perf_counter() - start_time, retries=attempt, error=str(e))
+                print(f"OpenAI API Error (request {idx}): {e}")
+                break
+
+            usage = response.usage
+            record_usage(
+                model,
+                caller,
+                latency=time.perf_counter() - start_time,
+                prompt_tokens=usage.prompt_tokens if usage else None,
+                completion_tokens=usage.completion_tokens if usage else None,
+                retries=attempt,
+            )
+            if usage is not None:
+                limiter.adjust(usage.total_tokens - estimated_tokens)
+                if on_usage is not None:
+                    on_usage(idx, usage)
+            if response.choices:
+                results[idx] = response.choices[0].message.content.strip()
+                if cache_keys[idx] is not None:
+                    cache.put(cache_keys[idx], results[idx])
+            else:
+                print(f"OpenAI API returned no response: {response}")
+            break
+
+        if on_result is not None:
+            on_result(idx, results[idx])
+
+    try:
+        await asyncio.gather(*(worker(idx, messages_list[idx]) for idx in pending))
+    finally:
+        await client.close()
+    return results
+
+
+def batch_chat_completion(*args, **kwargs) -> List[Optional[str]]:
+    """
+    Blocking wrapper around async_batch_chat_completion, for use from synchronous code.
+    """
+    return asyncio.run(async_batch_chat_completion(*args, **kwargs))
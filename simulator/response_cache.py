@@ -0,0 +1,163 @@
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+from typing import List, Dict, Any, Optional
+
+CACHE_MODES = ("readwrite", "replay")
+
+
+class CacheMissError(KeyError):
+    """Raised in replay mode when a request is not in the cache."""
+
+
+class ResponseCache:
+    """
+    Persistent SQLite cache of chat completion responses.
+    聊天请求结果的持久化缓存。
+
+    Entries are keyed by a stable hash of the request parameters and evicted least-recently-used
+    first once the stored responses exceed `max_bytes`. In "replay" mode the cache is read-only
+    and a miss raises CacheMissError, so dataset builds are reproducible and never hit the API.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1 << 30, mode: str = "readwrite"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"mode must be one of {CACHE_MODES}, got {mode!r}")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if mode == "replay":
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Replay cache not found: {path}")
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+            self.conn.commit()
+
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(
+        model: str,
+        messages: List[Dict[str, Any]],
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        presence_penalty: float,
+        **extra: Any,
+    ) -> str:
+        """
+        Stable sha256 of the request parameters. Extra parameters (e.g. seed) are included only when not None,
+        so adding an optional parameter does not invalidate existing entries.
+        """
+        request = {
+            "model": model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "presence_penalty": presence_penalty,
+        }
+        request.update({k: v for k, v in extra.items() if v is not None})
+        payload = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.mode == "replay":
+                    raise CacheMissError(key)
+                return None
+
+            self.hits += 1
+            if self.mode != "replay":
+                self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                self.conn.commit()
+            return row[0]
+
+    def put(self, key: str, response: Optional[str]) -> None:
+        if self.mode == "replay" or response is None:
+            return
+        size = len(response.encode("utf-8"))
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()),
+            )
+            self.total_bytes += size - (old[0] if old else 0)
+            self.evict()
+            self.conn.commit()
+
+    def evict(self) -> None:
+        """Deletes least-recently-used entries until the cache fits in max_bytes. Caller holds the lock."""
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute("SELECT key, size FROM responses ORDER BY last_access LIMIT 64").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            n_entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": n_entries,
+            "bytes": self.total_bytes,
+        }
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+_default_cache: Optional[ResponseCache] = None
+_default_cache_loaded = False
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache() -> Optional[ResponseCache]:
+    """
+    Returns the process-wide cache configured by environment variables, or None when caching is off.
+    - API_CACHE_PATH: SQLite file; caching is disabled when unset.
+    - API_CACHE_MODE: "readwrite" (default) or "replay".
+    - API_CACHE_MAX_MB: size bound for LRU eviction (default 1024).
+    """
+    global _default_cache, _default_cache_loaded
+    if _default_cache_loaded:
+        return _default_cache
+
+    with _default_cache_lock:
+        if not _default_cache_loaded:
+            path = os.getenv("API_CACHE_PATH")
+            if path:
+                _default_cache = ResponseCache(
+                    path,
+                    max_bytes=int(os.getenv("API_CACHE_MAX_MB") or 1024) * (1 << 20),
+                    mode=os.getenv("API_CACHE_MODE") or "readwrite",
+                )
+            _default_cache_loaded = True
+    return _default_cache
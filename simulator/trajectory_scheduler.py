@@ -0,0 +1,235 @@
+import os
+import time
+import json
+import sqlite3
+import argparse
+from tqdm import tqdm
+from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Optional, Tuple
+
+from file_utils import write_json_atomic
+from generate_intention_trajectory import GenIntentTrajectory
+
+JOB_STATES = ("pending", "running", "done", "failed")
+
+
+class JobStore:
+    """
+    Persistent SQLite table of (persona × scenario × seed) trajectory jobs and their state.
+    Every state change is committed immediately, so a killed run loses at most its in-flight jobs.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job_id TEXT PRIMARY KEY, persona_id TEXT NOT NULL, scenario_id TEXT NOT NULL, seed INTEGER NOT NULL, "
+            "state TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, error TEXT, "
+            "output_file TEXT, updated_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_state ON jobs(state)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_job_id(persona_id: str, scenario_id: str, seed: int) -> str:
+        return f"{persona_id}__{scenario_id}__s{seed}"
+
+    def add_grid(self, persona_ids: List[str], scenario_ids: List[str], seeds: List[int]) -> int:
+        """Expands the grid into jobs. Existing jobs keep their state, so re-adding a grid is idempotent."""
+        now = time.time()
+        rows = [
+            (self.make_job_id(persona_id, scenario_id, seed), persona_id, scenario_id, seed, now)
+            for persona_id in persona_ids
+            for scenario_id in scenario_ids
+            for seed in seeds
+        ]
+        cursor = self.conn.executemany(
+            "INSERT OR IGNORE INTO jobs (job_id, persona_id, scenario_id, seed, updated_at) VALUES (?, ?, ?, ?, ?)",
+            rows,
+        )
+        self.conn.commit()
+        return cursor.rowcount
+
+    def reset_running(self) -> int:
+        """Returns jobs left 'running' by a killed run to 'pending'."""
+        cursor = self.conn.execute(
+            "UPDATE jobs SET state = 'pending', updated_at = ? WHERE state = 'running'", (time.time(),)
+        )
+        self.conn.commit()
+        return cursor.rowcount
+
+    def retry_failed(self) -> int:
+        cursor = self.conn.execute(
+            "UPDATE jobs SET state = 'pending', attempts = 0, updated_at = ? WHERE state = 'failed'", (time.time(),)
+        )
+        self.conn.commit()
+        return cursor.rowcount
+
+    def claim(self) -> Optional[Tuple[str, str, str, int]]:
+        """Marks the next pending job as running and returns (job_id, persona_id, scenario_id, seed)."""
+        row = self.conn.execute(
+            "SELECT job_id, persona_id, scenario_id, seed FROM jobs WHERE state = 'pending' ORDER BY rowid LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+        self.conn.execute("UPDATE jobs SET state = 'running', updated_at = ? WHERE job_id = ?", (time.time(), row[0]))
+        self.conn.commit()
+        return row
+
+    def mark_done(self, job_id: str, output_file: str):
+        self.conn.execute(
+            "UPDATE jobs SET state = 'done', error = NULL, output_file = ?, updated_at = ? WHERE job_id = ?",
+            (output_file, time.time(), job_id),
+        )
+        self.conn.commit()
+
+    def mark_failed(self, job_id: str, error: str, max_attempts: int) -> bool:
+        """
+        Records a failure; the job goes back to 'pending' until it has failed `max_attempts` times.
+        Returns True when the job is now permanently 'failed'.
+        """
+        self.conn.execute(
+            "UPDATE jobs SET attempts = attempts + 1, error = ?, updated_at = ?, "
+            "state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END WHERE job_id = ?",
+            (error, time.time(), max_attempts, job_id),
+        )
+        self.conn.commit()
+        row = self.conn.execute("SELECT state FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row[0] == "failed"
+
+    def counts(self) -> Dict[str, int]:
+        counts = {state: 0 for state in JOB_STATES}
+        for state, n in self.conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"):
+            counts[state] = n
+        return counts
+
+    def close(self):
+        self.conn.close()
+
+
+class TrajectoryScheduler:
+    """
+    Runs the jobs of a JobStore on a bounded thread pool with GenIntentTrajectory.
+    Each job writes `intentions_{job_id}.json` atomically into the generator's save_dir.
+    """
+
+    def __init__(
+        self,
+        generator: GenIntentTrajectory,
+        store: JobStore,
+        personas: Dict[str, str],
+        scenarios: Dict[str, str],
+        max_workers: int = 4,
+        max_attempts: int = 3,
+    ):
+        self.generator = generator
+        self.store = store
+        self.personas = personas
+        self.scenarios = scenarios
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+
+    def run_job(self, job_id: str, persona_id: str, scenario_id: str, seed: int) -> str:
+        # API errors propagate, so the job is retried through mark_failed instead of saved truncated
+        intentions = self.generator.generate_intentions(
+            self.personas[persona_id], self.scenarios[scenario_id], seed=seed, partial_on_error=False
+        )
+        if not intentions:
+            raise RuntimeError("No intentions generated.")
+        output_file = os.path.join(self.generator.save_dir, f"intentions_{job_id}.json")
+        write_json_atomic(output_file, intentions)
+        return output_file
+
+    def run(self):
+        n_reset = self.store.reset_running()
+        if n_reset:
+            print(f"Resuming: {n_reset} interrupted jobs returned to pending.")
+
+        counts = self.store.counts()
+        total = sum(counts.values())
+        # tqdm's rate/ETA come from throughput observed in this run
+        progress = tqdm(total=total, initial=counts["done"] + counts["failed"], desc="trajectory jobs", unit="job")
+
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                while len(in_flight) < self.max_workers:
+                    job = self.store.claim()
+                    if job is None:
+                        break
+                    in_flight[executor.submit(self.run_job, *job)] = job
+                if not in_flight:
+                    break
+
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job_id = in_flight.pop(future)[0]
+                    try:
+                        self.store.mark_done(job_id, future.result())
+                        progress.update(1)
+                    except Exception as e:
+                        if self.store.mark_failed(job_id, str(e), self.max_attempts):
+                            progress.update(1)
+                progress.set_postfix(self.store.counts())
+
+        progress.close()
+        print(f"Jobs: {self.store.counts()}")
+
+
+def load_scenarios(path: Optional[str]) -> Dict[str, str]:
+    """
+    Reads scenarios from a JSON file, either {scenario_id: scenario} or a list of scenarios
+    (ids are then list indices). Without a file, a single empty scenario is used.
+    """
+    if not path:
+        return {"default": ""}
+    with open(path, "r", encoding="utf-8") as f:
+        scenarios = json.load(f)
+    if isinstance(scenarios, list):
+        scenarios = {str(idx): scenario for idx, scenario in enumerate(scenarios)}
+    return scenarios
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate intention trajectories for a persona × scenario × seed grid.")
+    parser.add_argument("--personas", default="simulator/user_personas.json")
+    parser.add_argument("--scenarios", default=None, help="JSON file of scenarios")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0])
+    parser.add_argument("--db", default="simulator/trajectory_jobs.sqlite")
+    parser.add_argument("--save-dir", default="simulator/trajectory")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-attempts", type=int, default=3)
+    parser.add_argument("--retry-failed", action="store_true", help="reset failed jobs to pending before running")
+    args = parser.parse_args()
+
+    load_dotenv()
+    API_KEY = os.getenv("API_KEY")
+    BASE_URL = os.getenv("API_HOST")
+    MODEL = os.getenv("API_MODEL_NAME")
+    if not API_KEY or not BASE_URL or not MODEL:
+        raise ValueError("API_KEY, API_HOST, and API_MODEL_NAME must be set in the environment variables.")
+
+    with open(args.personas, "r", encoding="utf-8") as f:
+        personas = json.load(f)
+    scenarios = load_scenarios(args.scenarios)
+
+    store = JobStore(args.db)
+    n_new = store.add_grid(list(personas.keys()), list(scenarios.keys()), args.seeds)
+    print(f"Added {n_new} new jobs to {args.db}")
+    if args.retry_failed:
+        store.retry_failed()
+
+    generator = GenIntentTrajectory(
+        api_key=API_KEY,
+        base_url=BASE_URL,
+        model=MODEL,
+        max_iterations=int(os.getenv("API_MAX_ITERATIONS") or 3),
+        intent_length_max=int(os.getenv("API_INTENT_LENGTH_MAX") or 100),
+    )
+    generator.save_dir = args.save_dir
+    scheduler = TrajectoryScheduler(generator, store, personas, scenarios, args.workers, args.max_attempts)
+    scheduler.run()
+    store.close()
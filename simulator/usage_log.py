@@ -0,0 +1,172 @@
+import os
+import sys
+import time
+import json
+import argparse
+import threading
+import numpy as np
+from collections import defaultdict
+from typing import List, Dict, Any, Optional
+
+
+class UsageRecorder:
+    """
+    Appends one JSON line per LLM call (model, tokens, latency, retries, caller, ...) to a file.
+    Thread-safe; lines are flushed as they are written so a crashed run keeps its records.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def record(self, **fields: Any) -> None:
+        fields = {"timestamp": time.time(), **fields}
+        line = json.dumps(fields, ensure_ascii=False) + "\n"
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+
+_default_recorder: Optional[UsageRecorder] = None
+_default_recorder_loaded = False
+_default_recorder_lock = threading.Lock()
+
+
+def get_default_recorder() -> Optional[UsageRecorder]:
+    """Returns the recorder writing to API_USAGE_LOG, or None when the variable is unset."""
+    global _default_recorder, _default_recorder_loaded
+    if _default_recorder_loaded:
+        return _default_recorder
+
+    with _default_recorder_lock:
+        if not _default_recorder_loaded:
+            path = os.getenv("API_USAGE_LOG")
+            if path:
+                _default_recorder = UsageRecorder(path)
+            _default_recorder_loaded = True
+    return _default_recorder
+
+
+def set_default_recorder(recorder: Optional[UsageRecorder]) -> None:
+    global _default_recorder, _default_recorder_loaded
+    with _default_recorder_lock:
+        _default_recorder = recorder
+        _default_recorder_loaded = True
+
+
+def record_usage(
+    model: str,
+    caller: Optional[str],
+    latency: float,
+    prompt_tokens: Optional[int] = None,
+    completion_tokens: Optional[int] = None,
+    ttft: Optional[float] = None,
+    retries: int = 0,
+    stream: bool = False,
+    cached: bool = False,
+    error: Optional[str] = None,
+) -> None:
+    """
+    Records one LLM call to the default recorder (no-op when API_USAGE_LOG is unset).
+    Args:
+        model (str): model name
+        caller (str): component that issued the call, e.g. "GenPersona"
+        latency (float): wall-clock seconds, including retries
+        prompt_tokens (int): provider-reported prompt tokens
+        completion_tokens (int): provider-reported completion tokens
+        ttft (float): seconds to the first streamed token
+        retries (int): retried attempts
+        stream (bool): whether the call was streamed
+        cached (bool): whether the response came from the response cache
+        error (str): error message when the call failed
+    """
+    recorder = get_default_recorder()
+    if recorder is None:
+        return
+    recorder.record(
+        model=model,
+        caller=caller,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        latency=round(latency, 4),
+        ttft=None if ttft is None else round(ttft, 4),
+        retries=retries,
+        stream=stream,
+        cached=cached,
+        error=error,
+    )
+
+
+def load_records(path: str) -> List[Dict[str, Any]]:
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def summarize(records: List[Dict[str, Any]], key: str) -> List[Dict[str, Any]]:
+    """
+    Description:
+        Groups records by `key` ("caller" or "model") and computes latency percentiles and token totals.
+        Cache hits are counted but excluded from latency percentiles.
+    Returns:
+        rows (List[Dict[str, Any]])
+    """
+    groups = defaultdict(list)
+    for record in records:
+        groups[record.get(key) or "-"].append(record)
+
+    rows = []
+    for name, group in sorted(groups.items()):
+        latencies = [r["latency"] for r in group if not r.get("cached") and not r.get("error")]
+        ttfts = [r["ttft"] for r in group if r.get("ttft") is not None]
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (0.0, 0.0, 0.0)
+        rows.append(
+            {
+                key: name,
+                "calls": len(group),
+                "cached": sum(1 for r in group if r.get("cached")),
+                "errors": sum(1 for r in group if r.get("error")),
+                "retries": sum(r.get("retries") or 0 for r in group),
+                "p50": p50,
+                "p95": p95,
+                "p99": p99,
+                "ttft_p50": float(np.percentile(ttfts, 50)) if ttfts else None,
+                "prompt_tokens": sum(r.get("prompt_tokens") or 0 for r in group),
+                "completion_tokens": sum(r.get("completion_tokens") or 0 for r in group),
+            }
+        )
+    return rows
+
+
+def print_summary(records: List[Dict[str, Any]]) -> None:
+    for key in ("caller", "model"):
+        print(
+            f"{key:<24} {'calls':>7} {'cached':>7} {'errors':>7} {'retries':>7} "
+            f"{'p50(s)':>8} {'p95(s)':>8} {'p99(s)':>8} {'ttft50':>8} {'prompt_tok':>11} {'compl_tok':>11}"
+        )
+        for row in summarize(records, key):
+            ttft = "-" if row["ttft_p50"] is None else f"{row['ttft_p50']:.3f}"
+            print(
+                f"{str(row[key]):<24} {row['calls']:>7} {row['cached']:>7} {row['errors']:>7} {row['retries']:>7} "
+                f"{row['p50']:>8.3f} {row['p95']:>8.3f} {row['p99']:>8.3f} {ttft:>8} "
+                f"{row['prompt_tokens']:>11} {row['completion_tokens']:>11}"
+            )
+        print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize LLM usage records written to API_USAGE_LOG.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary", help="latency percentiles and token totals per caller and model")
+    summary_parser.add_argument("path", nargs="?", default=os.getenv("API_USAGE_LOG"))
+    args = parser.parse_args()
+
+    if not args.path:
+        sys.exit("No usage log given and API_USAGE_LOG is not set.")
+    print_summary(load_records(args.path))